@@ -0,0 +1,78 @@
+"""Compares the `slice` and `einsum` core contractions of SecondOrderRNN on one-hot inputs.
+
+    python benchmarks/bench_2rnn_kernel.py --hidden_sizes 128 256 512 1024 2048 --vocab_size 50
+
+Reports the max. error of the outputs and of the core gradients, forward and forward+backward times, and the peak
+memory of forward+backward (GPU only) or else the activation memory kept for backward.
+"""
+import argparse as argparse
+
+import torch
+
+from cprnn.models import SecondOrderRNN
+from common import time_fn, SavedTensorsMeter
+
+
+def peak_memory(fn, model, device: torch.device):
+    """Peak memory of `fn()` in MB on GPU, activation memory kept for backward by `model` on CPU"""
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    with SavedTensorsMeter(model) as meter:
+        fn()
+    return meter.nbytes / 2 ** 20
+
+
+def main(args):
+    device = torch.device(args.device)
+    print("{:>6} | {:>8} | {:>8} | {:>12} | {:>12} | {:>8} | {:>12} | {:>12} | {:>8} | {:>12} | {:>12}".format(
+        "hidden", "max err", "grad err", "einsum fwd", "slice fwd", "speedup", "einsum f+b", "slice f+b", "speedup",
+        "einsum (MB)", "slice (MB)"
+    ))
+
+    for hidden_size in args.hidden_sizes:
+        model = SecondOrderRNN(input_size=0, hidden_size=hidden_size, vocab_size=args.vocab_size, dropout=0)
+        model = model.to(device)
+        inp = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len)).to(device)
+        results = dict()
+
+        for kernel in ['einsum', 'slice']:
+            model.kernel = kernel
+
+            def forward():
+                with torch.no_grad():
+                    return model(inp)[0]
+
+            def forward_backward():
+                model.zero_grad()
+                model(inp)[0].sum().backward()
+
+            forward_backward()
+            grad = model.w.grad.clone()
+            memory = peak_memory(forward_backward, model, device)
+            results[kernel] = (
+                forward(), grad, time_fn(forward, args.iters), time_fn(forward_backward, args.iters), memory
+            )
+
+        max_err = (results['einsum'][0] - results['slice'][0]).abs().max().item()
+        grad_err = (results['einsum'][1] - results['slice'][1]).abs().max().item()
+        print("{:>6} | {:8.1e} | {:8.1e} | {:10.4f}s | {:10.4f}s | {:7.2f}x | {:10.4f}s | {:10.4f}s | {:7.2f}x | "
+              "{:12.1f} | {:12.1f}".format(
+                  hidden_size, max_err, grad_err,
+                  results['einsum'][2], results['slice'][2], results['einsum'][2] / results['slice'][2],
+                  results['einsum'][3], results['slice'][3], results['einsum'][3] / results['slice'][3],
+                  results['einsum'][4], results['slice'][4]
+              ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SecondOrderRNN core kernels')
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=[128, 256, 512, 1024, 2048])
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--seq_len', type=int, default=50)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
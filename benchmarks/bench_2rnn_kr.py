@@ -0,0 +1,98 @@
+"""Compares the Khatri-Rao-free contraction of SecondOrderRNNKR with the one forming the Khatri-Rao product.
+
+    python benchmarks/bench_2rnn_kr.py --sizes 512 1024 2048
+
+First runs `gradcheck` on `Bilinear` in double precision and compares the gradients of both contractions. Then, for
+every `I = H` in `--sizes`, reports the activation memory kept for backward, the peak memory of a training step (GPU
+only), the forward/backward times and the tokens/s of the one-token-at-a-time generation of `toy_make_dataset`.
+"""
+import argparse as argparse
+import copy
+
+import torch
+
+from cprnn.models import SecondOrderRNNKR
+from cprnn.models.second_order_rnn_kr import bilinear
+from common import time_fn, SavedTensorsMeter
+
+
+def check_gradients():
+    batch_size, input_size, hidden_size = 3, 4, 5
+    inputs = (
+        torch.randn(batch_size, input_size, dtype=torch.double, requires_grad=True),
+        torch.randn(batch_size, hidden_size, dtype=torch.double, requires_grad=True),
+        torch.randn(hidden_size, input_size, hidden_size, dtype=torch.double, requires_grad=True),
+    )
+    print("gradcheck | bilinear | {}".format(torch.autograd.gradcheck(bilinear, inputs)))
+
+    model = SecondOrderRNNKR(input_size=8, hidden_size=16, vocab_size=20).double()
+    model_kr = copy.deepcopy(model)
+    model_kr.contraction = 'khatri_rao'
+    inputs = torch.randint(0, 20, (10, 4))
+
+    grads = []
+    for m in [model, model_kr]:
+        m(inputs)[0].pow(2).sum().backward()
+        grads.append([p.grad for p in m.parameters()])
+    max_err = max((g - g_kr).abs().max().item() for g, g_kr in zip(*grads))
+    print("bilinear vs. khatri_rao | max grad error {:.2e}".format(max_err))
+
+
+def main(args):
+    check_gradients()
+
+    device = torch.device(args.device)
+    inputs = torch.randint(0, args.vocab_size, (args.seq_len, args.batch_size)).to(device)
+    print("{:>6} | {:>10} | {:>16} | {:>10} | {:>10} | {:>10} | {:>12}".format(
+        "I = H", "mode", "activations (MB)", "peak (MB)", "forward", "backward", "gen. tok/s"
+    ))
+    for size in args.sizes:
+        model = SecondOrderRNNKR(input_size=size, hidden_size=size, vocab_size=args.vocab_size).to(device)
+
+        for contraction in ['khatri_rao', 'bilinear']:
+            model.contraction = contraction
+            model.train()
+
+            with SavedTensorsMeter(model) as meter:
+                model(inputs)
+
+            peak = float('nan')
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+                model(inputs)[0].sum().backward()
+                peak = torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+            def forward():
+                return model(inputs)[0].sum()
+
+            def forward_backward():
+                model.zero_grad()
+                forward().backward()
+
+            def generate():
+                # As in `toy_make_dataset`, one token at a time without autograd
+                input_ids, hidden = inputs[:1, :1], None
+                with torch.no_grad():
+                    for _ in range(args.gen_length):
+                        input_ids, _, hidden = model(input_ids, hidden)
+
+            time_forward = time_fn(forward, args.iters)
+            time_backward = time_fn(forward_backward, args.iters) - time_forward
+            model.eval()
+            time_generate = time_fn(generate, args.iters)
+            print("{:>6} | {:>10} | {:16.1f} | {:10.1f} | {:9.4f}s | {:9.4f}s | {:12.1f}".format(
+                size, contraction, meter.nbytes / 2 ** 20, peak, time_forward, time_backward,
+                args.gen_length / time_generate
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Khatri-Rao-free contraction of SecondOrderRNNKR')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024])
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--seq_len', type=int, default=20)
+    parser.add_argument('--gen_length', type=int, default=200)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
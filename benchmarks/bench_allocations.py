@@ -0,0 +1,50 @@
+"""Allocations per timestep of the recurrence, for the in-place inference loop and the autograd (training) loop.
+
+    python benchmarks/bench_allocations.py --models cprnn mrnn mirnn 2rnn --hidden_size 512 --rank 64
+
+Allocations are counted for the time loop only (`model.encode`) at two sequence lengths, and the difference is
+divided by the number of extra timesteps, so allocations made once per call do not count.
+"""
+import argparse as argparse
+
+import torch
+
+from common import models, time_fn, count_allocations
+
+
+def main(args):
+    device = torch.device(args.device)
+    print("{:>6} | {:>10} | {:>12} | {:>12} | {:>10}".format("model", "mode", "allocs/step", "allocs/call", "time"))
+
+    for name in args.models:
+        model = models[name](
+            input_size=0, hidden_size=args.hidden_size, vocab_size=args.vocab_size, rank=args.rank, dropout=0
+        ).to(device)
+        inputs = {
+            seq_len: torch.randint(0, args.vocab_size, (args.batch_size, seq_len)).to(device)
+            for seq_len in (args.seq_len, 2 * args.seq_len)
+        }
+
+        for mode, grad in [('inplace', False), ('autograd', True)]:
+            def encode(seq_len):
+                with torch.set_grad_enabled(grad):
+                    return model.encode(inputs[seq_len])
+
+            counts = {seq_len: count_allocations(lambda: encode(seq_len)) for seq_len in inputs}
+            per_step = (counts[2 * args.seq_len] - counts[args.seq_len]) / args.seq_len
+            print("{:>6} | {:>10} | {:12.1f} | {:12d} | {:9.4f}s".format(
+                name, mode, per_step, counts[args.seq_len], time_fn(lambda: encode(args.seq_len), args.iters)
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark per-timestep allocations of the recurrence')
+    parser.add_argument('-m', '--models', type=str, nargs='+', default=['cprnn', 'mrnn', 'mirnn', '2rnn'])
+    parser.add_argument('--hidden_size', type=int, default=512)
+    parser.add_argument('--rank', type=int, default=64)
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--seq_len', type=int, default=50)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
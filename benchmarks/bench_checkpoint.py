@@ -0,0 +1,60 @@
+"""Activation memory vs. step time of the custom RNNs for different numbers of checkpointed time segments.
+
+    python benchmarks/bench_checkpoint.py --model cprnn --hidden_size 2048 --rank 64 --batch_size 1024
+
+On CPU the memory column is the activation memory kept for backward. On GPU the peak allocated memory of a whole
+training step is reported as well.
+"""
+import argparse as argparse
+
+import torch
+import torch.nn as nn
+
+from common import models, time_fn, SavedTensorsMeter
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = models[args.model](
+        input_size=0, hidden_size=args.hidden_size, vocab_size=args.vocab_size, rank=args.rank, dropout=0
+    ).to(device)
+    criterion = nn.CrossEntropyLoss()
+    inputs = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len)).to(device)
+    targets = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len)).to(device)
+
+    def train_step():
+        model.zero_grad()
+        output, _ = model(inputs)
+        criterion(output.reshape(-1, args.vocab_size), targets.reshape(-1)).backward()
+
+    print("{:>8} | {:>16} | {:>16} | {:>12}".format("segments", "activations (MB)", "peak (MB)", "step time"))
+    for segments in args.segments:
+        model.recurrence.checkpoint_segments = segments
+
+        with SavedTensorsMeter(model) as meter:
+            model(inputs)
+        activations = meter.nbytes / 2 ** 20
+
+        peak = float('nan')
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            train_step()
+            peak = torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+        print("{:>8} | {:16.1f} | {:16.1f} | {:11.4f}s".format(
+            segments, activations, peak, time_fn(train_step, args.iters)
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark activation checkpointing over time segments')
+    parser.add_argument('-m', '--model', type=str, default='cprnn', choices=['cprnn', 'mrnn', 'mirnn', '2rnn'])
+    parser.add_argument('--segments', type=int, nargs='+', default=[0, 1, 2, 5, 10, 25])
+    parser.add_argument('--hidden_size', type=int, default=2048)
+    parser.add_argument('--rank', type=int, default=64)
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--seq_len', type=int, default=50)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
@@ -0,0 +1,101 @@
+"""Checks the hand-written backward of `cp_recurrence` and compares it with the autograd time loop of CPRNN/MRNN.
+
+    python benchmarks/bench_cp_recurrence.py --model cprnn --hidden_size 1024 --ranks 64 128 256 512
+
+First runs `gradcheck` in double precision for every gate, with and without the bias/input terms, and compares the
+gradients of a model trained with `recompute` against the regular loop. Then reports the activation memory kept for
+backward, the peak memory of a training step (GPU only) and the forward/backward times for each rank.
+"""
+import argparse as argparse
+import copy
+
+import torch
+
+from cprnn.models.recurrence import cp_recurrence
+from common import models, time_fn, SavedTensorsMeter
+
+
+def check_gradients():
+    batch_size, seq_len, hidden_size, rank = 3, 5, 6, 4
+    for gate in ['tanh', 'sigmoid', 'identity']:
+        for with_bias, with_input in [(True, False), (False, True)]:
+            inputs = (
+                torch.randn(batch_size, hidden_size, dtype=torch.double, requires_grad=True),
+                torch.randn(hidden_size, rank, dtype=torch.double, requires_grad=True),
+                torch.randn(rank, dtype=torch.double, requires_grad=True) if with_bias else None,
+                torch.randn(hidden_size, rank, dtype=torch.double, requires_grad=True),
+                torch.randn(seq_len, batch_size, rank, dtype=torch.double, requires_grad=True),
+                torch.randn(seq_len, batch_size, hidden_size, dtype=torch.double, requires_grad=True)
+                if with_input else None,
+            )
+            ok = torch.autograd.gradcheck(lambda *x: cp_recurrence(*x, gate=gate), inputs)
+            print("gradcheck | gate {:>8} | bias {:>5} | input {:>5} | {}".format(gate, with_bias, with_input, ok))
+
+
+def compare_models(args):
+    inputs = torch.randint(0, args.vocab_size, (8, 20))
+    for name in ['cprnn', 'mrnn']:
+        model = models[name](input_size=0, hidden_size=64, vocab_size=args.vocab_size, rank=16, dropout=0).double()
+        model_recompute = copy.deepcopy(model)
+        model_recompute.recompute = True
+
+        grads = []
+        for m in [model, model_recompute]:
+            m(inputs)[0].pow(2).sum().backward()
+            grads.append([p.grad for p in m.parameters()])
+        max_err = max((g - g_r).abs().max().item() for g, g_r in zip(*grads))
+        print("{:>6} | recompute vs. autograd loop | max grad error {:.2e}".format(name, max_err))
+
+
+def main(args):
+    check_gradients()
+    compare_models(args)
+
+    device = torch.device(args.device)
+    inputs = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len)).to(device)
+    print("{:>6} | {:>10} | {:>16} | {:>10} | {:>10} | {:>10}".format(
+        "rank", "mode", "activations (MB)", "peak (MB)", "forward", "backward"
+    ))
+    for rank in args.ranks:
+        model = models[args.model](
+            input_size=0, hidden_size=args.hidden_size, vocab_size=args.vocab_size, rank=rank, dropout=0
+        ).to(device)
+
+        for recompute in [False, True]:
+            model.recompute = recompute
+
+            with SavedTensorsMeter(model) as meter:
+                model.encode(inputs)
+
+            peak = float('nan')
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+                model.encode(inputs)[0].sum().backward()
+                peak = torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+            def forward():
+                return model.encode(inputs)[0].sum()
+
+            def forward_backward():
+                model.zero_grad()
+                forward().backward()
+
+            time_forward = time_fn(forward, args.iters)
+            time_backward = time_fn(forward_backward, args.iters) - time_forward
+            print("{:>6} | {:>10} | {:16.1f} | {:10.1f} | {:9.4f}s | {:9.4f}s".format(
+                rank, 'recompute' if recompute else 'autograd', meter.nbytes / 2 ** 20, peak, time_forward,
+                time_backward
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and benchmark the hand-written CP recurrence backward')
+    parser.add_argument('-m', '--model', type=str, default='cprnn', choices=['cprnn', 'mrnn'])
+    parser.add_argument('--ranks', type=int, nargs='+', default=[64, 128, 256, 512])
+    parser.add_argument('--hidden_size', type=int, default=1024)
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--seq_len', type=int, default=50)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
@@ -0,0 +1,93 @@
+"""Per-token generation latency of `model.step` vs. the `model.predict` path that `sample()` used before.
+
+    python benchmarks/bench_step.py --hidden_size 256 --models cprnn mrnn lstmpt
+    python benchmarks/bench_step.py --decoders adaptive --vocab_size 10000 --input_size 128
+
+For every model and decoder, first checks that stepping through a sequence gives the logits of `forward`, then
+times the generation of `--tokens` tokens with batch size 1 and top-k sampling: `predict` runs the full `forward`
+machinery and draws with numpy on the host every token, `step` runs one recurrent update, scores the whole
+vocabulary and draws on the device, and `step top_k` (what `sample()` uses) only scores the `top_k` most likely
+tokens, which skips most tail clusters of the adaptive softmax. Adaptive decoders are sized from Zipfian counts.
+"""
+import argparse as argparse
+
+import torch
+
+from common import models, time_fn
+
+
+def check_step(model, inputs: torch.LongTensor):
+    """Max. abs. difference between the logits of `forward` and those of `step` over the sequence `inputs` [B, S]"""
+    with torch.no_grad():
+        output, _ = model(inputs)  # [B, S, D_out]
+        states, err = None, 0.0
+        for t in range(inputs.size(1)):
+            logits, states = model.step(inputs[:, t], states)
+            err = max(err, (logits - output[:, t]).abs().max().item())
+    return err
+
+
+def generate_predict(model, n_tokens: int, top_k: int, device: torch.device):
+    states = model.init_hidden(batch_size=1, device=device)
+    output_id = torch.zeros(1, 1, dtype=torch.long, device=device)
+    for _ in range(n_tokens):
+        output_id, states = model.predict(output_id.reshape(1, 1), states, top_k=top_k, device=device)
+        output_id.item()
+
+
+def generate_step(model, n_tokens: int, top_k: int, device: torch.device, step_top_k: bool = False):
+    states = model.init_hidden(batch_size=1, device=device)
+    output_id = torch.zeros(1, dtype=torch.long, device=device)
+    output_ids = []
+    with torch.no_grad():
+        for _ in range(n_tokens):
+            if step_top_k:
+                (probs, top_ids), states = model.step(output_id, states, top_k=top_k)
+            else:
+                logits, states = model.step(output_id, states)
+                probs, top_ids = torch.topk(torch.softmax(logits, dim=-1), top_k, dim=-1)
+            output_id = top_ids.gather(-1, torch.multinomial(probs, 1)).view(1)
+            output_ids.append(output_id)
+    torch.cat(output_ids).tolist()
+
+
+def main(args):
+    device = torch.device(args.device)
+    unigram_counts = 1 / torch.arange(1, args.vocab_size + 1).float()  # Zipf
+    print("{:>8} | {:>8} | {:>12} | {:>14} | {:>14} | {:>15} | {:>8}".format(
+        "model", "decoder", "max err", "predict (ms)", "step (ms)", "step top_k (ms)", "speedup"
+    ))
+    for name in args.models:
+        for decoder in args.decoders:
+            model = models[name](
+                input_size=args.input_size, use_embedding=args.input_size > 0, hidden_size=args.hidden_size,
+                vocab_size=args.vocab_size, rank=args.rank, dropout=0, decoder=decoder, unigram_counts=unigram_counts
+            ).to(device)
+            model.eval()
+
+            err = check_step(model, torch.randint(0, args.vocab_size, (4, 20)).to(device))
+            time_predict = time_fn(lambda: generate_predict(model, args.tokens, args.top_k, device), args.iters)
+            time_step = time_fn(lambda: generate_step(model, args.tokens, args.top_k, device), args.iters)
+            time_step_top_k = time_fn(
+                lambda: generate_step(model, args.tokens, args.top_k, device, step_top_k=True), args.iters
+            )
+            print("{:>8} | {:>8} | {:12.2e} | {:14.3f} | {:14.3f} | {:15.3f} | {:7.2f}x".format(
+                name, decoder, err, 1e3 * time_predict / args.tokens, 1e3 * time_step / args.tokens,
+                1e3 * time_step_top_k / args.tokens, time_predict / time_step_top_k
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the single-token step against the predict path')
+    parser.add_argument('--models', type=str, nargs='+', default=list(models.keys()), choices=list(models.keys()))
+    parser.add_argument('--decoders', type=str, nargs='+', default=['linear', 'adaptive'],
+                        choices=['linear', 'adaptive'])
+    parser.add_argument('--input_size', type=int, default=0, help='Embedding size, one-hot inputs if 0')
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--rank', type=int, default=64)
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--top_k', type=int, default=5)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
@@ -0,0 +1,55 @@
+"""Inference through per-token transition matrices vs. the CP factors, for small-vocabulary CPRNN/MRNN.
+
+    python benchmarks/bench_transition_table.py --models cprnn mrnn --hidden_sizes 128 256 512 --rank 64
+
+For every size the recurrence (`model.encode`) is timed with `transition_table` set to `never` and `always`, the
+hidden states of the two are compared, and the `auto` column shows which one the cost model picks.
+"""
+import argparse as argparse
+
+import torch
+
+from common import models, time_fn
+
+
+def main(args):
+    device = torch.device(args.device)
+    print("{:>6} | {:>6} | {:>6} | {:>10} | {:>10} | {:>8} | {:>6} | {:>9}".format(
+        "model", "hidden", "batch", "factors", "table", "speedup", "auto", "max err"
+    ))
+
+    for name in args.models:
+        for hidden_size in args.hidden_sizes:
+            model = models[name](
+                input_size=0, hidden_size=hidden_size, vocab_size=args.vocab_size, rank=args.rank, dropout=0
+            ).to(device).eval()
+
+            for batch_size in args.batch_sizes:
+                inp = torch.randint(0, args.vocab_size, (batch_size, args.seq_len)).to(device)
+
+                def encode(mode):
+                    model.transition_table = mode
+                    with torch.no_grad():
+                        return model.encode(inp)[0]
+
+                t_factors, t_table = time_fn(lambda: encode('never'), args.iters), \
+                    time_fn(lambda: encode('always'), args.iters)
+                max_err = (encode('never') - encode('always')).abs().max().item()
+                model.transition_table = 'auto'
+                print("{:>6} | {:6d} | {:6d} | {:9.4f}s | {:9.4f}s | {:7.2f}x | {:>6} | {:9.2e}".format(
+                    name, hidden_size, batch_size, t_factors, t_table, t_factors / t_table,
+                    "table" if model.use_transition_table(batch_size) else "cp", max_err
+                ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the per-token transition table of CPRNN/MRNN')
+    parser.add_argument('-m', '--models', type=str, nargs='+', default=['cprnn', 'mrnn'])
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 128])
+    parser.add_argument('--rank', type=int, default=64)
+    parser.add_argument('--vocab_size', type=int, default=50)
+    parser.add_argument('--seq_len', type=int, default=100)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    main(parser.parse_args())
@@ -0,0 +1,67 @@
+import time
+
+import torch
+import torch.nn as nn
+
+from cprnn.models import CPRNN, SecondOrderRNN, LSTMPT, MRNN, MIRNN, CPLSTM, BlockSparseSecondOrderRNN
+
+models = {
+    "cprnn": CPRNN,
+    "2rnn": SecondOrderRNN,
+    "lstmpt": LSTMPT,
+    "mrnn": MRNN,
+    "mirnn": MIRNN,
+    "cplstm": CPLSTM,
+    "2rnn_bs": BlockSparseSecondOrderRNN
+}
+
+
+def time_fn(fn, iters=3, warmup=1):
+    """Average wall-clock time of `fn()` in seconds"""
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters
+
+
+def count_allocations(fn):
+    """Number of allocator calls made by `fn()` (CPU and CUDA), from the profiler's memory events"""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+        fn()
+    return sum(
+        1 for e in prof.events() if e.name == '[memory]' and (e.cpu_memory_usage > 0 or e.cuda_memory_usage > 0)
+    )
+
+
+class SavedTensorsMeter:
+    """Counts the bytes autograd keeps alive for backward, i.e. the activation memory of a forward pass
+
+    Storages are counted once even if saved several times, and parameters of `module` are not counted.
+    """
+    def __init__(self, module: nn.Module = None):
+        self.exclude = set() if module is None else {p.untyped_storage().data_ptr() for p in module.parameters()}
+        self.storages = dict()
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda x: x)
+
+    def pack(self, x: torch.Tensor):
+        ptr = x.untyped_storage().data_ptr()
+        if ptr not in self.exclude:
+            self.storages[ptr] = x.untyped_storage().nbytes()
+        return x
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+    def __enter__(self):
+        self.storages = dict()
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
@@ -0,0 +1,358 @@
+import os
+import copy
+import time
+import yaml
+
+import logging
+import os.path as osp
+import argparse as argparse
+
+import torch
+import torch.nn as nn
+
+from cprnn.utils import load_object, get_yaml_dict
+from cprnn.decomposition import cp_als
+from cprnn.models.quantization import quantize_model, model_nbytes
+from cprnn.features.ptb_dataloader import PTBDataloader
+from cprnn.features.tokenizer import CharacterTokenizer
+from evaluate import load_weights
+from train import _models, train_epoch, evaluate
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s', datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def load_run(path: str, device: torch.device):
+    """Loads the configs, best model (in eval mode) and tokenizer of a training run"""
+    args = get_yaml_dict(osp.join(path, 'configs.yaml'))
+    tokenizer = CharacterTokenizer(
+        tokens=load_object(osp.join(args['data']['path'], 'tokenizer-{}.pkl'.format(args['data']['tokenizer'])))
+    )
+    model = _models[args["model"]["name"].lower()](vocab_size=tokenizer.vocab_size, **args["model"])
+    dct = torch.load(osp.join(path, 'model_best.pth'), map_location=torch.device('cpu'))
+    load_weights(model, dct)
+    return args, model.to(device).eval(), dct, tokenizer
+
+
+def get_dataloaders(args: dict):
+    return {
+        split: PTBDataloader(
+            osp.join(args["data"]["path"], '{}-{}.pth'.format(split, args['data']['tokenizer'])),
+            batch_size=args["train"]["batch_size"], seq_len=args["train"]["seq_len"]
+        ) for split in ['train', 'valid', 'test']
+    }
+
+
+def measure_latency(model: nn.Module, vocab_size: int, device: torch.device, n_tokens: int = 200):
+    """Per-token generation latency in milliseconds (batch of one, one token at a time through `step`)"""
+    model.eval()
+    token_ids = torch.randint(0, vocab_size, (1,)).to(device)
+    state = None
+    with torch.no_grad():
+        for _ in range(10):  # Warm up
+            _, state = model.step(token_ids, state)
+        start = time.perf_counter()
+        for _ in range(n_tokens):
+            _, state = model.step(token_ids, state)
+    return (time.perf_counter() - start) / n_tokens * 1e3
+
+
+def measure_throughput(model: nn.Module, vocab_size: int, device: torch.device, batch_size: int = 128,
+                       seq_len: int = 50, iters: int = 3):
+    """Tokens per second of forward passes over a batch of sequences, without gradients"""
+    model.eval()
+    inp = torch.randint(0, vocab_size, (batch_size, seq_len)).to(device)
+    with torch.no_grad():
+        model(inp)  # Warm up
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(inp)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return iters * batch_size * seq_len / (time.perf_counter() - start)
+
+
+def finetune(model: nn.Module, args: dict, dataloaders: dict, epochs: int, device: torch.device):
+    optimizer = torch.optim.Adam(model.parameters(), lr=args["train"]["lr"])
+    criterion = nn.CrossEntropyLoss()
+    for i_epoch in range(1, epochs + 1):
+        train_metrics = train_epoch(
+            model, dataloaders['train'], optimizer, criterion, clip=args["train"]["grad_clip"], device=device,
+            stateful=args["train"].get("stateful", False), precision=args["train"].get("precision", "fp32"),
+            fused_loss=args["train"].get("fused_loss", False) or args["model"].get("decoder") == "adaptive"
+        )
+        logger.info("  Fine-tune epoch {}/{} | train bpc {:5.3f}".format(i_epoch, epochs, train_metrics['bpc']))
+    return optimizer
+
+
+def evaluate_splits(model: nn.Module, args: dict, dataloaders: dict, device: torch.device):
+    """Valid and test metrics of `model` in eval mode (`train.evaluate` leaves the mode as it is, and fine-tuning
+    leaves the model in train mode), so that every model of a table is scored without dropout"""
+    model.eval()
+    criterion = nn.CrossEntropyLoss()
+    return {
+        split: evaluate(model, dataloaders[split], criterion, device=device,
+                        stateful=args["train"].get("stateful", False))
+        for split in ['valid', 'test']
+    }
+
+
+def save_run(path: str, model: nn.Module, args: dict, dct: dict, metrics: dict, epochs: int = 0, optimizer=None):
+    """Writes a run folder that `evaluate.py` (and `compress.py`) can load"""
+    os.makedirs(path, exist_ok=True)
+    with open(osp.join(path, 'configs.yaml'), 'w') as outfile:
+        yaml.dump(args, outfile)
+
+    torch.save({
+        'epoch': dct['epoch'] + epochs,
+        'optimizer_state_dict': None if optimizer is None else optimizer.state_dict(),
+        'model_state_dict': model.state_dict(),
+        'torchrandom_state': torch.get_rng_state(),
+        'train_metrics': metrics['valid'],
+        'valid_metrics': metrics['valid'],
+        'test_metrics': metrics['test'],
+        'num_params': sum(p.numel() for p in model.parameters()),
+        'config': args
+    }, osp.join(path, "model_best.pth"))
+
+
+def write_table(rows: list, columns: list, path: str):
+    """Logs `rows` (list of dicts) as a table and writes it to `path`"""
+    header = " | ".join(["{:>12}".format(c) for c in columns])
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(" | ".join([
+            "{:>12.4f}".format(row[c]) if isinstance(row[c], float) else "{:>12}".format(row[c]) for c in columns
+        ]))
+    logger.info("\n" + "\n".join(lines))
+    with open(path, 'w') as outfile:
+        outfile.write("\n".join(lines) + "\n")
+
+
+def truncate(cli):
+    """Truncates a trained CPRNN/MRNN to smaller CP ranks, keeping the most important components"""
+    device = torch.device(cli.device)
+    args, model, dct, tokenizer = load_run(cli.path, device)
+    if args["model"]["name"].lower() not in ['cprnn', 'mrnn']:
+        raise ValueError("Rank truncation expects a `cprnn` or `mrnn` run, got `{}`".format(args["model"]["name"]))
+
+    dataloaders = get_dataloaders(args)
+    rows = list()
+    for rank in [model.rank, *cli.ranks]:
+        logger.info("Rank {}".format(rank))
+        model_r = copy.deepcopy(model).truncate_rank(rank)
+        args_r = copy.deepcopy(args)
+        args_r['model']['rank'] = rank
+
+        optimizer = None
+        if rank != model.rank and cli.epochs > 0:
+            optimizer = finetune(model_r, args_r, dataloaders, cli.epochs, device)
+
+        metrics = evaluate_splits(model_r, args_r, dataloaders, device)
+        if rank != model.rank:
+            save_run(osp.join(cli.path, 'truncated', 'r{}'.format(rank)), model_r, args_r, dct, metrics,
+                     epochs=cli.epochs, optimizer=optimizer)
+
+        rows.append({
+            "rank": rank,
+            "params": sum(p.numel() for p in model_r.parameters()),
+            "valid bpc": metrics['valid']['bpc'],
+            "test bpc": metrics['test']['bpc'],
+            "ms/token": measure_latency(model_r, tokenizer.vocab_size, device)
+        })
+
+    os.makedirs(osp.join(cli.path, 'truncated'), exist_ok=True)
+    write_table(rows, ["rank", "params", "valid bpc", "test bpc", "ms/token"],
+                osp.join(cli.path, 'truncated', 'results.txt'))
+
+
+def decompose(cli):
+    """Decomposes the core of a trained SecondOrderRNN into CPRNN checkpoints with CP-ALS"""
+    device = torch.device(cli.device)
+    args, model, dct, tokenizer = load_run(cli.path, device)
+    if args["model"]["name"].lower() != '2rnn':
+        raise ValueError("Decomposition expects a `2rnn` run, got `{}`".format(args["model"]["name"]))
+
+    dataloaders = get_dataloaders(args)
+    metrics_2rnn = evaluate_splits(model, args, dataloaders, device)
+    rows = [{
+        "model": "2rnn", "rank": "-", "params": sum(p.numel() for p in model.parameters()), "rel. error": 0.0,
+        "test bpc": metrics_2rnn['test']['bpc'], "tuned bpc": metrics_2rnn['test']['bpc'],
+        "ms/token": measure_latency(model, tokenizer.vocab_size, device)
+    }]
+
+    for rank in cli.ranks:
+        logger.info("Rank {}".format(rank))
+        (a, b, c), error = cp_als(model.w.detach().double(), rank, n_iter=cli.iters, verbose=True)
+
+        args_r = copy.deepcopy(args)
+        args_r['model']['name'], args_r['model']['rank'] = 'cprnn', rank
+        model_r = _models['cprnn'](vocab_size=tokenizer.vocab_size, **args_r['model']).to(device).eval()
+
+        # The CPRNN factors share the bias-augmented layout of the 2RNN core: w[i, j, k] = sum_r a[i, r] b[j, r] c[k, r]
+        state_dict = {k: v for k, v in model.state_dict().items() if k != 'w'}
+        state_dict.update({'a': a.float(), 'b': b.float(), 'c': c.float()})
+        model_r.load_state_dict(state_dict)
+
+        metrics = evaluate_splits(model_r, args_r, dataloaders, device)
+        metrics_tuned, optimizer = metrics, None
+        if cli.epochs > 0:
+            optimizer = finetune(model_r, args_r, dataloaders, cli.epochs, device)
+            metrics_tuned = evaluate_splits(model_r, args_r, dataloaders, device)
+
+        save_run(osp.join(cli.path, 'decomposed', 'r{}'.format(rank)), model_r, args_r, dct, metrics_tuned,
+                 epochs=cli.epochs, optimizer=optimizer)
+        rows.append({
+            "model": "cprnn", "rank": rank, "params": sum(p.numel() for p in model_r.parameters()),
+            "rel. error": error, "test bpc": metrics['test']['bpc'], "tuned bpc": metrics_tuned['test']['bpc'],
+            "ms/token": measure_latency(model_r, tokenizer.vocab_size, device)
+        })
+
+    write_table(rows, ["model", "rank", "params", "rel. error", "test bpc", "tuned bpc", "ms/token"],
+                osp.join(cli.path, 'decomposed', 'results.txt'))
+
+
+def prune(cli):
+    """Prunes the core of a trained SecondOrderRNN to block-sparse cores, keeping the blocks with the largest norms"""
+    device = torch.device(cli.device)
+    args, model, dct, tokenizer = load_run(cli.path, device)
+    if args["model"]["name"].lower() != '2rnn':
+        raise ValueError("Pruning expects a `2rnn` run, got `{}`".format(args["model"]["name"]))
+
+    dataloaders = get_dataloaders(args)
+    metrics_dense = evaluate_splits(model, args, dataloaders, device)
+    latency_dense = measure_latency(model, tokenizer.vocab_size, device)
+    throughput_dense = measure_throughput(model, tokenizer.vocab_size, device, batch_size=args["train"]["batch_size"])
+    rows = [{
+        "density": 1.0, "params": sum(p.numel() for p in model.parameters()),
+        "test bpc": metrics_dense['test']['bpc'], "tuned bpc": metrics_dense['test']['bpc'],
+        "ms/token": latency_dense, "speedup": 1.0, "tokens/s": throughput_dense, "batch speedup": 1.0
+    }]
+
+    for density in cli.densities:
+        logger.info("Density {}".format(density))
+        args_d = copy.deepcopy(args)
+        args_d['model'].update({'name': '2rnn_bs', 'block_size': cli.block_size, 'density': density})
+        model_d = _models['2rnn_bs'](vocab_size=tokenizer.vocab_size, **args_d['model']).to(device)
+
+        # Embedding and decoder are copied as they are, the core keeps its largest blocks
+        model_d.load_state_dict({
+            **model_d.state_dict(), **{k: v for k, v in model.state_dict().items() if k != 'w'}
+        })
+        model_d.prune_(model.w.detach())
+
+        metrics = evaluate_splits(model_d, args_d, dataloaders, device)
+        metrics_tuned, optimizer = metrics, None
+        if cli.epochs > 0:
+            # Only the kept blocks are parameters, so fine-tuning keeps the sparsity pattern
+            optimizer = finetune(model_d, args_d, dataloaders, cli.epochs, device)
+            metrics_tuned = evaluate_splits(model_d, args_d, dataloaders, device)
+
+        save_run(osp.join(cli.path, 'pruned', 'd{}'.format(density)), model_d, args_d, dct, metrics_tuned,
+                 epochs=cli.epochs, optimizer=optimizer)
+
+        latency = measure_latency(model_d, tokenizer.vocab_size, device)
+        throughput = measure_throughput(model_d, tokenizer.vocab_size, device, batch_size=args["train"]["batch_size"])
+        rows.append({
+            "density": density, "params": sum(p.numel() for p in model_d.parameters()),
+            "test bpc": metrics['test']['bpc'], "tuned bpc": metrics_tuned['test']['bpc'],
+            "ms/token": latency, "speedup": latency_dense / latency, "tokens/s": throughput,
+            "batch speedup": throughput / throughput_dense
+        })
+
+    write_table(rows, ["density", "params", "test bpc", "tuned bpc", "ms/token", "speedup", "tokens/s",
+                       "batch speedup"], osp.join(cli.path, 'pruned', 'results.txt'))
+
+
+def load_quantized(path: str, dtype: str):
+    """Loads a quantized model written by `compress.py quantize` for CPU inference"""
+    args, model, dct, tokenizer = load_run(path, torch.device('cpu'))
+    model = quantize_model(model, dtype)
+    model.load_state_dict(torch.load(osp.join(path, 'quantized', 'model-{}.pth'.format(dtype)), map_location='cpu'))
+    return args, model, tokenizer
+
+
+def quantize(cli):
+    """Quantizes a trained run to int8/fp16 weights and compares it with fp32 on CPU"""
+    device = torch.device('cpu')  # Quantized kernels are CPU-only
+    args, model, dct, tokenizer = load_run(cli.path, device)
+    dataloaders = get_dataloaders(args)
+    os.makedirs(osp.join(cli.path, 'quantized'), exist_ok=True)
+
+    metrics_fp32 = evaluate_splits(model, args, dataloaders, device)
+    latency_fp32 = measure_latency(model, tokenizer.vocab_size, device)
+    rows = [{
+        "dtype": "fp32", "MB": model_nbytes(model) / 2 ** 20, "valid bpc": metrics_fp32['valid']['bpc'],
+        "test bpc": metrics_fp32['test']['bpc'], "delta bpc": 0.0, "ms/token": latency_fp32, "speedup": 1.0
+    }]
+
+    for dtype in cli.dtypes:
+        logger.info("Quantizing to {}".format(dtype))
+        model_q = quantize_model(model, dtype)
+        torch.save(model_q.state_dict(), osp.join(cli.path, 'quantized', 'model-{}.pth'.format(dtype)))
+
+        metrics = evaluate_splits(model_q, args, dataloaders, device)
+        latency = measure_latency(model_q, tokenizer.vocab_size, device)
+        rows.append({
+            "dtype": dtype, "MB": model_nbytes(model_q) / 2 ** 20, "valid bpc": metrics['valid']['bpc'],
+            "test bpc": metrics['test']['bpc'], "delta bpc": metrics['test']['bpc'] - metrics_fp32['test']['bpc'],
+            "ms/token": latency, "speedup": latency_fp32 / latency
+        })
+
+    write_table(rows, ["dtype", "MB", "valid bpc", "test bpc", "delta bpc", "ms/token", "speedup"],
+                osp.join(cli.path, 'quantized', 'results.txt'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compress trained models into smaller deployable checkpoints')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_truncate = subparsers.add_parser('truncate', help='Truncate a CPRNN/MRNN run to smaller CP ranks')
+    parser_truncate.add_argument('-p', '--path', type=str, required=True, help='Run folder with `model_best.pth`')
+    parser_truncate.add_argument('-r', '--ranks', type=int, nargs='+', required=True)
+    parser_truncate.add_argument('-e', '--epochs', type=int, default=0, help='Fine-tuning epochs per rank')
+    parser_truncate.set_defaults(func=truncate)
+
+    parser_decompose = subparsers.add_parser('decompose', help='Decompose a 2RNN run into CPRNN checkpoints')
+    parser_decompose.add_argument('-p', '--path', type=str, required=True, help='Run folder with `model_best.pth`')
+    parser_decompose.add_argument('-r', '--ranks', type=int, nargs='+', required=True)
+    parser_decompose.add_argument('-i', '--iters', type=int, default=100, help='Maximum number of CP-ALS sweeps')
+    parser_decompose.add_argument('-e', '--epochs', type=int, default=0, help='Fine-tuning epochs per rank')
+    parser_decompose.set_defaults(func=decompose)
+
+    parser_prune = subparsers.add_parser('prune', help='Prune a 2RNN run to block-sparse cores')
+    parser_prune.add_argument('-p', '--path', type=str, required=True, help='Run folder with `model_best.pth`')
+    parser_prune.add_argument('-d', '--densities', type=float, nargs='+', required=True,
+                              help='Fractions of core blocks kept')
+    parser_prune.add_argument('-b', '--block_size', type=int, default=64)
+    parser_prune.add_argument('-e', '--epochs', type=int, default=0, help='Fine-tuning epochs per density')
+    parser_prune.set_defaults(func=prune)
+
+    parser_quantize = subparsers.add_parser('quantize', help='Quantize a run for CPU inference')
+    parser_quantize.add_argument('-p', '--path', type=str, required=True, help='Run folder with `model_best.pth`')
+    parser_quantize.add_argument('-d', '--dtypes', type=str, nargs='+', default=['int8', 'fp16'],
+                                 choices=['int8', 'fp16'])
+    parser_quantize.set_defaults(func=quantize)
+
+    cli = parser.parse_args()
+    cli.func(cli)
+
+    """
+    Commands
+
+    // Rank-64/32/16 models from a rank-512 CPRNN run, each fine-tuned for 2 epochs
+    python compress.py truncate -p runs/ptb/<experiment> -r 64 32 16 -e 2
+
+    // Rank-256/64 CPRNNs from a 2RNN run, before and after 1 epoch of fine-tuning
+    python compress.py decompose -p runs/ptb/<experiment> -r 256 64 -e 1
+
+    // Block-sparse 2RNNs keeping 50/25/10% of the 64x64 core blocks of a 2RNN run, each fine-tuned for 1 epoch
+    python compress.py prune -p runs/ptb/<experiment> -d 0.5 0.25 0.1 -b 64 -e 1
+
+    // int8 and fp16 weights, BPC and CPU latency against fp32
+    python compress.py quantize -p runs/ptb/<experiment> -d int8 fp16
+
+    """
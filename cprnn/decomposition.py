@@ -0,0 +1,87 @@
+import torch
+
+
+def mttkrp(tensor: torch.Tensor, factors: list, mode: int):
+    """Matricized tensor times Khatri-Rao product of a third-order tensor, for factor `mode`
+
+    The contraction always starts with one matmul over the last mode, so the largest intermediate is
+    `[I, J, R]` or `[R, J, K]` rather than the `[I*J*K, R]`-sized Khatri-Rao product.
+
+    Args:
+        tensor: [I, J, K]
+        factors: [A, B, C] with shapes [I, R], [J, R], [K, R]
+        mode: Factor to leave out of the product
+
+    Returns:
+        [I, R], [J, R] or [K, R]
+    """
+    a, b, c = factors
+    dim_i, dim_j, dim_k = tensor.shape
+
+    if mode == 0:
+        return ((tensor.reshape(dim_i * dim_j, dim_k) @ c).view(dim_i, dim_j, -1) * b.unsqueeze(0)).sum(dim=1)
+    elif mode == 1:
+        return ((tensor.reshape(dim_i * dim_j, dim_k) @ c).view(dim_i, dim_j, -1) * a.unsqueeze(1)).sum(dim=0)
+    elif mode == 2:
+        return ((a.t() @ tensor.reshape(dim_i, dim_j * dim_k)).view(-1, dim_j, dim_k) * b.t().unsqueeze(-1)).sum(
+            dim=1
+        ).t()
+    raise ValueError("Expected mode 0, 1 or 2 but got {}".format(mode))
+
+
+def cp_relative_error(tensor: torch.Tensor, factors: list):
+    """Relative reconstruction error `||T - [[A, B, C]]|| / ||T||`, without forming the reconstruction"""
+    a, b, c = factors
+    norm_tensor = tensor.pow(2).sum()
+    norm_cp = ((a.t() @ a) * (b.t() @ b) * (c.t() @ c)).sum()
+    inner = (mttkrp(tensor, factors, 2) * c).sum()
+    return ((norm_tensor - 2 * inner + norm_cp).clamp(min=0).sqrt() / norm_tensor.sqrt()).item()
+
+
+def cp_als(tensor: torch.Tensor, rank: int, n_iter: int = 100, tol: float = 1e-6, reg: float = 1e-8,
+           verbose: bool = False):
+    """CP decomposition of a third-order tensor by alternating least squares
+
+    Args:
+        tensor: [I, J, K]
+        rank: Number of CP components
+        n_iter: Maximum number of ALS sweeps
+        tol: Stops when the relative error improves by less than `tol`
+        reg: Ridge term added to the normal equations for stability
+        verbose: Print the error of every sweep
+
+    Returns:
+        factors: [A, B, C] with shapes [I, R], [J, R], [K, R]. Component weights are spread evenly over the three
+            factors so that their columns have equal norms.
+        error: Relative reconstruction error
+    """
+    tensor = tensor.detach()
+    factors = [torch.randn(dim, rank, dtype=tensor.dtype, device=tensor.device) for dim in tensor.shape]
+    eye = torch.eye(rank, dtype=tensor.dtype, device=tensor.device)
+    weights = torch.ones(rank, dtype=tensor.dtype, device=tensor.device)
+    error = float('inf')
+
+    for i_iter in range(n_iter):
+        for mode in range(3):
+            others = [factors[m] for m in range(3) if m != mode]
+            gram = (others[0].t() @ others[0]) * (others[1].t() @ others[1])
+            rhs = mttkrp(tensor, factors, mode)
+            factor = torch.linalg.solve(gram + reg * eye, rhs.t()).t()
+
+            # Keep factor columns at unit norm, the scale is carried by `weights`
+            weights = factor.norm(dim=0).clamp(min=1e-12)
+            factors[mode] = factor / weights
+
+        factors[-1] = factors[-1] * weights
+        error_new = cp_relative_error(tensor, factors)
+        factors[-1] = factors[-1] / weights
+
+        if verbose:
+            print("CP-ALS sweep {:4d} | relative error {:.6f}".format(i_iter + 1, error_new))
+        if error - error_new < tol:
+            error = error_new
+            break
+        error = error_new
+
+    scale = weights.pow(1 / 3)
+    return [f * scale for f in factors], error
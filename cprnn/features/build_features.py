@@ -11,7 +11,7 @@ import torchtext
 
 from cprnn.features.tokenizer import CharacterTokenizer
 from cprnn.utils import save_object
-from cprnn.models import CPRNN, SecondOrderRNN, LSTMPT
+from cprnn.models import CPRNN, SecondOrderRNN, SecondOrderRNNKR, LSTMPT
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,7 +22,7 @@ data_path = {
     "processed": osp.join(ROOT_DIR, "data", "processed")
 }
 
-models = {"cprnn": CPRNN, "lstmpt": LSTMPT}
+models = {"cprnn": CPRNN, "lstmpt": LSTMPT, "2rnnkr": SecondOrderRNNKR}
 
 
 def torchtext_get_indices(dataset: torch.utils.data.Dataset):
@@ -83,22 +83,23 @@ def toy_make_dataset(input_size=32, hidden_size=32, vocab_size=16, rank=32, trai
 
     # torch.manual_seed(87139)
 
-    batch_size, sequence_length = 1, 1  # can't change these
-
     model = models[model.lower()](input_size=input_size, hidden_size=hidden_size, vocab_size=vocab_size, rank=rank)
 
     model.eval()
     tokenizer = CharacterTokenizer(tokens=[s for s in string.printable[:vocab_size]])
 
     for split, dataset_length in zip(['train', 'valid', 'test'], [train_length, valid_length, test_length]):
-        input_ids = torch.randint(1, vocab_size, (sequence_length, batch_size))
-        dataset_ids = list([input_ids.item()])
-
-        hidden_state_prev = None
-        for i in range(dataset_length):
-            output_ids, output_conf, hidden_state = model(input_ids, hidden_state_prev)  # [S, B, D_i]
-            dataset_ids.append(output_ids.item())
-            input_ids, hidden_state_prev = output_ids, hidden_state
+        input_ids = torch.randint(1, vocab_size, (1,))
+        dataset_ids = [input_ids]
+
+        # Greedy generation, one `step` per token
+        hidden_state = None
+        with torch.no_grad():
+            for i in range(dataset_length):
+                logits, hidden_state = model.step(input_ids, hidden_state)  # [B, V]
+                input_ids = torch.argmax(logits, dim=-1)
+                dataset_ids.append(input_ids)
+        dataset_ids = torch.cat(dataset_ids).tolist()
 
         # import pdb; pdb.set_trace()
         hst = torch.bincount(torch.tensor(dataset_ids, dtype=torch.int))
@@ -153,6 +154,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Build datasets for language modelling')
     parser.add_argument('-d', '--dataset', type=str, default='ptb', choices=make_dataset_functions.keys())
     parser.add_argument('-m', '--model', type=str, default='2rnnkr', choices=models.keys())
+    parser.add_argument('--input_size', type=int, default=32, help='Toy generator input size')
+    parser.add_argument('--hidden_size', type=int, default=32, help='Toy generator hidden size')
+    parser.add_argument('--vocab_size', type=int, default=16, help='Toy generator vocabulary size')
+    parser.add_argument('--train_length', type=int, default=1000, help='Toy train split length')
     args = parser.parse_args()
 
     make_dataset_functions[args.dataset](**vars(args))
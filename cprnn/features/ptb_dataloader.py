@@ -2,6 +2,11 @@ import torch
 
 
 class PTBDataloader:
+    """Streams a token vector as `batch_size` contiguous rows
+
+    Row `i` of consecutive batches continues the same stream, so hidden states can be carried across batches
+    (truncated BPTT).
+    """
     def __init__(self, dataset_path: str, batch_size: int = 32, seq_len: int = 32, batch_first: bool = True):
         self.batch_first = batch_first
         self.arr = torch.load(dataset_path)
@@ -1,5 +1,9 @@
 from .cp_rnn import CPRNN
 from .second_order_rnn import SecondOrderRNN
+from .second_order_rnn_kr import SecondOrderRNNKR
 from .lstmpt import LSTMPT
 from .mrnn import MRNN
 from .mirnn import MIRNN
+from .cp_lstm import CPLSTM
+from .second_order_rnn_tp import TensorParallelSecondOrderRNN
+from .second_order_rnn_bs import BlockSparseSecondOrderRNN
@@ -0,0 +1,164 @@
+"""Benchmark-driven choice of contraction plans, cached in a JSON file
+
+Models with `autotune=True` time their candidate plans on the first call with a given shape and dispatch to the
+fastest one. Plans are timed forward and backward when the model trains, forward only otherwise. Winners are keyed
+by operation, shape, compute dtype (the autocast dtype under autocast), pass, thread count and device, so the file
+can be shared across runs and machines with the same setup. Models resolve their plan once per batch size, dtype
+and pass, not at every call. To inspect a plan file:
+
+    python -m cprnn.models.autotune runs/plans.json
+"""
+import os
+import sys
+import json
+import time
+
+import torch
+
+_plan_path = os.path.join(os.path.expanduser('~'), '.cache', 'cprnn', 'plans.json')
+_plans = None
+
+
+def _add_bias(out: torch.Tensor, bias: torch.Tensor = None):
+    return out if bias is None else out + bias
+
+
+# Candidate plans of the CP contraction `(a', b', c, bias) -> sum_r a'[b, r] b'[b, r] c[h, r] + bias[b, h]` used by
+# CPRNN (no bias) and MRNN (bias `x beta`)
+cp_contractions = {
+    # Elementwise product, GEMM, then the bias in a separate kernel
+    "factored": lambda a_prime, b_prime, c, bias: _add_bias((a_prime * b_prime) @ c.t(), bias),
+    # The bias is added in the epilogue of the GEMM, without a separate kernel and [B, D_h] temporary (MRNN only)
+    "addmm": lambda a_prime, b_prime, c, bias: torch.addmm(bias, a_prime * b_prime, c.t()),
+    # GEMM with the operands swapped, [D_h, R][R, B], whose result is used transposed (column-major [B, D_h])
+    "transposed": lambda a_prime, b_prime, c, bias: _add_bias(torch.mm(c, (a_prime * b_prime).t()).t(), bias),
+}
+
+# Candidate plans of the gate contraction of CPLSTM, `(a' * b' [B, G * R], c [G, D_h, R], bias [G, D_h]) -> [G, B, D_h]`
+lstm_contractions = {
+    "bmm": lambda ab, c, bias: torch.baddbmm(
+        bias.unsqueeze(1), ab.view(ab.size(0), c.size(0), c.size(2)).transpose(0, 1), c.transpose(1, 2)
+    ),
+    "matmul": lambda ab, c, bias: torch.matmul(
+        ab.view(ab.size(0), c.size(0), c.size(2)).transpose(0, 1), c.transpose(1, 2)
+    ) + bias.unsqueeze(1),
+    "einsum": lambda ab, c, bias: torch.einsum(
+        "bgr,ghr->gbh", ab.view(ab.size(0), c.size(0), c.size(2)), c
+    ) + bias.unsqueeze(1),
+}
+
+
+def cp_plans(bias: bool):
+    """Names of the CP contraction plans that apply with or without a bias"""
+    return [name for name in cp_contractions if bias or name != "addmm"]
+
+
+def set_plan_path(path: str):
+    """Reads and writes plans from `path` from now on"""
+    global _plan_path, _plans
+    _plan_path, _plans = path, None
+
+
+def load_plans(path: str = None):
+    """Plans cached in `path` (the current plan file by default), as `{key: {"plan": ..., "timings": ...}}`"""
+    global _plans
+    if path is not None and path != _plan_path:
+        with open(path) as infile:
+            return json.load(infile)
+
+    if _plans is None:
+        _plans = dict()
+        if os.path.exists(_plan_path):
+            with open(_plan_path) as infile:
+                _plans = json.load(infile)
+    return _plans
+
+
+def _save_plans():
+    os.makedirs(os.path.dirname(os.path.abspath(_plan_path)), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(_plan_path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        json.dump(_plans, outfile, indent=2, sort_keys=True)
+    os.replace(tmp_path, _plan_path)  # Concurrent runs never see a partially written file
+
+
+def compute_dtype(device: torch.device, dtype: torch.dtype):
+    """Dtype the matmuls of inputs of type `dtype` run in on `device`, i.e. the autocast dtype under autocast"""
+    device_type = torch.device(device).type
+    if hasattr(torch, 'get_autocast_dtype'):  # torch >= 2.4
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+    elif device_type == 'cuda' and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    elif device_type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return dtype
+
+
+def plan_key(op: str, shape: dict, device: torch.device, dtype: torch.dtype = torch.float32, backward: bool = False):
+    return "{}|{}|{}|{}|threads{}|{}".format(
+        op, "_".join("{}{}".format(k, v) for k, v in shape.items()), str(dtype).replace('torch.', ''),
+        "fwd+bwd" if backward else "fwd", torch.get_num_threads(), torch.device(device).type
+    )
+
+
+def _time(fn, device: torch.device, iters: int, warmup: int = 1):
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    for _ in range(warmup):
+        fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    sync()
+    return (time.perf_counter() - start) / iters
+
+
+def autotune(op: str, candidates: dict, shape: dict, device: torch.device, dtype: torch.dtype = torch.float32,
+             grad_inputs: tuple = None, iters: int = 5):
+    """Name of the fastest plan for `op` at `shape`, benchmarked on first use and cached in the plan file
+
+    Args:
+        op: Name of the operation, e.g. `cprnn`
+        candidates: Plan name -> zero-argument callable running the plan on representative inputs
+        shape: Sizes that the best plan depends on, e.g. `{"B": 128, "H": 2048, "R": 64}`
+        device: Device the plans run on
+        dtype: Dtype of the inputs, the autocast dtype is used under autocast (see `compute_dtype`)
+        grad_inputs: Tensors the plans are differentiated with respect to. If given, plans are timed forward and
+            backward (`torch.autograd.grad`, which leaves the `.grad` of parameters untouched), else forward only
+        iters: Timed calls per plan
+
+    Returns:
+        Name of the fastest plan
+    """
+    device = torch.device(device)
+    plans = load_plans()
+    key = plan_key(op, shape, device, compute_dtype(device, dtype), backward=grad_inputs is not None)
+    if key in plans and plans[key]["plan"] in candidates:
+        return plans[key]["plan"]
+
+    if grad_inputs is None:
+        with torch.no_grad():
+            timings = {name: _time(fn, device, iters) for name, fn in candidates.items()}
+    else:
+        def forward_backward(fn):
+            out = fn()
+            torch.autograd.grad(out, grad_inputs, torch.ones_like(out), allow_unused=True)
+
+        with torch.enable_grad():
+            timings = {
+                name: _time(lambda fn=fn: forward_backward(fn), device, iters) for name, fn in candidates.items()
+            }
+    plans[key] = {"plan": min(timings, key=timings.get), "timings": timings}
+    _save_plans()
+    return plans[key]["plan"]
+
+
+if __name__ == '__main__':
+    for key, entry in sorted(load_plans(sys.argv[1] if len(sys.argv) > 1 else None).items()):
+        print("{:<60} {:>14} | {}".format(key, entry["plan"], " ".join(
+            "{}={:.2e}s".format(name, t) for name, t in sorted(entry["timings"].items(), key=lambda x: x[1])
+        )))
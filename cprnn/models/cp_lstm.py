@@ -1,90 +1,299 @@
 import math
+from typing import Union
+
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from cprnn.features.tokenizer import CharacterTokenizer
+from cprnn.models.autotune import autotune, lstm_contractions, compute_dtype
+from cprnn.models.decoders import build_decoder, decoder_topk, decoder_next
+from cprnn.models.losses import decoder_cross_entropy
+from cprnn.models.quantization import dequantized
+from cprnn.models.recurrence import Recurrence
+
+_N_GATES = 4  # Forget, input and output gates (sigmoid), then cell candidate (tanh)
 
 
 class CPLSTM(nn.Module):
     """CP-Factorized LSTM. Outputs logits (no softmax)
 
+    The pre-activations of the four gates are CP contractions of the bias-augmented hidden state and input, with
+    one rank `rank` decomposition per gate. All gates are computed at once: `h_t` is projected on the hidden factors
+    of every gate with a single matmul, the input factors of the whole sequence are computed before the time loop,
+    and one batched contraction with the output factors gives the `[4, B, D_h]` pre-activations. The three sigmoid
+    gates are stored first so that a single sigmoid covers them.
+
+    The recurrent state `(h_t, c_t)` is carried as one `[B, 2 * D_h]` tensor in the time loop, so the model runs
+    through `Recurrence` (compile, checkpointing and in-place inference) like the other CP models.
+
     Args:
         input_size: Dimension of input features.
         hidden_size: Dimension of hidden features.
-        rank: Rank of cp factorization
+        vocab_size: Size of vocabulary
+        use_embedding: Whether to use embedding layer or one-hot encoding
+        rank: Rank of the cp factorization of each gate
+        tokenizer: Character tokenizer
+        batch_first: Whether to use batch first or not
+        dropout: Dropout rate
+        compile: Whether to run the time loop through torch.compile
+        unroll: Number of timesteps per compiled graph
+        checkpoint_segments: Number of time segments wrapped in activation checkpointing (0 disables it)
+        contraction: Plan of the gate contraction in the time loop (see `autotune.lstm_contractions`)
+        autotune: Whether to benchmark the contraction plans on first use of each batch size and use the fastest
+        decoder: Output layer, `linear` or `adaptive` (adaptive softmax, for large word-level vocabularies)
+        unigram_counts: Token counts of the training data, sizes the adaptive softmax clusters
+
     """
-    def __init__(self, input_size: int, hidden_size: int, vocab_size: int, rank: int = 8,
-                 embedding: nn.Embedding = None, decoder: nn.Module = None):
+    def __init__(self, input_size: int, hidden_size: int, vocab_size: int, use_embedding: bool = False, rank: int = 8,
+                 tokenizer: CharacterTokenizer = None, batch_first: bool = True, dropout: float = 0.5,
+                 compile: bool = False, unroll: int = 8, checkpoint_segments: int = 0, contraction: str = 'bmm',
+                 autotune: bool = False, decoder: str = 'linear', unigram_counts: torch.Tensor = None, **kwargs):
         super().__init__()
+
+        if contraction not in lstm_contractions:
+            raise ValueError("Unknown contraction `{}`. Expected one of {}".format(
+                contraction, list(lstm_contractions.keys())
+            ))
+
+        for option in ('scan', 'recompute'):
+            if kwargs.get(option):
+                raise ValueError("Option `{}` is not supported by CPLSTM".format(option))
+
+        self.use_embedding = use_embedding
+        self.dropout = dropout
+        self.batch_first = batch_first
+        self.tokenizer = tokenizer
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.vocab_size = vocab_size
         self.rank = rank
+        self.contraction = contraction
+        self.autotune = autotune
+        self._tuned_plans = dict()  # (batch size, compute dtype, backward) -> contraction, see `tune_contraction`
 
         # Define embedding and decoder layers
-        self.embedding = nn.Embedding(self.vocab_size, self.input_size) if embedding is None else embedding
-        self.decoder = nn.Linear(self.hidden_size, self.vocab_size) if decoder is None else decoder
-
-        # Encoder using CP factors
-        self.a = nn.Parameter(torch.Tensor(self.hidden_size, self.rank * 4))
-        self.b = nn.Parameter(torch.Tensor(self.input_size, self.rank * 4))
-        self.ct = nn.Parameter(torch.Tensor(self.rank * 4, self.hidden_size))
-        self.bias = nn.Parameter(torch.Tensor(self.hidden_size * 4))
+        if use_embedding:
+            self.embedding = nn.Embedding(self.vocab_size, self.input_size)
+
+        else:
+            # One hot version (inputs are gathered from the factor rows, see `encode`)
+            self.input_size = vocab_size
+
+        self.decoder = build_decoder(
+            decoder, self.hidden_size, self.vocab_size, self.dropout, unigram_counts=unigram_counts
+        )
+
+        # Encoder using CP factors. Columns of `a` and `b` are grouped by gate, [g_0 r_0 ... g_0 r_R, g_1 r_0, ...]
+        self.a = nn.Parameter(torch.Tensor(self.hidden_size + 1, _N_GATES * self.rank))
+        self.b = nn.Parameter(torch.Tensor(self.input_size + 1, _N_GATES * self.rank))
+        self.c = nn.Parameter(torch.Tensor(_N_GATES, self.hidden_size, self.rank))
+        self.bias = nn.Parameter(torch.Tensor(_N_GATES, self.hidden_size))
         self.init_weights()
 
+        self.recurrence = Recurrence(compile=compile, unroll=unroll, checkpoint_segments=checkpoint_segments)
+
     def init_weights(self):
         stdv = 1.0 / math.sqrt(self.hidden_size)
         for weight in self.parameters():
             weight.data.uniform_(-stdv, stdv)
 
-    def forward(self, inp, init_states=None):
-        """Assumes `inp` is of shape (seq, bsz) and contains word indices, out is of shape (seq, bsz, d_vocab)"""
+    def _step(self, s_t: torch.Tensor, b_prime_t: torch.Tensor):
+        h_t, c_t = s_t[:, :self.hidden_size], s_t[:, self.hidden_size:]
+
+        # [B, D_h][D_h, 4R] + [4R] => [B, 4R], then [B, 4R] x [4, D_h, R] => [4, B, D_h]
+        ab = torch.addmm(self.a[-1], h_t, self.a[:-1]) * b_prime_t
+        gates = lstm_contractions[self.contraction](ab, self.c, self.bias)
+
+        f_t, i_t, o_t = torch.sigmoid(gates[:3])
+        g_t = torch.tanh(gates[3])
+
+        c_t = torch.addcmul(f_t * c_t, i_t, g_t)
+        h_t = o_t * torch.tanh(c_t)
+        return torch.cat((h_t, c_t), dim=1)
+
+    def _step_into(self, out: torch.Tensor, s_t: torch.Tensor, b_prime_t: torch.Tensor, a: torch.Tensor,
+                   c: torch.Tensor, bias: torch.Tensor, ab: torch.Tensor, gates: torch.Tensor):
+        # Same as `_step`, written into `out` with `ab` [B, 4R] and `gates` [4, B, D_h] as scratch. `a`, `c` and
+        # `bias` are the weights, which quantized models dequantize once per call rather than at every step
+        h_t, c_t = s_t[:, :self.hidden_size], s_t[:, self.hidden_size:]
+        h_next, c_next = out[:, :self.hidden_size], out[:, self.hidden_size:]
+
+        torch.addmm(a[-1], h_t, a[:-1], out=ab).mul_(b_prime_t)
+        torch.baddbmm(
+            bias.unsqueeze(1), ab.view(-1, _N_GATES, self.rank).transpose(0, 1), c.transpose(1, 2), out=gates
+        )
+        gates[:3].sigmoid_()
+        gates[3].tanh_()
+
+        torch.mul(gates[0], c_t, out=c_next).addcmul_(gates[1], gates[3])
+        torch.tanh(c_next, out=h_next).mul_(gates[2])
+
+    def init_hidden(self, batch_size, device=torch.device('cpu')):
+        h, c = torch.zeros(batch_size, self.hidden_size).to(device), \
+               torch.zeros(batch_size, self.hidden_size).to(device)
+        return h, c
+
+    def predict(self, inp: Union[torch.LongTensor, str], init_states: tuple = None, top_k: int = 1,
+                device=torch.device('cpu')):
 
-        x = self.embedding(inp)  # [sequence, batch, input_size]
-        batch_size, sequence_length, _ = x.size()
-        hidden_seq = []
+        with torch.no_grad():
+
+            if isinstance(inp, str):
+                if self.tokenizer is None:
+                    raise ValueError("Tokenizer not defined. Please provide a tokenizer to the model.")
+                x = torch.tensor(self.tokenizer.char_to_ix(inp)).reshape(1, 1).to(device)
+            else:
+                x = inp.to(device)
+
+            hidden_seq, init_states = self.encode(x, init_states)
+            output_topk = decoder_topk(self.decoder, hidden_seq, top_k)  # [S, B, K]
+
+            prob = output_topk[0].reshape(-1) / output_topk[0].reshape(-1).sum()
+            k_star = np.random.choice(np.arange(top_k), p=prob.cpu().numpy())
+            output_ids = output_topk[1][:, :, k_star]
+
+            if isinstance(inp, str):
+                output_char = self.tokenizer.ix_to_char(output_ids.item())
+                return output_char, init_states
+            else:
+                return output_ids, init_states
+
+    def step(self, token_ids: torch.LongTensor, state: tuple = None, top_k: int = None):
+        """Single recurrent update for generation, without the sequence bookkeeping of `forward`
+
+        Args:
+            token_ids: Input ids. [B]
+            state: `(h, c)`, each [B, D_h] (zeros if None)
+            top_k: If set, the probabilities and ids of the `top_k` most likely tokens are returned instead of the
+                logits (`decoder_topk`)
+
+        Returns:
+            logits: [B, D_out], or `(probs, ids)`, each [B, top_k]
+            state: Next `(h, c)`
+        """
+        if state is None:
+            s_t = torch.zeros(token_ids.size(0), 2 * self.hidden_size).to(token_ids.device)
+        else:
+            s_t = torch.cat(state, dim=1)
+
+        if self.use_embedding:
+            b_prime = self.embedding(token_ids) @ self.b[:-1] + self.b[-1]
+        else:
+            b_prime = F.embedding(token_ids, self.b[:-1]) + self.b[-1]
+        s_t = self._step(s_t, b_prime)
+        h_t, c_t = s_t[:, :self.hidden_size], s_t[:, self.hidden_size:]
+        return decoder_next(self.decoder, h_t, top_k), (h_t, c_t)
+
+    def tune_contraction(self, h_t: torch.Tensor, b_prime_t: torch.Tensor):
+        """Fastest gate contraction plan for the batch size and compute dtype of `h_t`, resolved once per model with
+        `autotune` (timed forward and backward when the factors are trained)
+
+        Args:
+            h_t: Hidden state. [B, D_h]
+            b_prime_t: Input projection of the first step. [B, 4R]
+
+        Returns:
+            Name of the plan (see `autotune.lstm_contractions`)
+        """
+        backward = torch.is_grad_enabled() and self.c.requires_grad
+        key = (h_t.size(0), compute_dtype(h_t.device, h_t.dtype), backward)
+        if key not in self._tuned_plans:
+            # Detached copy, so that timing the backward leaves the graph of the batch alone
+            ab = (torch.addmm(self.a[-1], h_t, self.a[:-1]) * b_prime_t).detach().requires_grad_(backward)
+            candidates = {name: (lambda fn=fn: fn(ab, self.c, self.bias)) for name, fn in lstm_contractions.items()}
+            self._tuned_plans[key] = autotune(
+                "cplstm", candidates, shape={"B": h_t.size(0), "H": self.hidden_size, "R": self.rank},
+                device=h_t.device, dtype=h_t.dtype, grad_inputs=(ab, self.c, self.bias) if backward else None
+            )
+        return self._tuned_plans[key]
+
+    def encode(self, inp: torch.LongTensor, init_states: tuple = None):
+        """Runs the recurrence. Returns hidden states `[S, B, D_h]` (time first) and the last state `(h_t, c_t)`"""
+
+        if self.batch_first:
+            inp = inp.transpose(0, 1)
+
+        if len(inp.shape) != 2:
+            raise ValueError("Expected input tensor of order 2, but got order {} tensor instead".format(len(inp.shape)))
+
+        sequence_length, batch_size = inp.size()
+        device = inp.device
 
         if init_states is None:
-            h_t, c_t = (torch.zeros(batch_size, self.hidden_size).to(x.device),
-                        torch.zeros(batch_size, self.hidden_size).to(x.device))
+            s_t = torch.zeros(batch_size, 2 * self.hidden_size).to(device)
+
         else:
             h_t, c_t = init_states
+            s_t = torch.cat((h_t, c_t), dim=1).to(device)
+
+        # Input projection of all gates does not depend on h_t, so it is done for the whole sequence at once
+        # [S, B, D_i'][D_i', 4R] => [S, B, 4R]
+        if self.use_embedding:
+            x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
+            b_prime = x @ self.b[:-1] + self.b[-1]
+        else:
+            # one_hot(x) @ b is a row lookup; its backward only accumulates into the gathered rows
+            b_prime = F.embedding(inp, self.b[:-1]) + self.b[-1]
+
+        if self.recurrence.inplace_enabled():
+            # Inference writes into preallocated buffers, nothing is allocated per timestep
+            state_seq, s_t = self.recurrence.inplace(
+                self._step_into, s_t, b_prime, workspace=(
+                    dequantized(self.a), dequantized(self.c), dequantized(self.bias),
+                    s_t.new_empty(batch_size, _N_GATES * self.rank),
+                    s_t.new_empty(_N_GATES, batch_size, self.hidden_size)
+                )
+            )
+        else:
+            if self.autotune:
+                self.contraction = self.tune_contraction(s_t[:, :self.hidden_size], b_prime[0])
+            state_seq, s_t = self.recurrence(self._step, s_t, b_prime)  # [S, B, 2 * D_h]
 
-        for t in range(sequence_length):
-            x_t = x[t, :, :]
+        hidden_seq = state_seq[..., :self.hidden_size]
+        return hidden_seq, (s_t[:, :self.hidden_size], s_t[:, self.hidden_size:])
 
-            # CP contraction
-            gates = torch.multiply(h_t @ self.a, x_t @ self.b)  # [nxd][dx4r]
-            gates = torch.matmul(
-                # [n,4r] => [n,4,1,r]
-                gates.reshape(batch_size, 4, 1, self.rank),
+    def forward(self, inp: torch.LongTensor, init_states: tuple = None, targets: torch.LongTensor = None):
+        """Returns logits and the last state. With `targets`, returns the loss instead (see `forward_loss`)"""
+        if targets is not None:
+            return self.forward_loss(inp, targets, init_states)
 
-                # [4r,d] => [1,4,r,d]
-                self.ct.reshape(1, 4, self.rank, self.hidden_size)
-            ).squeeze()  # final dimension [n,4,d]
+        hidden_seq, states = self.encode(inp, init_states)
+        output = self.decoder(hidden_seq)
 
-            funcs = [torch.sigmoid, torch.sigmoid, torch.tanh, torch.sigmoid]
-            f_t, i_t, g_t, o_t = [funcs[k](gates[:, k, :]) for k in range(4)]
+        if self.batch_first:
+            output = output.transpose(0, 1)
 
-            c_t = f_t * c_t + i_t * g_t
-            h_t = o_t * torch.tanh(c_t)
-            hidden_seq.append(h_t.unsqueeze(0))
+        return output, states
 
-        hidden_seq = torch.cat(hidden_seq, dim=0)
+    def forward_loss(self, inp: torch.LongTensor, targets: torch.LongTensor, init_states: tuple = None):
+        """Mean cross-entropy of the predictions, computed over chunks of positions so that the `[B, S, D_out]`
+        logits are never materialized
 
-        # reshape from shape (sequence, batch, feature) to (batch, sequence, feature)
-        # output = self.decoder(hidden_seq.transpose(0, 1).contiguous())  # Don't really ne ed this line
+        Args:
+            inp: Input ids. [B, S] if batch_first else [S, B]
+            targets: Target ids, same shape as `inp`
+            init_states: Initial state `(h_t, c_t)`
 
-        output = self.decoder(hidden_seq.contiguous())
-        return output, (c_t, h_t)
+        Returns:
+            loss: Mean loss (scalar)
+            states: Last state `(h_t, c_t)`
+        """
+        hidden_seq, states = self.encode(inp, init_states)
+        if self.batch_first:
+            targets = targets.transpose(0, 1)
+        return decoder_cross_entropy(self.decoder, hidden_seq, targets), states
 
 
 if __name__ == '__main__':
 
-    input_size, hidden_size, cp_rank = 128, 128, 32
-    cplstm = CPLSTM(input_size, hidden_size, cp_rank)
+    vocab_size, hidden_size, cp_rank = 50, 128, 32
+    cplstm = CPLSTM(input_size=0, hidden_size=hidden_size, vocab_size=vocab_size, rank=cp_rank)
 
-    batch_size, sequence_length = 32, 32
-    x = torch.randn(batch_size, sequence_length, input_size)
-    out = cplstm(x)
+    batch_size, sequence_length = 32, 16
+    x = torch.randint(0, vocab_size, (batch_size, sequence_length))
+    out, (h_t, c_t) = cplstm(x)
 
     # output
-    # out[0].shape: torch.Size([32, 32, 128])
+    # out.shape: torch.Size([32, 16, 50])
@@ -0,0 +1,166 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def frequency_cutoffs(counts: torch.Tensor, coverage: tuple = (0.8, 0.95)):
+    """Adaptive softmax cutoffs from unigram counts sorted in decreasing order
+
+    Each cutoff is the smallest number of most frequent tokens that covers the corresponding fraction of the
+    corpus, so the head holds the tokens that make up `coverage[0]` of the data and each tail cluster the next slice.
+
+    Args:
+        counts: Unigram counts sorted in decreasing order. [V]
+        coverage: Increasing fractions of the corpus covered by the head and by each following cluster
+
+    Returns:
+        List of increasing cutoffs in `[1, V - 1]`
+    """
+    vocab_size = counts.size(0)
+    cumulative = counts.double().cumsum(dim=0) / counts.sum().clamp(min=1)
+    cutoffs = [int(torch.searchsorted(cumulative, c).item()) + 1 for c in coverage]
+    return sorted({min(max(c, 1), vocab_size - 1) for c in cutoffs})
+
+
+class AdaptiveDecoder(nn.Module):
+    """Adaptive softmax decoder (https://arxiv.org/abs/1609.04309)
+
+    Tokens are ranked by unigram frequency. The most frequent ones are scored by a head layer, which also scores one
+    entry per tail cluster, and the rest are scored within their cluster through a smaller projection. Training only
+    evaluates the clusters of the targets (`loss`) and `topk` only evaluates the clusters it needs, while `forward`
+    returns the exact log-probabilities of the whole vocabulary (usable as logits).
+
+    The cutoffs and the frequency order are saved with the weights, and loading a state dict rebuilds the layers
+    with the saved cutoffs. Models can therefore be built without `unigram_counts` before loading a checkpoint.
+
+    Args:
+        hidden_size: Dimension of hidden features
+        vocab_size: Size of vocabulary
+        dropout: Dropout rate
+        unigram_counts: Token counts of the training data, sizes the clusters. [V]
+        coverage: Fractions of the training data covered by the head and each cluster (see `frequency_cutoffs`)
+        div_value: Factor by which the projection size shrinks from one cluster to the next
+
+    """
+    def __init__(self, hidden_size: int, vocab_size: int, dropout: float = 0.0, unigram_counts: torch.Tensor = None,
+                 coverage: tuple = (0.8, 0.95), div_value: float = 4.0):
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.vocab_size = vocab_size
+        self.div_value = div_value
+        self.dropout = nn.Dropout(dropout)
+
+        counts = torch.ones(vocab_size) if unigram_counts is None else unigram_counts.float()
+        token_of_rank = counts.argsort(descending=True)
+        self.register_buffer('token_of_rank', token_of_rank)
+        self.register_buffer('rank_of_token', token_of_rank.argsort())
+        self.register_buffer('cutoffs', torch.tensor(frequency_cutoffs(counts[token_of_rank], coverage)))
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, vocab_size, self.cutoffs.tolist(), div_value=div_value)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        cutoffs = state_dict.get(prefix + 'cutoffs')
+        if cutoffs is not None and cutoffs.tolist() != self.cutoffs.tolist():
+            self.cutoffs = cutoffs.clone()
+            self.asm = nn.AdaptiveLogSoftmaxWithLoss(
+                self.hidden_size, self.vocab_size, cutoffs.tolist(), div_value=self.div_value
+            ).to(self.token_of_rank.device)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, hidden: torch.Tensor):
+        """Exact log-probabilities of every token. [*, D_h] => [*, V]"""
+        log_prob = self.asm.log_prob(self.dropout(hidden).reshape(-1, self.hidden_size))
+        return log_prob[:, self.rank_of_token].view(*hidden.shape[:-1], self.vocab_size)
+
+    def loss(self, hidden: torch.Tensor, targets: torch.LongTensor):
+        """Mean negative log-likelihood of `targets`. Only the clusters of the targets are evaluated.
+
+        Args:
+            hidden: [*, D_h]
+            targets: [*]
+
+        Returns:
+            Mean loss (scalar)
+        """
+        return self.asm(
+            self.dropout(hidden).reshape(-1, self.hidden_size), self.rank_of_token[targets.reshape(-1)]
+        ).loss
+
+    def topk(self, hidden: torch.Tensor, k: int):
+        """Most likely tokens, evaluating the tail clusters only for rows where they rank in the top `k` of the head
+
+        A token of a cluster is never more likely than its cluster, so clusters outside the head top `k` are skipped.
+        The result can differ from the exact top `k` when an expanded cluster contributes tokens less likely than a
+        skipped cluster, which only happens in the low-probability end of the list.
+
+        Args:
+            hidden: [*, D_h]
+            k: Number of tokens
+
+        Returns:
+            probs: [*, k]
+            ids: [*, k]
+        """
+        h = self.dropout(hidden).reshape(-1, self.hidden_size)
+        n_rows, shortlist_size = h.size(0), self.asm.shortlist_size
+
+        head_log_prob = F.log_softmax(self.asm.head(h), dim=-1)  # [N, shortlist + n_clusters]
+        top_head = head_log_prob.topk(min(k, head_log_prob.size(1)), dim=-1).indices
+
+        log_prob = head_log_prob.new_full((n_rows, self.vocab_size), -float('inf'))  # By frequency rank
+        log_prob[:, :shortlist_size] = head_log_prob[:, :shortlist_size]
+        for i, tail in enumerate(self.asm.tail):
+            start, stop = self.asm.cutoffs[i], self.asm.cutoffs[i + 1]
+            rows = (top_head == shortlist_size + i).any(dim=-1).nonzero().squeeze(-1)
+            if rows.numel() > 0:
+                log_prob[rows, start:stop] = F.log_softmax(tail(h[rows]), dim=-1) + \
+                    head_log_prob[rows, shortlist_size + i].unsqueeze(-1)
+
+        values, ranks = log_prob.topk(k, dim=-1)
+        return values.exp().view(*hidden.shape[:-1], k), self.token_of_rank[ranks].view(*hidden.shape[:-1], k)
+
+
+def build_decoder(decoder: str, hidden_size: int, vocab_size: int, dropout: float,
+                  unigram_counts: torch.Tensor = None):
+    """Output layer of the models
+
+    Args:
+        decoder: `linear` (dense softmax) or `adaptive` (adaptive softmax)
+        hidden_size: Dimension of hidden features
+        vocab_size: Size of vocabulary
+        dropout: Dropout rate
+        unigram_counts: Token counts of the training data, sizes the adaptive softmax clusters
+
+    """
+    if decoder == 'linear':
+        return nn.Sequential(
+            nn.Dropout(dropout),
+            nn.Linear(hidden_size, vocab_size)
+        )
+    elif decoder == 'adaptive':
+        return AdaptiveDecoder(hidden_size, vocab_size, dropout=dropout, unigram_counts=unigram_counts)
+    raise ValueError("Unknown decoder `{}`. Expected one of `linear`, `adaptive`".format(decoder))
+
+
+def decoder_topk(decoder: nn.Module, hidden_seq: torch.Tensor, k: int):
+    """Probabilities and ids of the `k` most likely tokens. [*, D_h] => [*, k], [*, k]"""
+    if isinstance(decoder, AdaptiveDecoder):
+        return decoder.topk(hidden_seq, k)
+    return torch.topk(torch.softmax(decoder_logits(decoder, hidden_seq), dim=-1), k, dim=-1)
+
+
+def decoder_logits(decoder: nn.Module, hidden: torch.Tensor):
+    """Logits of the next token (log-probabilities for the adaptive softmax). [*, D_h] => [*, V]
+
+    Outside training, the dropout of the linear decoder is an identity and is skipped along with the `nn.Sequential`.
+    """
+    if not decoder.training and isinstance(decoder, nn.Sequential) and isinstance(decoder[-1], nn.Linear):
+        return F.linear(hidden, decoder[-1].weight, decoder[-1].bias)
+    return decoder(hidden)
+
+
+def decoder_next(decoder: nn.Module, hidden: torch.Tensor, top_k: int = None):
+    """Output of `step`: the logits of the next token [*, V] (`decoder_logits`), or the probabilities and ids [*, k]
+    of the `top_k` most likely ones (`decoder_topk`, which skips the tail clusters of the adaptive softmax)"""
+    if top_k is None:
+        return decoder_logits(decoder, hidden)
+    return decoder_topk(decoder, hidden, top_k)
@@ -0,0 +1,105 @@
+"""Training of independent trials of a model together (`train.ensemble`)
+
+The parameters of the N trials are stacked along a new leading dimension (`torch.func.stack_module_state`), and
+every batch runs the forward and backward of all of them at once through `torch.func.vmap`. At small hidden sizes,
+the batched matmuls of N models keep the cores busy where one model cannot.
+
+Adam is elementwise, so a single Adam over the stacked parameters is N independent optimizers. Gradient clipping
+is done per trial (`clip_grad_norm_per_trial`). Dropout masks are drawn independently for every trial.
+`copy_trial` and `trial_optimizer_state_dict` write a trial back into a regular model and optimizer state, which
+is how trials are evaluated and checkpointed into their own folders.
+
+Only the plain time loop runs under vmap: `compile`, `checkpoint_segments`, `recompute`, `autotune`, `fused_loss`
+(and the adaptive softmax) and tensor parallelism are not supported.
+"""
+import copy
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import stack_module_state, functional_call, vmap
+
+
+class Ensemble:
+    """N models of the same architecture, run as one vectorized model
+
+    Args:
+        models: Trials, whose parameters are stacked. They are not modified
+
+    """
+    def __init__(self, models: List[nn.Module]):
+        self.n_trials = len(models)
+        self.params, self.buffers = stack_module_state(models)  # {name: [N, *shape]}
+        self.base = copy.deepcopy(models[0]).to('meta')  # Holds the architecture only
+        self.base.train()
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def __call__(self, inp: torch.LongTensor, init_states=None):
+        """Logits [N, B, S, D_out] (batch first) and last states [N, ...] of every trial on the same batch `inp`"""
+        def run(params, buffers, states):
+            return functional_call(self.base, (params, buffers), (inp, states))
+
+        in_dims = (0, 0, None if init_states is None else 0)
+        return vmap(run, in_dims=in_dims, randomness='different')(self.params, self.buffers, init_states)
+
+    def copy_trial(self, i: int, model: nn.Module):
+        """Copies the parameters and buffers of trial `i` into `model`"""
+        stacked = {**self.params, **self.buffers}
+        with torch.no_grad():
+            for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+                tensor.copy_(stacked[name][i])
+        return model
+
+
+def ensemble_cross_entropy(output: torch.Tensor, targets: torch.LongTensor):
+    """Mean cross-entropy of every trial. [N, B, S, D_out] and [B, S] => [N]"""
+    n_trials = output.size(0)
+    targets = targets.unsqueeze(0).expand(n_trials, *targets.shape)
+    loss = F.cross_entropy(output.reshape(-1, output.size(-1)).float(), targets.reshape(-1), reduction='none')
+    return loss.view(n_trials, -1).mean(dim=1)
+
+
+def clip_grad_norm_per_trial(parameters, max_norm: float):
+    """`nn.utils.clip_grad_norm_` of every trial of stacked parameters [N, ...]. Returns the total norms [N]"""
+    grads = [p.grad for p in parameters if p.grad is not None]
+    total_norm = torch.stack([g.detach().float().pow(2).flatten(1).sum(dim=1) for g in grads]).sum(dim=0).sqrt()
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for g in grads:
+        g.detach().mul_(clip_coef.view(-1, *[1] * (g.dim() - 1)).to(g.dtype))
+    return total_norm
+
+
+def trial_optimizer_state_dict(optimizer: torch.optim.Optimizer, i: int):
+    """State dict of the optimizer of trial `i`, as saved by an optimizer over the parameters of a single model"""
+    state_dict = optimizer.state_dict()
+    return {
+        'state': {
+            k: {name: v[i].clone() if torch.is_tensor(v) and v.dim() > 0 else v for name, v in state.items()}
+            for k, state in state_dict['state'].items()
+        },
+        'param_groups': state_dict['param_groups']
+    }
+
+
+def load_trial_optimizer_state_dicts(optimizer: torch.optim.Optimizer, state_dicts: list):
+    """Loads the optimizer states of single-model trials (e.g. resumed checkpoints) into the stacked `optimizer`.
+    The trials must have taken the same number of steps."""
+    stacked = copy.deepcopy(state_dicts[0])
+    for k, state in stacked['state'].items():
+        for name, value in state.items():
+            if torch.is_tensor(value) and value.dim() > 0:
+                state[name] = torch.stack([sd['state'][k][name] for sd in state_dicts])
+    optimizer.load_state_dict(stacked)
+
+
+class TrialOptimizer:
+    """Optimizer of trial `i` of a stacked `optimizer`, as far as checkpoints are concerned (`state_dict`)"""
+    def __init__(self, optimizer: torch.optim.Optimizer, i: int):
+        self.optimizer = optimizer
+        self.i = i
+
+    def state_dict(self):
+        return trial_optimizer_state_dict(self.optimizer, self.i)
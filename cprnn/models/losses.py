@@ -0,0 +1,98 @@
+import torch
+import torch.nn as nn
+
+from cprnn.models.decoders import AdaptiveDecoder
+
+_CHUNK_ELEMENTS = 2 ** 22  # Max. number of logits held at once by `chunked_cross_entropy`
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """Mean cross-entropy of a linear decoder, computed over chunks of rows
+
+    Only the log-sum-exp of every row is kept for backward, where the logits of each chunk are recomputed and turned
+    into `softmax - one_hot` in place. Peak memory is `[chunk_size, D_out]` rather than `[N, D_out]` for both passes.
+    """
+    @staticmethod
+    def forward(ctx, hidden: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, targets: torch.LongTensor,
+                chunk_size: int):
+        n_rows = hidden.size(0)
+        lse = torch.empty(n_rows, dtype=hidden.dtype, device=hidden.device)
+        loss = hidden.new_zeros(())
+
+        for start in range(0, n_rows, chunk_size):
+            end = start + chunk_size
+            logits = torch.addmm(bias, hidden[start:end], weight.t())  # [n, D_out]
+            lse[start:end] = torch.logsumexp(logits, dim=-1)
+            loss += (lse[start:end] - logits.gather(1, targets[start:end].unsqueeze(1)).squeeze(1)).sum()
+
+        ctx.save_for_backward(hidden, weight, bias, targets, lse)
+        ctx.chunk_size = chunk_size
+        return loss / n_rows
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        hidden, weight, bias, targets, lse = ctx.saved_tensors
+        n_rows, chunk_size = hidden.size(0), ctx.chunk_size
+        scale = grad_output / n_rows
+
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight)
+        grad_bias = torch.zeros_like(bias)
+
+        for start in range(0, n_rows, chunk_size):
+            end = start + chunk_size
+            grad_logits = torch.addmm(bias, hidden[start:end], weight.t())  # [n, D_out]
+            grad_logits.sub_(lse[start:end].unsqueeze(1)).exp_()  # Softmax
+            rows = torch.arange(grad_logits.size(0), device=grad_logits.device)
+            grad_logits[rows, targets[start:end]] -= 1
+            grad_logits.mul_(scale)
+
+            if grad_hidden is not None:
+                grad_hidden[start:end] = grad_logits @ weight
+            grad_weight.addmm_(grad_logits.t(), hidden[start:end])
+            grad_bias.add_(grad_logits.sum(dim=0))
+
+        return grad_hidden, grad_weight, grad_bias, None, None
+
+
+def chunked_cross_entropy(hidden: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, targets: torch.LongTensor,
+                          max_elements: int = _CHUNK_ELEMENTS):
+    """Same as `F.cross_entropy(F.linear(hidden, weight, bias), targets)`, without materializing the logits
+
+    Runs in fp32, also under autocast.
+
+    Args:
+        hidden: [N, D_h]
+        weight: [D_out, D_h]
+        bias: [D_out]
+        targets: [N]
+        max_elements: Max. number of logits computed at once
+
+    Returns:
+        Mean loss (scalar)
+    """
+    chunk_size = max(1, max_elements // weight.size(0))
+    with torch.autocast(device_type=hidden.device.type, enabled=False):
+        return ChunkedCrossEntropy.apply(hidden.float(), weight.float(), bias.float(), targets, chunk_size)
+
+
+def decoder_cross_entropy(decoder: nn.Module, hidden_seq: torch.Tensor, targets: torch.LongTensor):
+    """Fused loss of the `Sequential(Dropout, Linear)` decoder of the models. Adaptive decoders compute their own loss,
+    which only evaluates the clusters of the targets.
+
+    Args:
+        decoder: Decoder of the model
+        hidden_seq: [S, B, D_h]
+        targets: [S, B]
+
+    Returns:
+        Mean loss (scalar)
+    """
+    if isinstance(decoder, AdaptiveDecoder):
+        return decoder.loss(hidden_seq, targets)
+
+    dropout, linear = decoder
+    hidden = dropout(hidden_seq)
+    return chunked_cross_entropy(
+        hidden.reshape(-1, hidden.size(-1)), linear.weight, linear.bias, targets.reshape(-1)
+    )
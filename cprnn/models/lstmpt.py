@@ -5,12 +5,14 @@ import torch
 import torch.nn as nn
 
 from cprnn.features.tokenizer import CharacterTokenizer
+from cprnn.models.decoders import build_decoder, decoder_topk, decoder_next
+from cprnn.models.losses import decoder_cross_entropy
 
 
 class LSTMPT(nn.Module):
     def __init__(self, input_size: int, hidden_size: int, vocab_size: int, use_embedding: bool = False,
                  num_layers: int = 2, tokenizer: CharacterTokenizer = None, batch_first: bool = True,
-                 dropout: float = 0.5, **kwargs):
+                 dropout: float = 0.5, decoder: str = 'linear', unigram_counts: torch.Tensor = None, **kwargs):
         super().__init__()
 
         self.dropout = dropout
@@ -27,13 +29,16 @@ class LSTMPT(nn.Module):
             self.embedding = nn.Embedding(self.vocab_size, self.input_size)
 
         else:
-            # One hot version
-            self.embedding = lambda x: torch.nn.functional.one_hot(x, vocab_size).float()
+            # One hot version. Scattered straight into a float buffer so that only one [S, B, V] tensor is
+            # allocated (`one_hot(...).float()` builds an int64 one first). nn.LSTM fuses the input projection
+            # into its kernel, so the row-lookup path of the CP models does not apply here.
+            self.embedding = lambda x: torch.zeros(*x.shape, vocab_size, device=x.device).scatter_(
+                -1, x.unsqueeze(-1), 1.0
+            )
             self.input_size = vocab_size
 
-        self.decoder = nn.Sequential(
-            nn.Dropout(self.dropout),
-            nn.Linear(self.hidden_size, self.vocab_size)
+        self.decoder = build_decoder(
+            decoder, self.hidden_size, self.vocab_size, self.dropout, unigram_counts=unigram_counts
         )
 
         self.rnn = nn.LSTM(input_size=self.input_size, hidden_size=self.hidden_size, num_layers=self.num_layers,
@@ -56,9 +61,8 @@ class LSTMPT(nn.Module):
             else:
                 x = inp.to(device)
 
-            output, init_states = self.forward(x, init_states)
-            output_conf = torch.softmax(output, dim=-1)  # [S, B, Din]
-            output_topk = torch.topk(output_conf, top_k, dim=-1)  # [S, B, K]
+            hidden_seq, init_states = self.encode(x, init_states)
+            output_topk = decoder_topk(self.decoder, hidden_seq, top_k)  # [S, B, K]
 
             prob = output_topk[0].reshape(-1) / output_topk[0].reshape(-1).sum()
             k_star = np.random.choice(np.arange(top_k), p=prob.cpu().numpy())
@@ -70,7 +74,24 @@ class LSTMPT(nn.Module):
             else:
                 return output_ids, init_states
 
-    def forward(self, inp: torch.LongTensor, init_states: tuple = None):
+    def step(self, token_ids: torch.LongTensor, state: tuple = None, top_k: int = None):
+        """Single recurrent update for generation, without the sequence bookkeeping of `forward`
+
+        Args:
+            token_ids: Input ids. [B]
+            state: `(h, c)`, each [num_layers, B, D_h] (zeros if None)
+            top_k: If set, the probabilities and ids of the `top_k` most likely tokens are returned instead of the
+                logits (`decoder_topk`)
+
+        Returns:
+            logits: [B, D_out], or `(probs, ids)`, each [B, top_k]
+            state: Next `(h, c)`
+        """
+        output, state = self.rnn(self.embedding(token_ids).unsqueeze(0), state)  # [1, B, D_h]
+        return decoder_next(self.decoder, output[0], top_k), state
+
+    def encode(self, inp: torch.LongTensor, init_states: tuple = None):
+        """Runs the recurrence. Returns hidden states `[S, B, D_h]` (time first) and the last hidden state"""
 
         if self.batch_first:
             inp = inp.transpose(0, 1)
@@ -89,10 +110,36 @@ class LSTMPT(nn.Module):
             h_t, c_t = h_t.to(device), c_t.to(device)
             hidden_seq, (h_t, c_t) = self.rnn(x, (h_t, c_t))
 
-        output = self.decoder(hidden_seq.contiguous())
+        return hidden_seq, (h_t, c_t)
+
+    def forward(self, inp: torch.LongTensor, init_states: tuple = None, targets: torch.LongTensor = None):
+        """Returns logits and the last hidden state. With `targets`, returns the loss instead (see `forward_loss`)"""
+        if targets is not None:
+            return self.forward_loss(inp, targets, init_states)
+
+        hidden_seq, h_t = self.encode(inp, init_states)
+        output = self.decoder(hidden_seq)
 
         if self.batch_first:
             output = output.transpose(0, 1)
 
-        return output, (h_t, c_t)
+        return output, h_t
+
+    def forward_loss(self, inp: torch.LongTensor, targets: torch.LongTensor, init_states: tuple = None):
+        """Mean cross-entropy of the predictions, computed over chunks of positions so that the `[B, S, D_out]`
+        logits are never materialized
+
+        Args:
+            inp: Input ids. [B, S] if batch_first else [S, B]
+            targets: Target ids, same shape as `inp`
+            init_states: Initial hidden state
+
+        Returns:
+            loss: Mean loss (scalar)
+            h_t: Last hidden state
+        """
+        hidden_seq, h_t = self.encode(inp, init_states)
+        if self.batch_first:
+            targets = targets.transpose(0, 1)
+        return decoder_cross_entropy(self.decoder, hidden_seq, targets), h_t
 
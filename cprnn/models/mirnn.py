@@ -4,8 +4,12 @@ from typing import Union
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from cprnn.features.tokenizer import CharacterTokenizer
+from cprnn.models.decoders import build_decoder, decoder_topk, decoder_next
+from cprnn.models.losses import decoder_cross_entropy
+from cprnn.models.recurrence import Recurrence
 
 
 class MIRNN(nn.Module):
@@ -20,13 +24,21 @@ class MIRNN(nn.Module):
         tokenizer: Character tokenizer
         batch_first: Whether to use batch first or not
         dropout: Dropout rate
+        compile: Whether to run the time loop through torch.compile
+        unroll: Number of timesteps per compiled graph
+        checkpoint_segments: Number of time segments wrapped in activation checkpointing (0 disables it)
+        decoder: Output layer, `linear` or `adaptive` (adaptive softmax, for large word-level vocabularies)
+        unigram_counts: Token counts of the training data, sizes the adaptive softmax clusters
 
     """
     def __init__(self, input_size: int, hidden_size: int, vocab_size: int, use_embedding: bool = False, rank: int = 8,
                  tokenizer: CharacterTokenizer = None, batch_first: bool = True, dropout: float = 0.5,
-                 gate: str = 'tanh', **kwargs):
+                 gate: str = 'tanh', compile: bool = False, unroll: int = 8,
+                 checkpoint_segments: int = 0, decoder: str = 'linear', unigram_counts: torch.Tensor = None,
+                 **kwargs):
         super().__init__()
 
+        self.use_embedding = use_embedding
         self.dropout = dropout
         self.batch_first = batch_first
         self.tokenizer = tokenizer
@@ -35,19 +47,18 @@ class MIRNN(nn.Module):
         self.vocab_size = vocab_size
         self.rank = rank
         self.gate = {"tanh": torch.tanh, "sigmoid": torch.sigmoid, "identity": lambda x: x}[gate]
+        self.gate_ = {"tanh": torch.tanh_, "sigmoid": torch.sigmoid_, "identity": lambda x: x}[gate]
 
         # Define embedding and decoder layers
         if use_embedding:
             self.embedding = nn.Embedding(self.vocab_size, self.input_size)
 
         else:
-            # One hot version
-            self.embedding = lambda x: torch.nn.functional.one_hot(x, vocab_size).float()
+            # One hot version (inputs are gathered from the factor rows, see `forward`)
             self.input_size = vocab_size
 
-        self.decoder = nn.Sequential(
-            nn.Dropout(self.dropout),
-            nn.Linear(self.hidden_size, self.vocab_size)
+        self.decoder = build_decoder(
+            decoder, self.hidden_size, self.vocab_size, self.dropout, unigram_counts=unigram_counts
         )
 
         # Encoder using MI-RNN factors
@@ -65,12 +76,23 @@ class MIRNN(nn.Module):
 
         self.init_weights()
 
+        self.recurrence = Recurrence(compile=compile, unroll=unroll, checkpoint_segments=checkpoint_segments)
+
     def init_weights(self):
         # stdv = 1.0 / math.sqrt(self.hidden_size)
         stdv = 0.02  # to match paper
         for weight in self.parameters():
             weight.data.uniform_(-stdv, stdv)
 
+    def _step(self, h_t: torch.Tensor, x_w_t: torch.Tensor):
+        # Compute MI-RNN factors
+        return self.gate(self.beta1 * (h_t @ self.u) + x_w_t)
+
+    def _step_into(self, out: torch.Tensor, h_t: torch.Tensor, x_w_t: torch.Tensor):
+        # Same as `_step`, written into `out`
+        torch.mm(h_t, self.u, out=out)
+        self.gate_(out.mul_(self.beta1).add_(x_w_t))
+
     def init_hidden(self, batch_size, device=torch.device('cpu')):
         h = torch.zeros(batch_size, self.hidden_size).to(device)
         return h
@@ -87,9 +109,8 @@ class MIRNN(nn.Module):
             else:
                 x = inp.to(device)
 
-            output, init_states = self.forward(x, init_states)
-            output_conf = torch.softmax(output, dim=-1)  # [S, B, Din]
-            output_topk = torch.topk(output_conf, top_k, dim=-1)  # [S, B, K]
+            hidden_seq, init_states = self.encode(x, init_states)
+            output_topk = decoder_topk(self.decoder, hidden_seq, top_k)  # [S, B, K]
 
             prob = output_topk[0].reshape(-1) / output_topk[0].reshape(-1).sum()
             k_star = np.random.choice(np.arange(top_k), p=prob.cpu().numpy())
@@ -101,7 +122,28 @@ class MIRNN(nn.Module):
             else:
                 return output_ids, init_states
 
-    def forward(self, inp: torch.LongTensor, init_states: torch.Tensor = None):
+    def step(self, token_ids: torch.LongTensor, state: torch.Tensor = None, top_k: int = None):
+        """Single recurrent update for generation, without the sequence bookkeeping of `forward`
+
+        Args:
+            token_ids: Input ids. [B]
+            state: Hidden state. [B, D_h] (zeros if None)
+            top_k: If set, the probabilities and ids of the `top_k` most likely tokens are returned instead of the
+                logits (`decoder_topk`)
+
+        Returns:
+            logits: [B, D_out], or `(probs, ids)`, each [B, top_k]
+            state: Next hidden state. [B, D_h]
+        """
+        if state is None:
+            state = self.init_hidden(token_ids.size(0), device=token_ids.device)
+
+        x_w = self.embedding(token_ids) @ self.w if self.use_embedding else F.embedding(token_ids, self.w)
+        state = self._step(state, self.alpha * x_w + self.beta2 * x_w + self.b)
+        return decoder_next(self.decoder, state, top_k), state
+
+    def encode(self, inp: torch.LongTensor, init_states: torch.Tensor = None):
+        """Runs the recurrence. Returns hidden states `[S, B, D_h]` (time first) and the last hidden state"""
 
         if self.batch_first:
             inp = inp.transpose(0, 1)
@@ -109,32 +151,60 @@ class MIRNN(nn.Module):
         if len(inp.shape) != 2:
             raise ValueError("Expected input tensor of order 2, but got order {} tensor instead".format(len(inp.shape)))
 
-        x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
-        sequence_length, batch_size, _ = x.size()
-        hidden_seq = []
-
-        device = x.device
+        sequence_length, batch_size = inp.size()
+        device = inp.device
 
         if init_states is None:
-            h_t = torch.zeros(batch_size, self.hidden_size).to(x.device)
+            h_t = torch.zeros(batch_size, self.hidden_size).to(device)
 
         else:
             h_t = init_states
             h_t = h_t.to(device)
 
-        for t in range(sequence_length):
-            x_t = x[t, :, :]
+        # Input projection does not depend on h_t, so it is done for the whole sequence at once
+        # [S, B, D_i][D_i, D_h] => [S, B, D_h]
+        if self.use_embedding:
+            x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
+            x_w = x @ self.w
+        else:
+            # one_hot(x) @ w is a row lookup; its backward only accumulates into the gathered rows
+            x_w = F.embedding(inp, self.w)
+        x_w = self.alpha * x_w + self.beta2 * x_w + self.b
+
+        if self.recurrence.inplace_enabled():
+            # Inference writes into a preallocated buffer, nothing is allocated per timestep
+            hidden_seq, h_t = self.recurrence.inplace(self._step_into, h_t, x_w)
+        else:
+            hidden_seq, h_t = self.recurrence(self._step, h_t, x_w)  # [S, B, D_h]
+        return hidden_seq, h_t
 
-            # Compute MI-RNN factors
-            h_t = self.gate(
-                self.alpha * (x_t @  self.w) + self.beta1 * (h_t @ self.u) + self.beta2 * (x_t @ self.w) + self.b
-            )
-            hidden_seq.append(h_t.unsqueeze(0))
+    def forward(self, inp: torch.LongTensor, init_states: torch.Tensor = None, targets: torch.LongTensor = None):
+        """Returns logits and the last hidden state. With `targets`, returns the loss instead (see `forward_loss`)"""
+        if targets is not None:
+            return self.forward_loss(inp, targets, init_states)
 
-        hidden_seq = torch.cat(hidden_seq, dim=0)
-        output = self.decoder(hidden_seq.contiguous())
+        hidden_seq, h_t = self.encode(inp, init_states)
+        output = self.decoder(hidden_seq)
 
         if self.batch_first:
             output = output.transpose(0, 1)
 
         return output, h_t
+
+    def forward_loss(self, inp: torch.LongTensor, targets: torch.LongTensor, init_states: torch.Tensor = None):
+        """Mean cross-entropy of the predictions, computed over chunks of positions so that the `[B, S, D_out]`
+        logits are never materialized
+
+        Args:
+            inp: Input ids. [B, S] if batch_first else [S, B]
+            targets: Target ids, same shape as `inp`
+            init_states: Initial hidden state
+
+        Returns:
+            loss: Mean loss (scalar)
+            h_t: Last hidden state
+        """
+        hidden_seq, h_t = self.encode(inp, init_states)
+        if self.batch_first:
+            targets = targets.transpose(0, 1)
+        return decoder_cross_entropy(self.decoder, hidden_seq, targets), h_t
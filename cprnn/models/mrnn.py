@@ -4,8 +4,15 @@ from typing import Union
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from cprnn.features.tokenizer import CharacterTokenizer
+from cprnn.models.autotune import autotune, cp_contractions, cp_plans, compute_dtype
+from cprnn.models.decoders import build_decoder, decoder_topk, decoder_next
+from cprnn.models.losses import decoder_cross_entropy
+from cprnn.models.quantization import dequantized
+from cprnn.models.rank_growth import rank_prefix_mask
+from cprnn.models.recurrence import Recurrence, linear_scan, cp_recurrence, transition_table_pays_off
 
 
 class MRNN(nn.Module):
@@ -23,13 +30,43 @@ class MRNN(nn.Module):
         tokenizer: Character tokenizer
         batch_first: Whether to use batch first or not
         dropout: Dropout rate
+        compile: Whether to run the time loop through torch.compile
+        unroll: Number of timesteps per compiled graph
+        checkpoint_segments: Number of time segments wrapped in activation checkpointing (0 disables it)
+        scan: Whether to compute the time loop with a parallel prefix scan (requires gate `identity`). Memory grows
+            with `S B R^2` per scan level; large batches are scanned in chunks (see `linear_scan`)
+        recompute: Whether to train through `cp_recurrence`, whose backward recomputes the step intermediates from
+            the hidden states (takes precedence over `compile` and `checkpoint_segments`)
+        contraction: Plan of the CP contraction in the time loop (see `autotune.cp_contractions`)
+        autotune: Whether to benchmark the contraction plans on first use of each batch size and use the fastest
+        transition_table: Whether inference steps through per-token transition matrices (see
+            `build_transition_table`): `auto` (when `transition_table_pays_off`), `always` or `never`
+        decoder: Output layer, `linear` or `adaptive` (adaptive softmax, for large word-level vocabularies)
+        unigram_counts: Token counts of the training data, sizes the adaptive softmax clusters
 
     """
     def __init__(self, input_size: int, hidden_size: int, vocab_size: int, use_embedding: bool = False, rank: int = 8,
                  gate: str = 'tanh', tokenizer: CharacterTokenizer = None, batch_first: bool = True,
-                 dropout: float = 0.5, **kwargs):
+                 dropout: float = 0.5, compile: bool = False, unroll: int = 8,
+                 checkpoint_segments: int = 0, scan: bool = False, recompute: bool = False,
+                 contraction: str = 'factored', autotune: bool = False, transition_table: str = 'auto',
+                 decoder: str = 'linear', unigram_counts: torch.Tensor = None, **kwargs):
         super().__init__()
 
+        if contraction not in cp_plans(bias=True):
+            raise ValueError("Unknown contraction `{}`. Expected one of {}".format(
+                contraction, cp_plans(bias=True)
+            ))
+
+        if transition_table not in ('auto', 'always', 'never'):
+            raise ValueError("Unknown transition_table `{}`. Expected one of `auto`, `always`, `never`".format(
+                transition_table
+            ))
+
+        if scan and gate != 'identity':
+            raise ValueError("Parallel scan requires gate `identity`, got `{}`".format(gate))
+
+        self.use_embedding = use_embedding
         self.dropout = dropout
         self.batch_first = batch_first
         self.tokenizer = tokenizer
@@ -38,20 +75,26 @@ class MRNN(nn.Module):
         self.vocab_size = vocab_size
         self.rank = rank
         self.gate = {"tanh": torch.tanh, "sigmoid": torch.sigmoid, "identity": lambda x: x}[gate]
-
+        self.gate_ = {"tanh": torch.tanh_, "sigmoid": torch.sigmoid_, "identity": lambda x: x}[gate]
+        self.scan = scan
+        self.recompute = recompute
+        self.gate_name = gate
+        self.contraction = contraction
+        self.autotune = autotune
+        self._tuned_plans = dict()  # (batch size, rank, dtype, backward) -> contraction, see `tune_contraction`
+        self.transition_table = transition_table
+        self._table = None  # (factor versions, transition matrices, step biases), see `build_transition_table`
 
         # Define embedding and decoder layers
         if use_embedding:
             self.embedding = nn.Embedding(self.vocab_size, self.input_size)
 
         else:
-            # One hot version
-            self.embedding = lambda x: torch.nn.functional.one_hot(x, vocab_size).float()
+            # One hot version (inputs are gathered from the factor rows, see `forward`)
             self.input_size = vocab_size
 
-        self.decoder = nn.Sequential(
-            nn.Dropout(self.dropout),
-            nn.Linear(self.hidden_size, self.vocab_size)
+        self.decoder = build_decoder(
+            decoder, self.hidden_size, self.vocab_size, self.dropout, unigram_counts=unigram_counts
         )
 
         # Encoder using CP factors
@@ -63,11 +106,139 @@ class MRNN(nn.Module):
 
         self.init_weights()
 
+        self.recurrence = Recurrence(compile=compile, unroll=unroll, checkpoint_segments=checkpoint_segments)
+
     def init_weights(self):
         stdv = 1.0 / math.sqrt(self.hidden_size)
         for weight in self.parameters():
             weight.data.uniform_(-stdv, stdv)
 
+    def _step(self, h_t: torch.Tensor, b_prime_t: torch.Tensor, x_beta_t: torch.Tensor):
+        # [B, D_h][D_h, R] => [B, R]
+        a_prime = h_t @ self.a
+        return self.gate(cp_contractions[self.contraction](a_prime, b_prime_t, self.c, x_beta_t))
+
+    def _step_into(self, out: torch.Tensor, h_t: torch.Tensor, b_prime_t: torch.Tensor, x_beta_t: torch.Tensor,
+                   a: torch.Tensor, c: torch.Tensor, a_prime: torch.Tensor):
+        # Same as `_step`, written into `out` with `a_prime` [B, R] as scratch. `a` and `c` are the factors, which
+        # quantized models dequantize once per call rather than at every step
+        torch.mm(h_t, a, out=a_prime)
+        torch.addmm(x_beta_t, a_prime.mul_(b_prime_t), c.t(), out=out)
+        self.gate_(out)
+
+    def tune_contraction(self, h_t: torch.Tensor, b_prime_t: torch.Tensor, x_beta_t: torch.Tensor):
+        """Fastest CP contraction plan for the batch size and compute dtype of `h_t` at the current rank, resolved
+        once with `autotune` (timed forward and backward when the factors are trained)
+
+        Args:
+            h_t: Hidden state. [B, D_h]
+            b_prime_t: Input projection of the first step. [B, R]
+            x_beta_t: Input term of the first step. [B, D_h]
+
+        Returns:
+            Name of the plan (see `autotune.cp_contractions`)
+        """
+        backward = torch.is_grad_enabled() and self.c.requires_grad
+        key = (h_t.size(0), self.rank, compute_dtype(h_t.device, h_t.dtype), backward)
+        if key not in self._tuned_plans:
+            # Detached copies, so that timing the backward leaves the graph of the batch alone
+            a_prime = (h_t @ self.a).detach().requires_grad_(backward)
+            b_prime = b_prime_t.detach().requires_grad_(backward)
+            bias = x_beta_t.detach().requires_grad_(backward)
+            candidates = {
+                name: (lambda name=name: cp_contractions[name](a_prime, b_prime, self.c, bias))
+                for name in cp_plans(bias=True)
+            }
+            self._tuned_plans[key] = autotune(
+                "mrnn", candidates, shape={"B": h_t.size(0), "H": self.hidden_size, "R": self.rank},
+                device=h_t.device, dtype=h_t.dtype, grad_inputs=(a_prime, b_prime, bias, self.c) if backward else None
+            )
+        return self._tuned_plans[key]
+
+    def _table_step_into(self, out: torch.Tensor, h_t: torch.Tensor, x_t: torch.LongTensor, u_t: torch.Tensor,
+                         w: torch.Tensor, w_t: torch.Tensor):
+        # Gathers the transition matrix of every input into `w_t` [B, D_h, D_h], then [B, 1, D_h][B, D_h, D_h]
+        torch.index_select(w, 0, x_t, out=w_t)
+        torch.baddbmm(u_t.unsqueeze(1), h_t.unsqueeze(1), w_t, out=out.unsqueeze(1))
+        self.gate_(out)
+
+    def build_transition_table(self):
+        """Transition matrix `a diag(b'_v) c^T` [V, D_h, D_h] and step bias [V, D_h] of every token `v`, such that a
+        step is `h_{t+1} = gate(h_t @ w[x_t] + u[x_t])`. Cached until the factors change or `train` is called.
+        """
+        params = [self.a, self.b, self.c, self.beta, self.alpha]
+        if self.use_embedding:
+            params.append(self.embedding.weight)
+        versions = [(id(p), getattr(p, '_version', 0)) for p in params]  # Bumped by optimizer steps and loading
+
+        if self._table is None or self._table[0] != versions:
+            self._table = None  # Frees the previous table before building the new one
+            with torch.no_grad():
+                b_prime = self.b if not self.use_embedding else self.embedding.weight @ self.b  # [V, R]
+                # [D_h, R][V, R][D_h, R] => [V, D_h, D_h] and [V, D_i][D_i, D_h] => [V, D_h]
+                w = torch.einsum("ir,vr,kr->vik", self.a, b_prime, self.c)
+                u = (self.beta if not self.use_embedding else self.embedding.weight @ self.beta) + self.alpha
+            self._table = (versions, w, u)
+        return self._table[1], self._table[2]
+
+    def use_transition_table(self, batch_size: int):
+        """Whether `encode` steps through `build_transition_table` for a batch of `batch_size` sequences. Never for
+        quantized factors, whose fp32 `[V, D_h, D_h]` table would undo the compression."""
+        if self.training or self.transition_table == 'never' or not self.recurrence.inplace_enabled():
+            return False
+        if not isinstance(self.c, torch.Tensor):  # `QuantizedWeight`
+            return False
+        return self.transition_table == 'always' or transition_table_pays_off(
+            self.vocab_size, self.hidden_size, self.rank, batch_size
+        )
+
+    def train(self, mode: bool = True):
+        self._table = None  # Stale once the factors are trained
+        return super().train(mode)
+
+    def component_importance(self):
+        """Importance of each CP component, the product of the norms of its factor columns. [R]"""
+        return self.a.norm(dim=0) * self.b.norm(dim=0) * self.c.norm(dim=0)
+
+    def truncate_rank(self, rank: int, prefix: bool = False):
+        """Keeps the `rank` most important CP components, sorted by decreasing importance (in place). With `prefix`,
+        keeps the first `rank` components instead, i.e. the rank-`rank` model of nested-rank training."""
+        if rank > self.rank:
+            raise ValueError("Cannot truncate rank {} model to rank {}".format(self.rank, rank))
+
+        with torch.no_grad():
+            if prefix:
+                index = torch.arange(rank, device=self.a.device)
+            else:
+                index = self.component_importance().argsort(descending=True)[:rank]
+            self.a = nn.Parameter(self.a[:, index].clone())
+            self.b = nn.Parameter(self.b[:, index].clone())
+            self.c = nn.Parameter(self.c[:, index].clone())
+        self.rank = rank
+        return self
+
+    def grow_rank(self, rank: int):
+        """Appends `rank - self.rank` CP components (in place). Their `a` and `b` columns are drawn as in
+        `init_weights` and their `c` columns are zero, so the function of the model is unchanged.
+
+        The parameter objects are kept and their data extended, so optimizers keep tracking them (pad their states
+        with `rank_growth.grow_optimizer_state`).
+        """
+        if rank < self.rank:
+            raise ValueError("Cannot grow rank {} model to rank {}".format(self.rank, rank))
+
+        stdv = 1.0 / math.sqrt(self.hidden_size)
+        with torch.no_grad():
+            for factor in [self.a, self.b]:
+                new = factor.new_empty(factor.size(0), rank - self.rank).uniform_(-stdv, stdv)
+                factor.data = torch.cat([factor.data, new], dim=1)
+            self.c.data = torch.cat([self.c.data, self.c.new_zeros(self.c.size(0), rank - self.rank)], dim=1)
+            for factor in [self.a, self.b, self.c]:
+                factor.grad = None  # Shape of the previous rank
+        self.rank = rank
+        self._table = None
+        return self
+
     def init_hidden(self, batch_size, device=torch.device('cpu')):
         h = torch.zeros(batch_size, self.hidden_size).to(device)
         return h
@@ -84,9 +255,8 @@ class MRNN(nn.Module):
             else:
                 x = inp.to(device)
 
-            output, init_states = self.forward(x, init_states)
-            output_conf = torch.softmax(output, dim=-1)  # [S, B, Din]
-            output_topk = torch.topk(output_conf, top_k, dim=-1)  # [S, B, K]
+            hidden_seq, init_states = self.encode(x, init_states)
+            output_topk = decoder_topk(self.decoder, hidden_seq, top_k)  # [S, B, K]
 
             prob = output_topk[0].reshape(-1) / output_topk[0].reshape(-1).sum()
             k_star = np.random.choice(np.arange(top_k), p=prob.cpu().numpy())
@@ -98,7 +268,40 @@ class MRNN(nn.Module):
             else:
                 return output_ids, init_states
 
-    def forward(self, inp: torch.LongTensor, init_states: torch.Tensor = None):
+    def step(self, token_ids: torch.LongTensor, state: torch.Tensor = None, top_k: int = None):
+        """Single recurrent update for generation, without the sequence bookkeeping of `forward`
+
+        Args:
+            token_ids: Input ids. [B]
+            state: Hidden state. [B, D_h] (zeros if None)
+            top_k: If set, the probabilities and ids of the `top_k` most likely tokens are returned instead of the
+                logits (`decoder_topk`)
+
+        Returns:
+            logits: [B, D_out], or `(probs, ids)`, each [B, top_k]
+            state: Next hidden state. [B, D_h]
+        """
+        if state is None:
+            state = self.init_hidden(token_ids.size(0), device=token_ids.device)
+
+        if self.use_transition_table(token_ids.size(0)):
+            w, u = self.build_transition_table()
+            state = self.gate(torch.baddbmm(u[token_ids].unsqueeze(1), state.unsqueeze(1), w[token_ids]).squeeze(1))
+            return decoder_next(self.decoder, state, top_k), state
+
+        if self.use_embedding:
+            x = self.embedding(token_ids)
+            b_prime, x_beta = x @ self.b, x @ self.beta + self.alpha
+        else:
+            b_prime, x_beta = F.embedding(token_ids, self.b), F.embedding(token_ids, self.beta) + self.alpha
+        state = self._step(state, b_prime, x_beta)
+        return decoder_next(self.decoder, state, top_k), state
+
+    def encode(self, inp: torch.LongTensor, init_states: torch.Tensor = None, rank_prefix=None):
+        """Runs the recurrence. Returns hidden states `[S, B, D_h]` (time first) and the last hidden state
+
+        With `rank_prefix` (an int or one per sequence [B]), only the first `rank_prefix` CP components are used.
+        """
 
         if self.batch_first:
             inp = inp.transpose(0, 1)
@@ -106,36 +309,88 @@ class MRNN(nn.Module):
         if len(inp.shape) != 2:
             raise ValueError("Expected input tensor of order 2, but got order {} tensor instead".format(len(inp.shape)))
 
-        x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
-        sequence_length, batch_size, _ = x.size()
-        hidden_seq = []
-
-        device = x.device
+        sequence_length, batch_size = inp.size()
+        device = inp.device
 
         if init_states is None:
-            h_t = torch.zeros(batch_size, self.hidden_size).to(x.device)
+            h_t = torch.zeros(batch_size, self.hidden_size).to(device)
 
         else:
             h_t = init_states
             h_t = h_t.to(device)
 
-        for t in range(sequence_length):
-            x_t = x[t, :, :]
-
-            # [B, D_h][D_h, R] => [B, R]
-            a_prime = h_t @ self.a
+        if rank_prefix is None and self.use_transition_table(batch_size):
+            # Small vocabularies: every step is one gathered [D_h, D_h] matvec instead of three factor products
+            w, u = self.build_transition_table()
+            return self.recurrence.inplace(
+                self._table_step_into, h_t, inp, F.embedding(inp, u),
+                workspace=(w, h_t.new_empty(batch_size, self.hidden_size, self.hidden_size))
+            )
 
-            # [B, D_i'][D_i', R] => [B, R]
-            b_prime = x_t @ self.b
-            h_t = self.gate(
-                torch.einsum("br,br,hr->bh", a_prime, b_prime, self.c) + x_t @ self.beta + self.alpha
+        # Input projections do not depend on h_t, so they are done for the whole sequence at once
+        # [S, B, D_i][D_i, R] => [S, B, R] and [S, B, D_i][D_i, D_h] => [S, B, D_h]
+        if self.use_embedding:
+            x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
+            b_prime = x @ self.b
+            x_beta = x @ self.beta + self.alpha
+        else:
+            # one_hot(x) @ M is a row lookup; its backward only accumulates into the gathered rows
+            b_prime = F.embedding(inp, self.b)
+            x_beta = F.embedding(inp, self.beta) + self.alpha
+
+        if rank_prefix is not None:
+            # Components past the prefix drop out of every step with their column of b'
+            b_prime = b_prime * rank_prefix_mask(self.rank, rank_prefix, device, b_prime.dtype)
+
+        if self.scan:
+            # The identity-gated update is affine in h_t: all steps are composed with a parallel prefix scan
+            hidden_seq = linear_scan(h_t, self.a, self.c, b_prime, x_beta)  # [S, B, D_h]
+            h_t = hidden_seq[-1]
+        elif self.recurrence.inplace_enabled():
+            # Inference writes into preallocated buffers, nothing is allocated per timestep
+            hidden_seq, h_t = self.recurrence.inplace(
+                self._step_into, h_t, b_prime, x_beta,
+                workspace=(dequantized(self.a), dequantized(self.c), h_t.new_empty(batch_size, self.rank))
             )
-            hidden_seq.append(h_t.unsqueeze(0))
+        elif self.recompute:
+            hidden_seq = cp_recurrence(h_t, self.a, None, self.c, b_prime, x_beta, gate=self.gate_name)
+            h_t = hidden_seq[-1]
+        else:
+            if self.autotune:
+                self.contraction = self.tune_contraction(h_t, b_prime[0], x_beta[0])
+            hidden_seq, h_t = self.recurrence(self._step, h_t, b_prime, x_beta)  # [S, B, D_h]
+        return hidden_seq, h_t
+
+    def forward(self, inp: torch.LongTensor, init_states: torch.Tensor = None, targets: torch.LongTensor = None,
+                rank_prefix=None):
+        """Returns logits and the last hidden state. With `targets`, returns the loss instead (see `forward_loss`)"""
+        if targets is not None:
+            return self.forward_loss(inp, targets, init_states, rank_prefix=rank_prefix)
 
-        hidden_seq = torch.cat(hidden_seq, dim=0)
-        output = self.decoder(hidden_seq.contiguous())
+        hidden_seq, h_t = self.encode(inp, init_states, rank_prefix=rank_prefix)
+        output = self.decoder(hidden_seq)
 
         if self.batch_first:
             output = output.transpose(0, 1)
 
         return output, h_t
+
+    def forward_loss(self, inp: torch.LongTensor, targets: torch.LongTensor, init_states: torch.Tensor = None,
+                     rank_prefix=None):
+        """Mean cross-entropy of the predictions, computed over chunks of positions so that the `[B, S, D_out]`
+        logits are never materialized
+
+        Args:
+            inp: Input ids. [B, S] if batch_first else [S, B]
+            targets: Target ids, same shape as `inp`
+            init_states: Initial hidden state
+            rank_prefix: Number of CP components used, an int or one per sequence [B] (see `encode`)
+
+        Returns:
+            loss: Mean loss (scalar)
+            h_t: Last hidden state
+        """
+        hidden_seq, h_t = self.encode(inp, init_states, rank_prefix=rank_prefix)
+        if self.batch_first:
+            targets = targets.transpose(0, 1)
+        return decoder_cross_entropy(self.decoder, hidden_seq, targets), h_t
@@ -0,0 +1,131 @@
+import io
+import copy
+
+import torch
+import torch.nn as nn
+
+
+def _dequantize_args(obj):
+    if isinstance(obj, QuantizedWeight):
+        return obj.dequantize()
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_dequantize_args(o) for o in obj)
+    elif isinstance(obj, dict):
+        return {k: _dequantize_args(v) for k, v in obj.items()}
+    return obj
+
+
+class QuantizedWeight(nn.Module):
+    """Weight stored in int8 or fp16 and dequantized to fp32 when used
+
+    int8 weights are quantized symmetrically with one scale per index of every dimension but the first, e.g.
+    `[1, D_i', D_h]` scales for the `(D_h', D_i', D_h)` core of a SecondOrderRNN. The object behaves like a tensor
+    in torch functions and operators (through `__torch_function__`). Indexing only dequantizes the selected
+    elements, so gathering slices of a large core never materializes the whole fp32 tensor.
+
+    Args:
+        weight: Weight to quantize
+        dtype: Storage type, `int8` or `fp16`
+
+    """
+    def __init__(self, weight: torch.Tensor, dtype: str = 'int8'):
+        super().__init__()
+        weight = weight.detach()
+        self.storage_dtype = dtype
+
+        if dtype == 'int8':
+            scale = weight.abs().amax(dim=0, keepdim=True).clamp(min=1e-12) / 127
+            self.register_buffer('qdata', torch.round(weight / scale).to(torch.int8))
+            self.register_buffer('scale', scale.float())
+        elif dtype == 'fp16':
+            self.register_buffer('qdata', weight.half())
+            self.register_buffer('scale', torch.ones(1, *weight.shape[1:]))
+        else:
+            raise ValueError("Unknown storage type `{}`. Expected one of `int8`, `fp16`".format(dtype))
+
+    @classmethod
+    def __torch_function__(cls, func, types, args=(), kwargs=None):
+        return func(*_dequantize_args(args), **_dequantize_args(kwargs or {}))
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if name.startswith('_'):  # Keeps copy/pickle protocol lookups from recursing through `dequantize`
+                raise
+            # Tensor methods and attributes (`t()`, `device`, ...) are served by the dequantized weight
+            return getattr(self.dequantize(), name)
+
+    def __getitem__(self, idx):
+        return self.qdata[idx].float() * self.scale.expand(self.qdata.shape)[idx]
+
+    def __matmul__(self, other):
+        return self.dequantize() @ other
+
+    def __rmatmul__(self, other):
+        return other @ self.dequantize()
+
+    def __mul__(self, other):
+        return self.dequantize() * other
+
+    __rmul__ = __mul__
+
+    def __add__(self, other):
+        return self.dequantize() + other
+
+    __radd__ = __add__
+
+    @property
+    def shape(self):
+        return self.qdata.shape
+
+    def size(self, *args):
+        return self.qdata.size(*args)
+
+    def dim(self):
+        return self.qdata.dim()
+
+    def dequantize(self):
+        return self.qdata.float() * self.scale
+
+    def extra_repr(self):
+        return "shape={}, dtype={}".format(tuple(self.qdata.shape), self.storage_dtype)
+
+
+def dequantized(weight):
+    """`weight` as a regular tensor, dequantized if it is a `QuantizedWeight`. Lets the time loops dequantize a weight
+    once per call instead of at every use in a step."""
+    return weight.dequantize() if isinstance(weight, QuantizedWeight) else weight
+
+
+def quantize_model(model: nn.Module, dtype: str = 'int8'):
+    """Copy of `model` for CPU inference with int8 or fp16 weights
+
+    `nn.Linear` and `nn.LSTM` layers (the decoders and LSTMPT's recurrence) go through PyTorch dynamic
+    quantization. The model's own recurrent weights (CP factors, dense cores, ...) of order two or more are
+    replaced by `QuantizedWeight`. Biases and other vectors stay in fp32.
+
+    Args:
+        model: Trained fp32 model
+        dtype: `int8` or `fp16`
+
+    Returns:
+        Quantized copy of `model` in eval mode
+    """
+    qdtype = {'int8': torch.qint8, 'fp16': torch.float16}[dtype]
+    model = copy.deepcopy(model).cpu().eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=qdtype)
+
+    for name, param in list(model.named_parameters(recurse=False)):
+        if param.dim() >= 2:
+            delattr(model, name)
+            setattr(model, name, QuantizedWeight(param, dtype))
+
+    return model
+
+
+def model_nbytes(model: nn.Module):
+    """Serialized size of the weights of `model` in bytes (counts packed quantized weights too)"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
@@ -0,0 +1,83 @@
+"""Rank growth of CP models (`cprnn`, `mrnn`) during training
+
+A run with `model.rank_schedule` starts at a small rank and appends CP components at scheduled epochs or when the
+validation loss stops improving, e.g.
+
+    python train.py model.name=cprnn model.rank=64 model.rank_schedule="8,16@3,32@6,64@plateau"
+
+trains at rank 8, grows to 16 at epoch 3 and to 32 at epoch 6, then to 64 at the first epoch that follows one without
+improvement of the validation loss. Entries apply in order and the last one must be `model.rank`. New components
+have a zero output factor, so a growth leaves the function of the model unchanged (see `grow_rank`), and their
+optimizer states start at zero (see `grow_optimizer_state`).
+
+Nested-rank training (`train.nested_ranks`) trains the prefixes of the components instead, so that the first `r`
+components form a rank-`r` model on their own (see `rank_prefix_mask`).
+"""
+from typing import List, Tuple, Optional
+
+import torch
+
+
+def parse_rank_schedule(schedule: str, rank: int) -> List[Tuple[int, Optional[int]]]:
+    """Parses `rank_schedule` into `(rank, epoch)` entries, epoch `None` for growths on a validation plateau
+
+    Args:
+        schedule: Comma-separated entries, the starting rank then `rank@epoch` or `rank@plateau`
+        rank: Final rank of the model (`model.rank`)
+
+    Returns:
+        List of `(rank, epoch)`, the first one being `(starting rank, 1)`
+    """
+    entries = []
+    for i, entry in enumerate(str(schedule).replace(' ', '').split(',')):
+        rank_str, _, start = entry.partition('@')
+        if i == 0 and start == '':
+            start = '1'
+        if not rank_str.isdigit() or not (start.isdigit() or start == 'plateau'):
+            raise ValueError("Invalid rank schedule entry `{}`, expected `rank@epoch` or `rank@plateau`".format(entry))
+        entries.append((int(rank_str), None if start == 'plateau' else int(start)))
+
+    ranks = [r for r, _ in entries]
+    if any(r_next <= r for r, r_next in zip(ranks[:-1], ranks[1:])) or ranks[-1] != rank:
+        raise ValueError("Rank schedule `{}` must be increasing and end at the model rank {}".format(schedule, rank))
+    return entries
+
+
+def scheduled_rank(schedule: List[Tuple[int, Optional[int]]], rank: int, epoch: int, plateau: bool = False):
+    """Rank to train epoch `epoch` with, given the current `rank` and whether the last epoch did not improve the
+    validation loss. Several epoch entries can apply at once, a plateau applies to one entry."""
+    for next_rank, start in schedule:
+        if next_rank <= rank:
+            continue
+        if start is None and plateau:
+            rank, plateau = next_rank, False
+        elif start is not None and epoch >= start:
+            rank = next_rank
+        else:
+            break
+    return rank
+
+
+def grow_optimizer_state(optimizer: torch.optim.Optimizer, params):
+    """Zero-pads the states of `params` (e.g. Adam moments) that no longer match the shape of their parameter, after
+    a growth that kept the parameter objects and extended their data"""
+    for p in params:
+        for key, value in optimizer.state.get(p, dict()).items():
+            if torch.is_tensor(value) and value.dim() > 0 and value.shape != p.shape:
+                padded = value.new_zeros(p.shape)
+                padded[tuple(slice(0, n) for n in value.shape)] = value
+                optimizer.state[p][key] = padded
+
+
+def rank_prefix_mask(rank: int, rank_prefix, device: torch.device, dtype: torch.dtype = torch.float32):
+    """Mask of the CP components kept by `rank_prefix` (nested-rank training), i.e. the first `rank_prefix` ones
+
+    Args:
+        rank: Rank of the model
+        rank_prefix: Rank prefix, an int or one per sequence [B]
+
+    Returns:
+        [R] or [B, R], multiplied into the input projection `b'` so that the other components drop out of every step
+    """
+    rank_prefix = torch.as_tensor(rank_prefix, device=device)
+    return (torch.arange(rank, device=device) < rank_prefix.unsqueeze(-1)).to(dtype)
@@ -0,0 +1,339 @@
+import os
+import math
+
+import torch
+import torch.utils.checkpoint
+
+_TABLE_BYTES = 2 ** 28  # Max. memory of the per-token transition table (see `transition_table_pays_off`)
+_SCAN_MAX_ELEMENTS = 2 ** 24  # Max. size of the `[S, B, R, R]` cores of one scan level (see `linear_scan`)
+
+
+def multi_step(step, h_t: torch.Tensor, *inputs: torch.Tensor):
+    """Applies `step` over the leading (time) dimension of `inputs`
+
+    Args:
+        step: Recurrent update `step(h_t, *inputs_t) -> h_t`
+        h_t: Initial hidden state. [B, D_h]
+        inputs: Precomputed per-timestep inputs of `step`. [S, B, *]
+
+    Returns:
+        hidden_seq: [S, B, D_h]
+        h_t: Last hidden state. [B, D_h]
+    """
+    hidden_seq = []
+    for t in range(inputs[0].size(0)):
+        # Under autocast the step may come out in bf16; the state keeps its own dtype (fp32) across timesteps
+        h_t = step(h_t, *[u[t] for u in inputs]).to(h_t.dtype)
+        hidden_seq.append(h_t)
+    return torch.stack(hidden_seq, dim=0), h_t
+
+
+def enable_compile_cache(cache_dir: str):
+    """Persists torch.compile artifacts in `cache_dir` so that reruns do not pay the compile cost again"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, "fx_graph_cache"):  # Only available in recent versions of torch
+        inductor_config.fx_graph_cache = True
+
+
+class Recurrence:
+    """Runs the time loop of a recurrent model, either eagerly or through torch.compile
+
+    When compiled, the loop is cut in blocks of `unroll` timesteps and each block is traced into a single graph,
+    which removes the per-step Python and dispatch overhead. The first compiled call is checked against the eager
+    loop and raises if the two disagree.
+
+    With `checkpoint_segments > 0` the time loop is split into that many segments, each wrapped in activation
+    checkpointing while gradients are enabled. Autograd then keeps only the hidden states at the output of each
+    segment and recomputes the intermediates of a segment during backward.
+
+    Without gradients (and without compile), models can run `inplace` instead, which writes every hidden state into a
+    preallocated `[S, B, D_h]` buffer through an out-of-place-free step and allocates nothing per timestep.
+
+    The step function is passed on every call rather than stored, so that replicas of a model (e.g. under
+    nn.DataParallel) run their own parameters.
+
+    Args:
+        compile: Whether to compile the time loop
+        unroll: Number of timesteps per compiled graph
+        checkpoint_segments: Number of checkpointed time segments (0 disables checkpointing)
+        rtol: Relative tolerance of the compiled vs. eager check
+        atol: Absolute tolerance of the compiled vs. eager check
+
+    """
+    def __init__(self, compile: bool = False, unroll: int = 8, checkpoint_segments: int = 0, rtol: float = 1e-4,
+                 atol: float = 1e-5):
+        self.compile = compile
+        self.unroll = unroll
+        self.checkpoint_segments = checkpoint_segments
+        self.rtol = rtol
+        self.atol = atol
+        self._compiled = None
+        self._verified = False
+
+    def __getstate__(self):
+        # Compiled graphs are rebuilt lazily, they cannot be pickled or copied
+        state = self.__dict__.copy()
+        state['_compiled'], state['_verified'] = None, False
+        return state
+
+    def compiled(self, step, h_t: torch.Tensor, *inputs: torch.Tensor):
+        if self._compiled is None:
+            self._compiled = torch.compile(multi_step, dynamic=False)
+
+        hidden_seq = []
+        for start in range(0, inputs[0].size(0), self.unroll):
+            hidden_block, h_t = self._compiled(step, h_t, *[u[start:start + self.unroll] for u in inputs])
+            hidden_seq.append(hidden_block)
+        return torch.cat(hidden_seq, dim=0), h_t
+
+    def checkpointed(self, run, step, h_t: torch.Tensor, *inputs: torch.Tensor):
+        sequence_length = inputs[0].size(0)
+        segment_length = math.ceil(sequence_length / self.checkpoint_segments)
+
+        hidden_seq = []
+        for start in range(0, sequence_length, segment_length):
+            hidden_segment, h_t = torch.utils.checkpoint.checkpoint(
+                run, step, h_t, *[u[start:start + segment_length] for u in inputs], use_reentrant=False
+            )
+            hidden_seq.append(hidden_segment)
+        return torch.cat(hidden_seq, dim=0), h_t
+
+    def inplace_enabled(self):
+        """Whether `inplace` can replace `__call__`, i.e. nothing needs the autograd graph or a compiled loop"""
+        return not self.compile and not torch.is_grad_enabled()
+
+    @staticmethod
+    def inplace(step_into, h_t: torch.Tensor, *inputs: torch.Tensor, workspace: tuple = ()):
+        """Runs `step_into(out, h_t, *inputs_t, *workspace)`, which writes the next hidden state into `out`, over time
+
+        Args:
+            step_into: In-place recurrent update
+            h_t: Initial hidden state. [B, D_h]
+            inputs: Precomputed per-timestep inputs. [S, B, *]
+            workspace: Scratch buffers reused by every step
+
+        Returns:
+            hidden_seq: [S, B, D_h]
+            h_t: Last hidden state (view of `hidden_seq`). [B, D_h]
+        """
+        hidden_seq = h_t.new_empty(inputs[0].size(0), *h_t.shape)
+        for t in range(hidden_seq.size(0)):
+            step_into(hidden_seq[t], h_t, *[u[t] for u in inputs], *workspace)
+            h_t = hidden_seq[t]
+        return hidden_seq, h_t
+
+    def __call__(self, step, h_t: torch.Tensor, *inputs: torch.Tensor):
+        """Runs `step(h_t, *inputs_t) -> h_t` over time. Returns hidden states `[S, B, D_h]` and last hidden state
+        `[B, D_h]`"""
+        run = self.compiled if self.compile else multi_step
+
+        if self.checkpoint_segments > 0 and torch.is_grad_enabled():
+            hidden_seq, h_last = self.checkpointed(run, step, h_t, *inputs)
+        else:
+            hidden_seq, h_last = run(step, h_t, *inputs)
+
+        if not self.compile:
+            return hidden_seq, h_last
+
+        if not self._verified:
+            with torch.no_grad():
+                hidden_seq_eager, _ = multi_step(step, h_t, *inputs)
+            if not torch.allclose(hidden_seq.detach(), hidden_seq_eager, rtol=self.rtol, atol=self.atol):
+                raise RuntimeError("Compiled recurrence does not match the eager one (max abs. error {:.2e})".format(
+                    (hidden_seq.detach() - hidden_seq_eager).abs().max().item()
+                ))
+            self._verified = True
+
+        return hidden_seq, h_last
+
+
+def linear_scan(h_0: torch.Tensor, a: torch.Tensor, c: torch.Tensor, b_prime: torch.Tensor, d: torch.Tensor,
+                max_elements: int = _SCAN_MAX_ELEMENTS):
+    """Computes the identity-gated CP recurrence `h_{t+1} = ((h_t @ a) * b'_t) @ c^T + d_t` with a parallel prefix scan
+
+    For a fixed input sequence each step is an affine map `h -> h a diag(b'_t) c^T + d_t`. Affine maps compose
+    associatively and, thanks to the low-rank structure, the composition of any run of steps stays of the form
+    `h -> h a P c^T + d` with a `[R, R]` core `P`:
+
+    .. math::
+        (P_1, d_1) \\circ (P_2, d_2) = (P_1 K P_2, d_1 a P_2 c^T + d_2), \\quad K = c^T a
+
+    so no `[D_h, D_h]` matrix is ever formed. An inclusive (Hillis-Steele) scan over time then gives all hidden
+    states in `ceil(log2 S)` sequential levels. Backward goes through autograd and has the same depth. It always runs
+    in fp32, as products of up to `S` cores lose too much precision under bf16 autocast.
+
+    The scan keeps a `[S, B, R, R]` core per level, so it trades memory for sequential depth (about 0.8 GB per level
+    at `B = 1024`, `S = 50`, `R = 64`). Sequences are independent, so the batch is scanned in chunks whose cores stay
+    within `max_elements`. With gradients the chunks are checkpointed, so backward also holds the cores of one chunk
+    at a time. When a single sequence already exceeds `max_elements`, the recurrence runs step by step instead.
+
+    Args:
+        h_0: Initial hidden state. [B, D_h]
+        a: Hidden factor (without bias row). [D_h, R]
+        c: Output factor. [D_h, R]
+        b_prime: Input projection of every step. [S, B, R]
+        d: Additive term of every step. [S, B, D_h]
+        max_elements: Max. number of elements of the cores of one scan level
+
+    Returns:
+        hidden_seq: [S, B, D_h]
+    """
+    sequence_length, batch_size, rank = b_prime.shape
+    h_0, a, c, b_prime, d = [u.float() for u in (h_0, a, c, b_prime, d)]
+    chunk_size = max_elements // (sequence_length * rank * rank)
+
+    with torch.autocast(device_type=h_0.device.type, enabled=False):
+        if chunk_size == 0:
+            hidden_seq, _ = multi_step(lambda h_t, b_t, d_t: ((h_t @ a) * b_t) @ c.t() + d_t, h_0, b_prime, d)
+            return hidden_seq
+
+        if chunk_size >= batch_size:
+            return _scan_chunk(h_0, a, c, b_prime, d)
+
+        hidden_seq = []
+        for start in range(0, batch_size, chunk_size):
+            chunk = h_0[start:start + chunk_size], a, c, b_prime[:, start:start + chunk_size], \
+                d[:, start:start + chunk_size]
+            if torch.is_grad_enabled():
+                # Otherwise autograd would keep the cores of all chunks for backward
+                hidden_seq.append(torch.utils.checkpoint.checkpoint(_scan_chunk, *chunk, use_reentrant=False))
+            else:
+                hidden_seq.append(_scan_chunk(*chunk))
+        return torch.cat(hidden_seq, dim=1)
+
+
+def _scan_chunk(h_0: torch.Tensor, a: torch.Tensor, c: torch.Tensor, b_prime: torch.Tensor, d: torch.Tensor):
+    """Prefix scan of `linear_scan` over one chunk of the batch"""
+    sequence_length = b_prime.size(0)
+    k = c.t() @ a  # [R, R]
+    p = torch.diag_embed(b_prime)  # [S, B, R, R]
+
+    offset = 1
+    while offset < sequence_length:
+        # Compose every element with the one `offset` steps before it
+        p_prev, d_prev, p_next = p[:-offset], d[:-offset], p[offset:]
+        p = torch.cat((p[:offset], p_prev @ k @ p_next), dim=0)
+        d = torch.cat((d[:offset], ((d_prev @ a).unsqueeze(-2) @ p_next).squeeze(-2) @ c.t() + d[offset:]), dim=0)
+        offset *= 2
+
+    # [1, B, 1, R][S, B, R, R] => [S, B, R] => [S, B, D_h]
+    return ((h_0 @ a).unsqueeze(0).unsqueeze(-2) @ p).squeeze(-2) @ c.t() + d
+
+
+def _gate_grad(gate: str, h: torch.Tensor):
+    """Derivative of the gate at the pre-activation that produced `h`, written in terms of `h`"""
+    if gate == 'tanh':
+        return 1 - h * h
+    elif gate == 'sigmoid':
+        return h * (1 - h)
+    return torch.ones_like(h)
+
+
+class CPRecurrence(torch.autograd.Function):
+    """Time loop of `h_{t+1} = g(((h_t @ a + a_0) * b'_t) @ c^T + u_t)` with a hand-written backward
+
+    Forward runs without autograd and only the hidden states are kept. Backward walks the sequence in reverse,
+    recomputes `h_t @ a + a_0` from the stored states and accumulates the factor gradients into buffers allocated
+    once, instead of keeping the `[B, R]` and `[B, D_h]` intermediates of every step.
+    """
+    @staticmethod
+    def forward(ctx, h_0: torch.Tensor, a: torch.Tensor, a_0: torch.Tensor, c: torch.Tensor, b_prime: torch.Tensor,
+                u: torch.Tensor, gate: str):
+        gate_ = {"tanh": torch.tanh_, "sigmoid": torch.sigmoid_, "identity": lambda x: x}[gate]
+        hidden_seq = h_0.new_empty(b_prime.size(0), *h_0.shape)
+        a_prime = h_0.new_empty(h_0.size(0), a.size(1))
+
+        h_t = h_0
+        for t in range(hidden_seq.size(0)):
+            if a_0 is None:
+                torch.mm(h_t, a, out=a_prime)
+            else:
+                torch.addmm(a_0, h_t, a, out=a_prime)
+            if u is None:
+                torch.mm(a_prime.mul_(b_prime[t]), c.t(), out=hidden_seq[t])
+            else:
+                torch.addmm(u[t], a_prime.mul_(b_prime[t]), c.t(), out=hidden_seq[t])
+            h_t = gate_(hidden_seq[t])
+
+        ctx.save_for_backward(h_0, a, a_0, c, b_prime, hidden_seq)
+        ctx.gate, ctx.has_u = gate, u is not None
+        return hidden_seq
+
+    @staticmethod
+    def backward(ctx, grad_hidden_seq: torch.Tensor):
+        h_0, a, a_0, c, b_prime, hidden_seq = ctx.saved_tensors
+        grad_a, grad_c = torch.zeros_like(a), torch.zeros_like(c)
+        grad_a_0 = None if a_0 is None else torch.zeros_like(a_0)
+        grad_b_prime = torch.empty_like(b_prime)
+        grad_u = torch.empty_like(hidden_seq) if ctx.has_u else None
+
+        grad_h = torch.zeros_like(h_0)
+        for t in reversed(range(hidden_seq.size(0))):
+            h_prev = h_0 if t == 0 else hidden_seq[t - 1]
+            a_prime = h_prev @ a if a_0 is None else torch.addmm(a_0, h_prev, a)  # Recomputed, [B, R]
+
+            grad_z = (grad_hidden_seq[t] + grad_h).mul_(_gate_grad(ctx.gate, hidden_seq[t]))  # [B, D_h]
+            if grad_u is not None:
+                grad_u[t] = grad_z
+
+            grad_c.addmm_(grad_z.t(), a_prime * b_prime[t])
+            grad_m = grad_z @ c  # [B, R]
+            torch.mul(grad_m, a_prime, out=grad_b_prime[t])
+            grad_a_prime = grad_m.mul_(b_prime[t])
+            grad_a.addmm_(h_prev.t(), grad_a_prime)
+            if grad_a_0 is not None:
+                grad_a_0.add_(grad_a_prime.sum(dim=0))
+            grad_h = grad_a_prime @ a.t()
+
+        return grad_h, grad_a, grad_a_0, grad_c, grad_b_prime, grad_u, None
+
+
+def cp_recurrence(h_0: torch.Tensor, a: torch.Tensor, a_0: torch.Tensor, c: torch.Tensor, b_prime: torch.Tensor,
+                  u: torch.Tensor = None, gate: str = 'tanh'):
+    """CP recurrence of CPRNN (`a_0` the bias row of `a`, no `u`) and MRNN (no `a_0`, `u` the input term) through
+    `CPRecurrence`. Runs in the dtype of `h_0`, also under autocast.
+
+    Args:
+        h_0: Initial hidden state. [B, D_h]
+        a: Hidden factor. [D_h, R]
+        a_0: Bias of the hidden projection or None. [R]
+        c: Output factor. [D_h, R]
+        b_prime: Input projection of every step. [S, B, R]
+        u: Additive term of every step or None. [S, B, D_h]
+        gate: `tanh`, `sigmoid` or `identity`
+
+    Returns:
+        hidden_seq: [S, B, D_h]
+    """
+    a, a_0, c, b_prime, u = [None if x is None else x.to(h_0.dtype) for x in (a, a_0, c, b_prime, u)]
+    with torch.autocast(device_type=h_0.device.type, enabled=False):
+        return CPRecurrence.apply(h_0, a, a_0, c, b_prime, u, gate)
+
+
+def transition_table_pays_off(vocab_size: int, hidden_size: int, rank: int, batch_size: int, element_size: int = 4,
+                              max_bytes: int = _TABLE_BYTES):
+    """Whether inference should use per-token `[D_h, D_h]` transition matrices instead of the CP factors
+
+    For token `v` the CP step is linear in `h_t` with matrix `a diag(b'_v) c^T`. With all `V` of them in a table, a
+    step is one gathered batched matvec of `D_h^2` multiply-adds per sequence, against `2 D_h R` for the factored
+    step spread over three kernels and an elementwise product. The table is used when it costs at most twice the
+    factored flops (`D_h <= 4 R`), which the single kernel makes up for at the batch sizes of generation and
+    evaluation, and when the `V D_h^2` table (vs. `R (2 D_h + V)` for the factors) plus the `B D_h^2` matrices
+    gathered at every step fit in `max_bytes`.
+
+    Args:
+        vocab_size: Size of vocabulary
+        hidden_size: Dimension of hidden features
+        rank: Rank of cp factorization
+        batch_size: Number of sequences stepped at once
+        element_size: Bytes per table entry
+        max_bytes: Memory budget of the table and the gathered matrices
+
+    Returns:
+        bool
+    """
+    table_bytes = (vocab_size + batch_size) * hidden_size * hidden_size * element_size
+    return hidden_size <= 4 * rank and table_bytes <= max_bytes
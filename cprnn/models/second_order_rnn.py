@@ -4,8 +4,84 @@ import math
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from cprnn.features.tokenizer import CharacterTokenizer
+from cprnn.models.autotune import autotune, compute_dtype
+from cprnn.models.decoders import build_decoder, decoder_topk, decoder_next
+from cprnn.models.losses import decoder_cross_entropy
+from cprnn.models.recurrence import Recurrence
+
+_SLICE_CHUNK_ELEMENTS = 2 ** 26  # Max. number of core elements gathered at once by `slice_contract`
+_KERNELS = ('slice', 'einsum', 'hidden_first', 'input_first')
+_TUNE_MAX_ELEMENTS = 2 ** 26  # Max. size of the intermediate of a kernel timed by `tune_kernel`
+
+
+class SliceContract(torch.autograd.Function):
+    """`y[b, k] = sum_i h[b, i] (w[i, x_b, k] + w[i, -1, k])` for input ids `x`, i.e. the slice kernel with a
+    hand-written backward
+
+    Indexing the core per batch chunk under autograd keeps every gathered `[b, D_h, D_h]` slice for backward and
+    gives every chunk its own core-sized gradient. Here only `h` and `x` are kept, the slices are gathered again in
+    backward, and the outer products of all chunks are accumulated (`index_add_`) into a single core gradient.
+    Written with `setup_context` so that it also runs under `torch.func.vmap`.
+    """
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(h: torch.Tensor, x: torch.LongTensor, w: torch.Tensor):
+        w_slices = w[:-1].transpose(0, 1)  # [D_i', D_h, D_h'] (view)
+        chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (w_slices.size(1) * w_slices.size(2)))
+
+        out = h @ w_slices[-1]  # The bias slice of the input mode is shared by every batch element
+        for start in range(0, h.size(0), chunk_size):
+            stop = start + chunk_size
+            slices = torch.index_select(w_slices, 0, x[start:stop])  # [b, D_h, D_h']
+            out[start:stop].unsqueeze(1).baddbmm_(h[start:stop].unsqueeze(1), slices)
+        return out
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.save_for_backward(*inputs)
+
+    @staticmethod
+    def backward(ctx, grad_out: torch.Tensor):
+        h, x, w = ctx.saved_tensors
+        w_slices = w[:-1].transpose(0, 1)
+        chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (w_slices.size(1) * w_slices.size(2)))
+
+        grad_w = torch.zeros_like(w)
+        grad_slices = grad_w[:-1].transpose(0, 1)  # Same layout as `w_slices`, written in place
+        grad_slices[-1].addmm_(h.t(), grad_out)
+        grad_h = grad_out @ w_slices[-1].t()
+        for start in range(0, h.size(0), chunk_size):
+            stop = start + chunk_size
+            g, h_c, x_c = grad_out[start:stop], h[start:stop], x[start:stop]
+
+            # [b, D_h, D_h'][b, D_h', 1] => [b, D_h]
+            slices = torch.index_select(w_slices, 0, x_c)
+            grad_h[start:stop].unsqueeze(2).baddbmm_(slices, g.unsqueeze(2))
+
+            # Outer products [b, D_h, D_h'] summed into the slices of their inputs
+            grad_slices.index_add_(0, x_c, torch.bmm(h_c.unsqueeze(2), g.unsqueeze(1)))
+
+        return grad_h, None, grad_w
+
+
+def slice_contract(h: torch.Tensor, x: torch.LongTensor, w: torch.Tensor):
+    """Contracts `h` with the slices of the core `w` selected by the input ids `x` through `SliceContract`, without
+    the bias row of the hidden mode. Runs in the dtype of `h`, also under autocast.
+
+    Args:
+        h: Hidden state. [B, D_h]
+        x: Input ids. [B]
+        w: Core. [D_h + 1, D_i + 1, D_h']
+
+    Returns:
+        [B, D_h']
+    """
+    with torch.autocast(device_type=h.device.type, enabled=False):
+        return SliceContract.apply(h, x, w.to(h.dtype))
 
 
 class SecondOrderRNN(nn.Module):
@@ -19,13 +95,28 @@ class SecondOrderRNN(nn.Module):
         tokenizer: Character tokenizer
         batch_first: Whether to use batch first or not
         dropout: Dropout rate
+        kernel: Core contraction. `slice` gathers the `w[:, x_b, :]` slice of every batch element and contracts it
+            with `h_t` in a batched matmul (one-hot inputs only). `einsum` leaves the order to torch.einsum,
+            `hidden_first` contracts the hidden mode of the core first and `input_first` the input mode. Embedding
+            inputs use `einsum` unless autotuned.
+        compile: Whether to run the time loop through torch.compile
+        unroll: Number of timesteps per compiled graph
+        checkpoint_segments: Number of time segments wrapped in activation checkpointing (0 disables it)
+        autotune: Whether to benchmark the kernels on first use of each batch size and use the fastest
+        decoder: Output layer, `linear` or `adaptive` (adaptive softmax, for large word-level vocabularies)
+        unigram_counts: Token counts of the training data, sizes the adaptive softmax clusters
 
     """
     def __init__(self, input_size: int, hidden_size: int, vocab_size: int, use_embedding: bool = False,
                  gate: str = 'tanh', tokenizer: CharacterTokenizer = None, batch_first: bool = True,
-                 dropout: float = 0.5, **kwargs):
+                 dropout: float = 0.5, kernel: str = 'slice', compile: bool = False, unroll: int = 8,
+                 checkpoint_segments: int = 0, autotune: bool = False, decoder: str = 'linear',
+                 unigram_counts: torch.Tensor = None, **kwargs):
         super().__init__()
 
+        if kernel not in _KERNELS:
+            raise ValueError("Unknown kernel `{}`. Expected one of {}".format(kernel, list(_KERNELS)))
+
         self.use_embedding = use_embedding
         self.dropout = dropout
         self.batch_first = batch_first
@@ -34,6 +125,10 @@ class SecondOrderRNN(nn.Module):
         self.hidden_size = hidden_size
         self.vocab_size = vocab_size
         self.gate = {"tanh": torch.tanh, "sigmoid": torch.sigmoid, "identity": lambda x: x}[gate]
+        self.gate_ = {"tanh": torch.tanh_, "sigmoid": torch.sigmoid_, "identity": lambda x: x}[gate]
+        self.kernel = 'einsum' if use_embedding and kernel == 'slice' else kernel
+        self.autotune = autotune
+        self._tuned_plans = dict()  # (batch size, compute dtype, backward) -> kernel, see `tune_kernel`
 
         # Define embedding and decoder layers
         if use_embedding:
@@ -44,20 +139,136 @@ class SecondOrderRNN(nn.Module):
             self.embedding = lambda x: torch.nn.functional.one_hot(x, vocab_size).float()
             self.input_size = vocab_size
 
-        self.decoder = nn.Sequential(
-            nn.Dropout(self.dropout),
-            nn.Linear(self.hidden_size, self.vocab_size)
+        self.decoder = build_decoder(
+            decoder, self.hidden_size, self.vocab_size, self.dropout, unigram_counts=unigram_counts
         )
 
         # Encoder using CP factors
-        self.w = nn.Parameter(torch.Tensor(self.hidden_size + 1, self.input_size + 1, self.hidden_size))
+        self.init_core(**kwargs)
         self.init_weights()
 
+        self.recurrence = Recurrence(compile=compile, unroll=unroll, checkpoint_segments=checkpoint_segments)
+
+    def init_core(self, **kwargs):
+        """Allocates the core `w`. [D_h + 1, D_i + 1, D_h]"""
+        self.w = nn.Parameter(torch.Tensor(self.hidden_size + 1, self.input_size + 1, self.hidden_size))
+
     def init_weights(self):
         stdv = 1.0 / math.sqrt(self.hidden_size)
         for weight in self.parameters():
             weight.data.uniform_(-stdv, stdv)
 
+    def slice_contract(self, h_t: torch.Tensor, x_t: torch.LongTensor):
+        """Contracts `h_t` with the core for one-hot inputs `x_t`, without the bias row of the hidden mode.
+
+        Only the `w[:, x_b, :]` slice of each batch element takes part, which is `D_in` times fewer FLOPs than
+        contracting the full core with the one-hot vector. Slices are gathered in batch chunks of at most
+        `_SLICE_CHUNK_ELEMENTS` elements so that `[B, D_h, D_h]` is never materialized at once for large `D_h`.
+        When the core is trained, the contraction goes through `SliceContract`, whose backward accumulates one core
+        gradient per step instead of one per chunk.
+
+        Args:
+            h_t: Hidden state. [B, D_h]
+            x_t: Input ids. [B]
+
+        Returns:
+            [B, D_h]
+        """
+        if torch.is_grad_enabled() and isinstance(self.w, torch.Tensor) and self.w.requires_grad:
+            return slice_contract(h_t, x_t, self.w)
+
+        chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (self.hidden_size * self.hidden_size))
+
+        # The core is only ever indexed, so a quantized `w` dequantizes the gathered slices and nothing else.
+        # The bias slice of the input mode is shared by every batch element
+        out = h_t @ self.w[:-1, -1]  # [B, D_h][D_h, D_h] => [B, D_h]
+        chunks = []
+        for start in range(0, h_t.size(0), chunk_size):
+            h_chunk = h_t[start:start + chunk_size].unsqueeze(1)  # [b, 1, D_h]
+            w_chunk = self.w[:-1, x_t[start:start + chunk_size]].transpose(0, 1)  # [b, D_h, D_h]
+            chunks.append(torch.bmm(h_chunk, w_chunk).squeeze(1))
+
+        return out + torch.cat(chunks, dim=0)
+
+    def contract(self, kernel: str, h_t: torch.Tensor, x_t: torch.Tensor):
+        """Contracts `h_t` and `x_t` with the core, without the bias row of the hidden mode
+
+        Args:
+            kernel: One of `slice`, `einsum`, `hidden_first`, `input_first`
+            h_t: Hidden state. [B, D_h]
+            x_t: Input ids [B] for the slice kernel, bias-augmented inputs [B, D_i'] otherwise
+
+        Returns:
+            [B, D_h]
+        """
+        if kernel == 'slice':
+            return self.slice_contract(h_t, x_t)
+        elif kernel == 'hidden_first':
+            # [B, D_h][D_h, D_i' * D_h] => [B, D_i', D_h], then [B, 1, D_i'][B, D_i', D_h] => [B, D_h]
+            h_w = (h_t @ self.w[:-1].reshape(self.hidden_size, -1)).view(h_t.size(0), -1, self.w.size(-1))
+            return torch.bmm(x_t.unsqueeze(1), h_w).squeeze(1)
+        elif kernel == 'input_first':
+            # [B, D_i'][D_h, D_i', D_h] => [B, D_h, D_h], then [B, 1, D_h][B, D_h, D_h] => [B, D_h]
+            x_w = torch.einsum("bj,ijk->bik", x_t, self.w[:-1])
+            return torch.bmm(h_t.unsqueeze(1), x_w).squeeze(1)
+        return torch.einsum("bi,bj,ijk->bk", h_t, x_t, self.w[:-1])
+
+    def _step(self, h_t: torch.Tensor, x_w_t: torch.Tensor, x_t: torch.Tensor):
+        # `x_t` holds input ids [B] for the slice kernel and the bias-augmented inputs [B, D_i'] otherwise
+        return self.gate(self.contract(self.kernel, h_t, x_t) + x_w_t)
+
+    def _step_into(self, out: torch.Tensor, h_t: torch.Tensor, x_w_t: torch.Tensor, x_t: torch.LongTensor,
+                   w_chunk: torch.Tensor):
+        # Same as `_step` with the slice kernel, written into `out`. Core slices are gathered into `w_chunk`
+        # [b, D_h, D_h] and accumulated in place by baddbmm.
+        w_slices = self.w[:-1].transpose(0, 1)  # [D_i', D_h, D_h] (view)
+        torch.addmm(x_w_t, h_t, self.w[:-1, -1], out=out)
+        for start in range(0, h_t.size(0), w_chunk.size(0)):
+            x_chunk = x_t[start:start + w_chunk.size(0)]
+            slices = w_chunk[:x_chunk.size(0)]
+            torch.index_select(w_slices, 0, x_chunk, out=slices)
+            out[start:start + x_chunk.size(0)].unsqueeze(1).baddbmm_(
+                h_t[start:start + x_chunk.size(0)].unsqueeze(1), slices
+            )
+        self.gate_(out)
+
+    def tune_kernel(self, h_t: torch.Tensor, x_t: torch.LongTensor):
+        """Fastest core contraction for the batch size and compute dtype of `h_t`, resolved once per model with
+        `autotune` (timed forward and backward when the core is trained)
+
+        `hidden_first` materializes a `[B, D_i', D_h]` and `input_first` a `[B, D_h, D_h]` intermediate for the whole
+        batch (2 GB at B=128 and D_h=2048 for `input_first`). They are only timed while that intermediate has at most
+        `_TUNE_MAX_ELEMENTS` elements, so that tuning does not run out of memory.
+
+        Args:
+            h_t: Hidden state. [B, D_h]
+            x_t: Input ids of the first step. [B]
+
+        Returns:
+            Name of the kernel
+        """
+        backward = torch.is_grad_enabled() and isinstance(self.w, torch.Tensor) and self.w.requires_grad
+        key = (h_t.size(0), compute_dtype(h_t.device, h_t.dtype), backward)
+        if key not in self._tuned_plans:
+            # Slices can only be gathered for one-hot inputs. Detached copies, so that timing the backward leaves the
+            # graph of the batch alone
+            h_0 = h_t.detach().requires_grad_(backward)
+            x_0 = torch.cat((self.embedding(x_t), torch.ones(h_t.size(0), 1).to(h_t.device)), dim=1).detach()
+            intermediate = {
+                'hidden_first': h_t.size(0) * (self.input_size + 1) * self.hidden_size,
+                'input_first': h_t.size(0) * self.hidden_size * self.hidden_size
+            }
+            kernels = [
+                k for k in _KERNELS
+                if (k != 'slice' or not self.use_embedding) and intermediate.get(k, 0) <= _TUNE_MAX_ELEMENTS
+            ]
+            candidates = {k: (lambda k=k: self.contract(k, h_0, x_t if k == 'slice' else x_0)) for k in kernels}
+            self._tuned_plans[key] = autotune(
+                "2rnn", candidates, shape={"B": h_t.size(0), "H": self.hidden_size, "I": self.input_size},
+                device=h_t.device, dtype=h_t.dtype, grad_inputs=(h_0, self.w) if backward else None
+            )
+        return self._tuned_plans[key]
+
     def init_hidden(self, batch_size, device=torch.device('cpu')):
         h = torch.zeros(batch_size, self.hidden_size).to(device)
         return h
@@ -74,9 +285,8 @@ class SecondOrderRNN(nn.Module):
             else:
                 x = inp.to(device)
 
-            output, init_states = self.forward(x, init_states)
-            output_conf = torch.softmax(output, dim=-1)  # [S, B, Din]
-            output_topk = torch.topk(output_conf, top_k, dim=-1)  # [S, B, K]
+            hidden_seq, init_states = self.encode(x, init_states)
+            output_topk = decoder_topk(self.decoder, hidden_seq, top_k)  # [S, B, K]
 
             prob = output_topk[0].reshape(-1) / output_topk[0].reshape(-1).sum()
             k_star = np.random.choice(np.arange(top_k), p=prob.cpu().numpy())
@@ -88,7 +298,37 @@ class SecondOrderRNN(nn.Module):
             else:
                 return output_ids, init_states
 
-    def forward(self, inp: torch.LongTensor, init_states: torch.Tensor = None):
+    def step(self, token_ids: torch.LongTensor, state: torch.Tensor = None, top_k: int = None):
+        """Single recurrent update for generation, without the sequence bookkeeping of `forward`
+
+        Args:
+            token_ids: Input ids. [B]
+            state: Hidden state. [B, D_h] (zeros if None)
+            top_k: If set, the probabilities and ids of the `top_k` most likely tokens are returned instead of the
+                logits (`decoder_topk`)
+
+        Returns:
+            logits: [B, D_out], or `(probs, ids)`, each [B, top_k]
+            state: Next hidden state. [B, D_h]
+        """
+        batch_size, device = token_ids.size(0), token_ids.device
+        if state is None:
+            state = self.init_hidden(batch_size, device=device)
+
+        if self.use_embedding:
+            x_w = self.embedding(token_ids) @ self.w[-1, :-1] + self.w[-1, -1]
+        else:
+            x_w = F.embedding(token_ids, self.w[-1, :-1]) + self.w[-1, -1]
+
+        if self.kernel == 'slice':
+            x_prime = token_ids
+        else:
+            x_prime = torch.cat((self.embedding(token_ids), torch.ones(batch_size, 1).to(device)), dim=1)
+        state = self._step(state, x_w, x_prime)
+        return decoder_next(self.decoder, state, top_k), state
+
+    def encode(self, inp: torch.LongTensor, init_states: torch.Tensor = None):
+        """Runs the recurrence. Returns hidden states `[S, B, D_h]` (time first) and the last hidden state"""
 
         # print("In gpu {} | Shape: {}".format(torch.cuda.current_device(), inp.shape))
 
@@ -98,31 +338,73 @@ class SecondOrderRNN(nn.Module):
         if len(inp.shape) != 2:
             raise ValueError("Expected input tensor of order 2, but got order {} tensor instead".format(len(inp.shape)))
 
-        x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
-        sequence_length, batch_size,  _ = x.size()
-        hidden_seq = []
-
-        device = x.device
+        sequence_length, batch_size = inp.size()
+        device = inp.device
 
         if init_states is None:
-            h_t = torch.zeros(batch_size, self.hidden_size).to(x.device)
+            h_t = torch.zeros(batch_size, self.hidden_size).to(device)
 
         else:
             h_t = init_states
             h_t = h_t.to(device)
 
-        for t in range(sequence_length):
-            x_t = x[t, :, :]  # [B, D_in]
+        # The bias row of the hidden mode only sees the input, so it is done for the whole sequence at once
+        # [S, B, D_i'][D_i', D_h] => [S, B, D_h]
+        if self.use_embedding:
+            x_w = self.embedding(inp) @ self.w[-1, :-1] + self.w[-1, -1]
+        else:
+            # one_hot(x) @ w[-1] is a row lookup; its backward only accumulates into the gathered rows
+            x_w = F.embedding(inp, self.w[-1, :-1]) + self.w[-1, -1]
+
+        if self.autotune:
+            self.kernel = self.tune_kernel(h_t, inp[0])
+
+        if self.kernel == 'slice':
+            x_prime = inp
+        else:
+            # [S, B, D_i] => [S, B, D_i']
+            x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
+            x_prime = torch.cat((x, torch.ones(sequence_length, batch_size, 1).to(device)), dim=2)
+
+        # Quantized cores are only dequantized slice by slice in `slice_contract`, so they keep the regular loop.
+        # Sharded cores (`TensorParallelSecondOrderRNN`) gather the hidden state between steps
+        if self.kernel == 'slice' and isinstance(self.w, torch.Tensor) and self.w.size(-1) == self.hidden_size \
+                and self.recurrence.inplace_enabled():
+            # Inference writes into preallocated buffers, nothing is allocated per timestep
+            chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (self.hidden_size * self.hidden_size))
+            w_chunk = h_t.new_empty(min(chunk_size, batch_size), self.hidden_size, self.hidden_size)
+            hidden_seq, h_t = self.recurrence.inplace(self._step_into, h_t, x_w, x_prime, workspace=(w_chunk,))
+        else:
+            hidden_seq, h_t = self.recurrence(self._step, h_t, x_w, x_prime)  # [S, B, D_h]
+        return hidden_seq, h_t
 
-            h_prime = torch.cat((h_t, torch.ones(batch_size, 1).to(device)), dim=1)  # [B, D_h][D_h, R] => [B, R]
-            x_prime = torch.cat((x_t, torch.ones(batch_size, 1).to(device)), dim=1)   # [B, D_i'][D_i', R] => [B, R]
-            h_t = self.gate(torch.einsum("bi,bj,ijk->bk", h_prime, x_prime, self.w))
-            hidden_seq.append(h_t.unsqueeze(0))
+    def forward(self, inp: torch.LongTensor, init_states: torch.Tensor = None, targets: torch.LongTensor = None):
+        """Returns logits and the last hidden state. With `targets`, returns the loss instead (see `forward_loss`)"""
+        if targets is not None:
+            return self.forward_loss(inp, targets, init_states)
 
-        hidden_seq = torch.cat(hidden_seq, dim=0)
-        output = self.decoder(hidden_seq.contiguous())
+        hidden_seq, h_t = self.encode(inp, init_states)
+        output = self.decoder(hidden_seq)
 
         if self.batch_first:
             output = output.transpose(0, 1)
 
-        return output, h_t
\ No newline at end of file
+        return output, h_t
+
+    def forward_loss(self, inp: torch.LongTensor, targets: torch.LongTensor, init_states: torch.Tensor = None):
+        """Mean cross-entropy of the predictions, computed over chunks of positions so that the `[B, S, D_out]`
+        logits are never materialized
+
+        Args:
+            inp: Input ids. [B, S] if batch_first else [S, B]
+            targets: Target ids, same shape as `inp`
+            init_states: Initial hidden state
+
+        Returns:
+            loss: Mean loss (scalar)
+            h_t: Last hidden state
+        """
+        hidden_seq, h_t = self.encode(inp, init_states)
+        if self.batch_first:
+            targets = targets.transpose(0, 1)
+        return decoder_cross_entropy(self.decoder, hidden_seq, targets), h_t
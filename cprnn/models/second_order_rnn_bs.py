@@ -0,0 +1,222 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from cprnn.models.decoders import decoder_next
+from cprnn.models.second_order_rnn import SecondOrderRNN, _SLICE_CHUNK_ELEMENTS
+
+
+class BlockSliceContract(torch.autograd.Function):
+    """Block-sparse counterpart of `SliceContract`: contracts `h` with the kept blocks of the inputs `x` (and of the
+    input bias), with a hand-written backward
+
+    Only `h` and `x` are kept for backward, the `[nnz, b, block_size, block_size]` blocks of the inputs are gathered
+    again there, and the outer products of all batch chunks are accumulated (`index_add_`) into a single gradient
+    of the kept blocks instead of one per chunk.
+    """
+    generate_vmap_rule = True
+
+    @staticmethod
+    def forward(h: torch.Tensor, x: torch.LongTensor, blocks: torch.Tensor, block_rows: torch.LongTensor,
+                block_cols: torch.LongTensor):
+        batch_size, n_kept, block_size = h.size(0), blocks.size(0), blocks.size(-1)
+        n_blocks = h.size(1) // block_size
+        chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (n_kept * block_size * block_size))
+
+        # [B, D_h] => [nnz, B, block_size], the input block of every kept block
+        h_blocks = h.reshape(batch_size, n_blocks, block_size).transpose(0, 1)[block_rows]
+        partial = torch.bmm(h_blocks, blocks[:, -1])  # Input bias
+        for start in range(0, batch_size, chunk_size):
+            stop = start + chunk_size
+            w_chunk = torch.index_select(blocks, 1, x[start:stop])  # [nnz, b, block_size, block_size]
+            partial[:, start:stop] += torch.matmul(h_blocks[:, start:stop].unsqueeze(2), w_chunk).squeeze(2)
+
+        # Sum the products into their output blocks, [n_out, B, block_size] => [B, D_h]
+        out = h.new_zeros(n_blocks, batch_size, block_size).index_add_(0, block_cols, partial)
+        return out.transpose(0, 1).reshape(batch_size, -1)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.save_for_backward(*inputs)
+
+    @staticmethod
+    def backward(ctx, grad_out: torch.Tensor):
+        h, x, blocks, block_rows, block_cols = ctx.saved_tensors
+        batch_size, n_kept, block_size = h.size(0), blocks.size(0), blocks.size(-1)
+        n_blocks = h.size(1) // block_size
+        chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (n_kept * block_size * block_size))
+
+        h_blocks = h.reshape(batch_size, n_blocks, block_size).transpose(0, 1)[block_rows]  # [nnz, B, block_size]
+        g_blocks = grad_out.reshape(batch_size, n_blocks, block_size).transpose(0, 1)[block_cols]
+
+        grad_blocks = torch.zeros_like(blocks)
+        grad_blocks[:, -1] = torch.bmm(h_blocks.transpose(1, 2), g_blocks)
+        grad_h_blocks = torch.bmm(g_blocks, blocks[:, -1].transpose(1, 2))
+        for start in range(0, batch_size, chunk_size):
+            stop = start + chunk_size
+            g, h_c, x_c = g_blocks[:, start:stop], h_blocks[:, start:stop], x[start:stop]
+
+            w_chunk = torch.index_select(blocks, 1, x_c)
+            grad_h_blocks[:, start:stop] += torch.matmul(w_chunk, g.unsqueeze(3)).squeeze(3)
+
+            # Outer products [nnz, b, block_size, block_size] summed into the blocks of their inputs
+            grad_blocks.index_add_(1, x_c, h_c.unsqueeze(3) * g.unsqueeze(2))
+
+        grad_h = h.new_zeros(n_blocks, batch_size, block_size).index_add_(0, block_rows, grad_h_blocks)
+        return grad_h.transpose(0, 1).reshape(batch_size, -1), None, grad_blocks, None, None
+
+
+class BlockSparseSecondOrderRNN(SecondOrderRNN):
+    """Second Order RNN whose core is block-sparse in its two hidden modes. Outputs logits (no softmax)
+
+    The hidden modes of `w[:-1]` [D_h, D_i + 1, D_h] are cut in `block_size x block_size` blocks and only a `density`
+    fraction of the `(D_h / block_size)^2` (input, output) blocks is stored, each for every input `[D_i + 1]`. A step
+    gathers the kept blocks of the inputs, multiplies them with the matching blocks of `h_t` and sums the products
+    into their output blocks, so FLOPs, gathered memory and optimizer states all scale with `density`. The bias row
+    of the hidden mode (`w[-1]`, which only sees the input) stays dense.
+
+    The kept blocks are drawn at random when the model is built, or chosen by magnitude from a trained dense core
+    with `prune_` (see `compress.py prune`).
+
+    Takes the arguments of `SecondOrderRNN`, and:
+
+    Args:
+        block_size: Size of the blocks along each hidden mode, must divide `hidden_size`
+        density: Fraction of blocks kept
+
+    """
+    def init_core(self, block_size: int = 64, density: float = 0.25, **kwargs):
+        """Allocates the kept blocks [nnz, D_i + 1, block_size, block_size] and their block coordinates"""
+        if self.hidden_size % block_size != 0:
+            raise ValueError("Block size {} does not divide hidden size {}".format(block_size, self.hidden_size))
+
+        if not 0 < density <= 1:
+            raise ValueError("Density must be in (0, 1], got {}".format(density))
+
+        self.block_size = block_size
+        self.density = density
+        self.n_blocks = self.hidden_size // block_size
+        n_kept = max(1, round(density * self.n_blocks ** 2))
+
+        index = torch.randperm(self.n_blocks ** 2)[:n_kept].sort().values
+        self.register_buffer('block_rows', index // self.n_blocks)  # Input block of each kept block
+        self.register_buffer('block_cols', index % self.n_blocks)  # Output block of each kept block
+        self.blocks = nn.Parameter(torch.Tensor(n_kept, self.input_size + 1, block_size, block_size))
+        self.w_bias = nn.Parameter(torch.Tensor(self.input_size + 1, self.hidden_size))
+
+    def prune_(self, w: torch.Tensor):
+        """Keeps the blocks of the dense core `w` [D_h + 1, D_i + 1, D_h] with the largest norms (in place)"""
+        n_blocks, block_size = self.n_blocks, self.block_size
+        with torch.no_grad():
+            # [D_h, D_i', D_h] => [n_in, n_out, D_i', block_size, block_size]
+            core = w[:-1].reshape(n_blocks, block_size, -1, n_blocks, block_size).permute(0, 3, 2, 1, 4)
+            norms = core.pow(2).sum(dim=(2, 3, 4)).flatten()
+            index = norms.topk(self.blocks.size(0)).indices.sort().values
+
+            self.block_rows.copy_(index // n_blocks)
+            self.block_cols.copy_(index % n_blocks)
+            self.blocks.copy_(core.reshape(n_blocks * n_blocks, *core.shape[2:])[index])
+            self.w_bias.copy_(w[-1])
+        return self
+
+    def block_contract(self, h_t: torch.Tensor, x_t: torch.Tensor):
+        """Contracts `h_t` and `x_t` with the kept blocks of the core
+
+        Args:
+            h_t: Hidden state. [B, D_h]
+            x_t: Input ids [B] for one-hot inputs, bias-augmented inputs [B, D_i'] for embeddings
+
+        Returns:
+            [B, D_h]
+        """
+        if not self.use_embedding and torch.is_grad_enabled() and self.blocks.requires_grad:
+            # One block gradient per step instead of one per batch chunk, see `BlockSliceContract`
+            with torch.autocast(device_type=h_t.device.type, enabled=False):
+                return BlockSliceContract.apply(
+                    h_t, x_t, self.blocks.to(h_t.dtype), self.block_rows, self.block_cols
+                )
+
+        batch_size, n_kept, block_size = h_t.size(0), self.blocks.size(0), self.block_size
+        chunk_size = max(1, _SLICE_CHUNK_ELEMENTS // (n_kept * block_size * block_size))
+
+        # [B, D_h] => [nnz, B, 1, block_size], the input block of every kept block
+        h_blocks = h_t.reshape(batch_size, self.n_blocks, block_size).transpose(0, 1)[self.block_rows].unsqueeze(2)
+
+        partial = []  # [nnz, b, block_size] per batch chunk
+        for start in range(0, batch_size, chunk_size):
+            h_chunk = h_blocks[:, start:start + chunk_size]
+            if self.use_embedding:
+                # The inputs carry the bias, [b, D_i'][nnz, D_i', block_size, block_size] => [nnz, b, ...]
+                w_chunk = torch.einsum("bj,njkl->nbkl", x_t[start:start + chunk_size], self.blocks)
+                products = torch.matmul(h_chunk, w_chunk)
+            else:
+                # Blocks of the inputs [nnz, b, block_size, block_size] and of the input bias [nnz, 1, ...]
+                products = torch.matmul(h_chunk, self.blocks[:, x_t[start:start + chunk_size]]) + \
+                    torch.matmul(h_chunk, self.blocks[:, -1].unsqueeze(1))
+            partial.append(products.squeeze(2))
+
+        # Sum the products into their output blocks, [n_out, B, block_size] => [B, D_h]
+        out = h_t.new_zeros(self.n_blocks, batch_size, block_size)
+        out = out.index_add(0, self.block_cols, torch.cat(partial, dim=1))
+        return out.transpose(0, 1).reshape(batch_size, self.hidden_size)
+
+    def _step(self, h_t: torch.Tensor, x_w_t: torch.Tensor, x_t: torch.Tensor):
+        return self.gate(self.block_contract(h_t, x_t) + x_w_t)
+
+    def step(self, token_ids: torch.LongTensor, state: torch.Tensor = None, top_k: int = None):
+        """Single recurrent update for generation, without the sequence bookkeeping of `forward`
+
+        Args:
+            token_ids: Input ids. [B]
+            state: Hidden state. [B, D_h] (zeros if None)
+            top_k: If set, the probabilities and ids of the `top_k` most likely tokens are returned instead of the
+                logits (`decoder_topk`)
+
+        Returns:
+            logits: [B, D_out], or `(probs, ids)`, each [B, top_k]
+            state: Next hidden state. [B, D_h]
+        """
+        batch_size, device = token_ids.size(0), token_ids.device
+        if state is None:
+            state = self.init_hidden(batch_size, device=device)
+
+        if self.use_embedding:
+            x_prime = torch.cat((self.embedding(token_ids), torch.ones(batch_size, 1).to(device)), dim=1)
+            x_w = x_prime @ self.w_bias
+        else:
+            x_prime = token_ids
+            x_w = F.embedding(token_ids, self.w_bias[:-1]) + self.w_bias[-1]
+        state = self._step(state, x_w, x_prime)
+        return decoder_next(self.decoder, state, top_k), state
+
+    def encode(self, inp: torch.LongTensor, init_states: torch.Tensor = None):
+        """Runs the recurrence. Returns hidden states `[S, B, D_h]` (time first) and the last hidden state"""
+
+        if self.batch_first:
+            inp = inp.transpose(0, 1)
+
+        if len(inp.shape) != 2:
+            raise ValueError("Expected input tensor of order 2, but got order {} tensor instead".format(len(inp.shape)))
+
+        sequence_length, batch_size = inp.size()
+        device = inp.device
+
+        if init_states is None:
+            h_t = torch.zeros(batch_size, self.hidden_size).to(device)
+
+        else:
+            h_t = init_states
+            h_t = h_t.to(device)
+
+        # The bias row of the hidden mode only sees the input, so it is done for the whole sequence at once
+        # [S, B, D_i'][D_i', D_h] => [S, B, D_h]
+        if self.use_embedding:
+            x = self.embedding(inp)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
+            x_prime = torch.cat((x, torch.ones(sequence_length, batch_size, 1).to(device)), dim=2)
+            x_w = x_prime @ self.w_bias
+        else:
+            x_prime = inp
+            x_w = F.embedding(inp, self.w_bias[:-1]) + self.w_bias[-1]
+
+        hidden_seq, h_t = self.recurrence(self._step, h_t, x_w, x_prime)  # [S, B, D_h]
+        return hidden_seq, h_t
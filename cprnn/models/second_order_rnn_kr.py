@@ -3,17 +3,90 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 
+_BILINEAR_CHUNK_ELEMENTS = 2 ** 24  # Max. number of elements of the [b, D_h * D_i] intermediates of `Bilinear`
+
+
+class Bilinear(torch.autograd.Function):
+    """`y[b, k] = sum_ij A[k, i, j] x[b, i] h[b, j]`, i.e. `F.linear(khatri_rao(x, h), A.view(D_h, -1))` without
+    forming the Khatri-Rao product
+
+    Forward contracts `h` with `A` viewed as `[D_h * D_i, D_h]`, then the result with `x`. Only `x` and `h` are kept
+    for backward instead of the `[B, D_i * D_h]` product of every step. The `[b, D_h * D_i]` intermediates of both
+    passes are computed over chunks of the batch, so their size does not grow with the batch.
+    """
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, h: torch.Tensor, a: torch.Tensor):
+        hidden_size, input_size = a.size(0), a.size(1)
+        a_flat = a.reshape(hidden_size * input_size, a.size(2))
+        chunk_size = max(1, _BILINEAR_CHUNK_ELEMENTS // (hidden_size * input_size))
+
+        out = h.new_empty(h.size(0), hidden_size)
+        for start in range(0, h.size(0), chunk_size):
+            stop = start + chunk_size
+            # [b, D_h][D_h, D_h * D_i] => [b, D_h, D_i], then [b, D_h, D_i][b, D_i, 1] => [b, D_h]
+            a_h = (h[start:stop] @ a_flat.t()).view(-1, hidden_size, input_size)
+            out[start:stop] = torch.bmm(a_h, x[start:stop].unsqueeze(2)).squeeze(2)
+
+        ctx.save_for_backward(x, h, a)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out: torch.Tensor):
+        x, h, a = ctx.saved_tensors
+        hidden_size, input_size = a.size(0), a.size(1)
+        a_flat = a.reshape(hidden_size * input_size, a.size(2))
+        chunk_size = max(1, _BILINEAR_CHUNK_ELEMENTS // (hidden_size * input_size))
+
+        grad_x, grad_h, grad_a = torch.empty_like(x), torch.empty_like(h), torch.zeros_like(a_flat)
+        for start in range(0, h.size(0), chunk_size):
+            stop = start + chunk_size
+            g, x_c, h_c = grad_out[start:stop], x[start:stop], h[start:stop]
+
+            # Gradient w.r.t. `A @ h` [b, D_h * D_i], which gives the ones of `h` and `A`
+            g_x = (g.unsqueeze(2) * x_c.unsqueeze(1)).view(-1, hidden_size * input_size)
+            grad_h[start:stop] = g_x @ a_flat
+            grad_a.addmm_(g_x.t(), h_c)
+
+            # [b, 1, D_h][b, D_h, D_i] => [b, D_i], with `A @ h` recomputed
+            a_h = (h_c @ a_flat.t()).view(-1, hidden_size, input_size)
+            grad_x[start:stop] = torch.bmm(g.unsqueeze(1), a_h).squeeze(1)
+
+        return grad_x, grad_h, grad_a.view_as(a)
+
+
+def bilinear(x: torch.Tensor, h: torch.Tensor, a: torch.Tensor):
+    """Contracts the core `a` with the input and the hidden state through `Bilinear`. Runs in the dtype of `h`.
+
+    Args:
+        x: Input. [B, D_i]
+        h: Hidden state. [B, D_h]
+        a: Core, indexed as (output, input, hidden). [D_h, D_i, D_h]
+
+    Returns:
+        [B, D_h]
+    """
+    x, a = x.to(h.dtype), a.to(h.dtype)
+    with torch.autocast(device_type=h.device.type, enabled=False):
+        return Bilinear.apply(x, h, a)
+
 
 class SecondOrderRNNKR(nn.Module):
     """
     Implements a 2RNN : 
     h_t = phi(A (h^T \otimes x^T)^T + Ux + Vh + b)
     y_t = sigma(W h_t + c)
+
+    `A (h^T \otimes x^T)^T` is computed by `bilinear` with `A` viewed as [D_h, D_i, D_h], set `contraction` to
+    `khatri_rao` to form the [B, D_i * D_h] product instead (reference, slower and keeps it for backward).
     """
 
     def __init__(self, input_size: int, hidden_size: int, vocab_size: int,
-                 embedding: nn.Embedding = None, **kwargs):
+                 embedding: nn.Embedding = None, contraction: str = 'bilinear', **kwargs):
         super().__init__()
+        if contraction not in ('bilinear', 'khatri_rao'):
+            raise ValueError("Unknown contraction `{}`, expected `bilinear` or `khatri_rao`".format(contraction))
+
+        self.contraction = contraction
         self.gate = nn.ReLU()
         self.hidden_size = hidden_size
         self.hidden_size = hidden_size
@@ -46,22 +119,41 @@ class SecondOrderRNNKR(nn.Module):
         for weight in self.parameters():
             weight.data.uniform_(-k, k)
 
-    def init_hidden(self, batch_size: int) -> torch.Tensor:
+    def init_hidden(self, batch_size: int, device=torch.device('cpu')) -> torch.Tensor:
         h_0 = torch.normal(mean = 0, std = 0.00001, size=(batch_size, self.hidden_size))
-        if torch.cuda.is_available(): h_0.cuda()
-        return h_0
+        return h_0.to(device)
 
     def recurrent_layer(self, x_input: torch.Tensor, hidden: torch.Tensor) -> torch.Tensor:
         """
         x_input.shape  = (batch_size, input_size) 
         hidden/h.shape = (batch_size, hidden_size) 
         """
-        khatri_rao_input = self.khatri_rao(x_input, hidden)
-        h = self.gate(F.linear(khatri_rao_input, self.A, bias=None)
+        if self.contraction == 'khatri_rao':
+            a_x_h = F.linear(self.khatri_rao(x_input, hidden), self.A, bias=None)
+        else:
+            a_x_h = bilinear(x_input, hidden, self.A.view(self.hidden_size, self.input_size, self.hidden_size))
+        h = self.gate(a_x_h
                         + F.linear(hidden, self.V, self.b)  
                         + F.linear(x_input.float(), self.U, bias=None))
         return h 
 
+    def step(self, token_ids: torch.LongTensor, hidden: torch.Tensor = None, top_k: int = None):
+        """
+        Single recurrent update for generation, without the sequence bookkeeping of `forward`
+        token_ids.shape = (batch_size,)
+        hidden.shape = (batch_size, hidden_size) -> zeros if None
+        Returns logits (batch_size, vocab_size), or the probabilities and ids (batch_size, top_k) of the `top_k` most
+        likely tokens if `top_k` is set, and the next hidden state
+        """
+        x = self.embedding(token_ids)
+        if hidden is None:
+            hidden = torch.zeros(token_ids.size(0), self.hidden_size).to(x.device)
+        hidden = self.recurrent_layer(x, hidden)
+        logits = F.linear(hidden, self.W, self.c)
+        if top_k is not None:
+            return torch.topk(torch.softmax(logits, dim=-1), top_k, dim=-1), hidden
+        return logits, hidden
+
     def forward(self, inputs: torch.Tensor, hidden: torch.Tensor = None) -> torch.Tensor:
         """ 
         inputs.shape = (seq_len, batch_size)
@@ -77,7 +169,7 @@ class SecondOrderRNNKR(nn.Module):
             ))
 
         inputs = self.embedding(inputs)  # [S, B, D_in] (i.e. [sequence, batch, input_size])
-        batch_size, sequence_length, _ = inputs.size()
+        sequence_length, batch_size, _ = inputs.size()
 
         if hidden is None:
             hidden = torch.zeros(batch_size, self.hidden_size).to(inputs.device)
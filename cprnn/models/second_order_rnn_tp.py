@@ -0,0 +1,60 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+from cprnn.models.second_order_rnn import SecondOrderRNN
+from cprnn.models.tensor_parallel import tensor_parallel_info, gather_shards, reduce_grad, all_reduce_grad, \
+    broadcast_replicated, share_dropout
+
+
+class TensorParallelSecondOrderRNN(SecondOrderRNN):
+    """Second Order RNN with its core sharded along the output hidden mode across processes (see `tensor_parallel`)
+
+    Process `r` of `N` holds `w[:, :, r * D_h / N:(r + 1) * D_h / N]`, i.e. the core (and its Adam states) of
+    `D_h / N` hidden units. Each step computes the pre-activations of the local units from the full `h_t` and
+    all-gathers them into the full `h_{t+1}`, which the decoder and the next step use. Backward sums the gradients of
+    `h_t` over the shards through `reduce_grad`. The embedding and decoder are replicated.
+
+    Takes the arguments of `SecondOrderRNN`. `hidden_size` must be divisible by the number of processes. In a single
+    process the model is a `SecondOrderRNN`, which also loads consolidated checkpoints of sharded runs.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        rank, world_size = tensor_parallel_info()
+        if world_size > 1:
+            # Seed of rank 0, read without advancing (or resetting) the global RNGs
+            seed = torch.tensor([torch.initial_seed() % (2 ** 31 - 1)])
+            dist.broadcast(seed, src=0)
+            broadcast_replicated(self)
+
+            # Shards are drawn from streams of their own. Dropout masks and samples come from streams seeded alike in
+            # every process, so that they are identical across processes
+            stdv = 1.0 / math.sqrt(self.hidden_size)
+            self.w.data.uniform_(-stdv, stdv, generator=torch.Generator().manual_seed(seed.item() + 1 + rank))
+            self.generator = torch.Generator().manual_seed(seed.item())
+            self.sample_rng = np.random.RandomState(seed.item())
+            share_dropout(self, self.generator)
+
+            if self.use_embedding:
+                # Embeddings only reach the loss through the local shard
+                self.embedding.weight.register_hook(all_reduce_grad)
+
+    def init_core(self, **kwargs):
+        """Allocates the local shard of the core `w`. [D_h + 1, D_i + 1, D_h / N]"""
+        rank, world_size = tensor_parallel_info()
+        if self.hidden_size % world_size != 0:
+            raise ValueError("Hidden size {} is not divisible by the number of processes {}".format(
+                self.hidden_size, world_size
+            ))
+
+        self.w = nn.Parameter(torch.Tensor(self.hidden_size + 1, self.input_size + 1, self.hidden_size // world_size))
+        self.w.tensor_parallel_sharded = True
+
+    def _step(self, h_t: torch.Tensor, x_w_t: torch.Tensor, x_t: torch.Tensor):
+        # Local hidden units [B, D_h / N], gathered into the next full hidden state [B, D_h]
+        h_local = self.gate(self.contract(self.kernel, reduce_grad(h_t), x_t) + x_w_t)
+        return gather_shards(h_local)
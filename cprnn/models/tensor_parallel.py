@@ -0,0 +1,195 @@
+"""Tensor parallelism across local processes (torch.distributed, gloo backend)
+
+Launched through torchrun, e.g. for the 2RNN core sharded over 8 processes of one machine:
+
+    torchrun --standalone --nproc_per_node 8 train.py model.name=2rnn_tp model.hidden_size=2048
+
+Every process runs the same batches. Sharded parameters (marked with `tensor_parallel_sharded`) hold a slice of the
+model and their gradients and optimizer states only cover that slice. Replicated parameters start equal (broadcast
+from rank 0) and stay equal since every process computes them from the same full activations, with dropout masks
+drawn from a generator seeded alike in every process (see `SharedDropout`).
+
+Checkpoints are saved per process (see `shard_filename`). To merge the shards of a run into one checkpoint that
+loads in a single process:
+
+    python -m cprnn.models.tensor_parallel runs/ptb/<experiment>/model_best.pth
+"""
+import os
+import sys
+import glob
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def init_tensor_parallel():
+    """Joins the process group set up by torchrun, if any. Returns `(rank, world_size)`, `(0, 1)` otherwise"""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend='gloo')
+        # torchrun limits every process to one thread, each one gets its share of the cores instead
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    return tensor_parallel_info()
+
+
+def tensor_parallel_info():
+    """Rank of this process and number of processes, `(0, 1)` when not distributed"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def shard_filename(filename: str):
+    """Per-process name of a checkpoint, e.g. `model_best-rank0-of-8.pth`. Unchanged when not distributed"""
+    rank, world_size = tensor_parallel_info()
+    if world_size == 1:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return "{}-rank{}-of-{}{}".format(root, rank, world_size, ext)
+
+
+def tensor_parallel_state(model: nn.Module):
+    """Entries saved with every checkpoint, which `consolidate` needs to merge per-process checkpoints"""
+    rank, world_size = tensor_parallel_info()
+    return {
+        'tensor_parallel_rank': rank,
+        'tensor_parallel_world_size': world_size,
+        'tensor_parallel_sharded': [
+            name for name, p in model.named_parameters() if getattr(p, 'tensor_parallel_sharded', False)
+        ]
+    }
+
+
+def all_reduce_grad(grad: torch.Tensor):
+    """Sum of `grad` over processes. Also the gradient hook of replicated parameters only used by sharded layers"""
+    grad = grad.contiguous().clone()
+    dist.all_reduce(grad)
+    return grad
+
+
+class _GatherShards(torch.autograd.Function):
+    """Concatenates the last dimension of `x` across processes. Backward keeps the local slice of the gradient,
+    which every process holds in full (see `_ReduceGrad`)."""
+    @staticmethod
+    def forward(ctx, x: torch.Tensor):
+        rank, world_size = tensor_parallel_info()
+        x = x.contiguous()
+        parts = [torch.empty_like(x) for _ in range(world_size)]
+        dist.all_gather(parts, x)
+        ctx.start, ctx.stop = rank * x.size(-1), (rank + 1) * x.size(-1)
+        return torch.cat(parts, dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return grad_output[..., ctx.start:ctx.stop].contiguous()
+
+
+class _ReduceGrad(torch.autograd.Function):
+    """Identity whose backward sums the gradient over processes, for replicated inputs of sharded computations"""
+    @staticmethod
+    def forward(ctx, x: torch.Tensor):
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return all_reduce_grad(grad_output)
+
+
+def gather_shards(x: torch.Tensor):
+    """All-gathers the last dimension of `x`. [*, D / N] => [*, D]"""
+    return x if tensor_parallel_info()[1] == 1 else _GatherShards.apply(x)
+
+
+def reduce_grad(x: torch.Tensor):
+    """Marks the replicated `x` as input of a sharded computation, so that its gradient sums all shards"""
+    return x if tensor_parallel_info()[1] == 1 else _ReduceGrad.apply(x)
+
+
+def broadcast_replicated(module: nn.Module, src: int = 0):
+    """Copies the replicated parameters and buffers of `module` from process `src` to all processes"""
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if not getattr(tensor, 'tensor_parallel_sharded', False):
+            dist.broadcast(tensor.data, src=src)
+
+
+class SharedDropout(nn.Module):
+    """`nn.Dropout` drawing its masks from `generator` instead of the default RNG. Processes whose generators are
+    seeded alike draw the same masks, without touching the global RNG state"""
+    def __init__(self, p: float, generator: torch.Generator):
+        super().__init__()
+        self.p = p
+        self.generator = generator
+
+    def forward(self, x: torch.Tensor):
+        if not self.training or self.p == 0:
+            return x
+        keep = torch.empty(x.shape).bernoulli_(1 - self.p, generator=self.generator)
+        return x * keep.to(device=x.device, dtype=x.dtype) / (1 - self.p)
+
+
+def share_dropout(module: nn.Module, generator: torch.Generator):
+    """Replaces the `nn.Dropout` layers of `module` by `SharedDropout` layers drawing from `generator`"""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Dropout):
+            setattr(module, name, SharedDropout(child.p, generator))
+        else:
+            share_dropout(child, generator)
+
+
+def clip_grad_norm_(parameters, max_norm: float):
+    """`nn.utils.clip_grad_norm_` over the full model, i.e. with the norms of sharded gradients summed over processes.
+    Every process then scales its gradients by the same factor."""
+    parameters = [p for p in parameters if p.grad is not None]
+    if tensor_parallel_info()[1] == 1:
+        return nn.utils.clip_grad_norm_(parameters, max_norm)
+
+    sharded = torch.zeros(())
+    replicated = torch.zeros(())
+    for p in parameters:
+        if getattr(p, 'tensor_parallel_sharded', False):
+            sharded += p.grad.detach().float().pow(2).sum().cpu()
+        else:
+            replicated += p.grad.detach().float().pow(2).sum().cpu()
+    dist.all_reduce(sharded)
+
+    total_norm = (sharded + replicated).sqrt()
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for p in parameters:
+        p.grad.detach().mul_(clip_coef.to(p.grad.device))
+    return total_norm
+
+
+def consolidate(path: str):
+    """Merges the per-process checkpoints of `path` (see `shard_filename`) into one checkpoint dict
+
+    Sharded tensors are concatenated along their last dimension in rank order, i.e. the layout of the model built in
+    a single process. Optimizer states are left out, they cannot be resumed with a different number of processes.
+    """
+    root, ext = os.path.splitext(path)
+    paths = glob.glob("{}-rank*-of-*{}".format(root, ext))
+    if len(paths) == 0:
+        raise FileNotFoundError("No checkpoint shards found for `{}`".format(path))
+
+    dcts = [torch.load(p, map_location='cpu') for p in paths]
+    dcts = sorted(dcts, key=lambda d: d['tensor_parallel_rank'])
+    if len(dcts) != dcts[0]['tensor_parallel_world_size']:
+        raise ValueError("Expected {} checkpoint shards for `{}`, found {}".format(
+            dcts[0]['tensor_parallel_world_size'], path, len(dcts)
+        ))
+
+    model_state_dict = dict()
+    for key, value in dcts[0]['model_state_dict'].items():
+        if key in dcts[0]['tensor_parallel_sharded']:
+            value = torch.cat([d['model_state_dict'][key] for d in dcts], dim=-1)
+        model_state_dict[key] = value
+
+    dct = {k: v for k, v in dcts[0].items() if k not in ('optimizer_state_dict', 'tensor_parallel_rank')}
+    dct.update({'model_state_dict': model_state_dict, 'tensor_parallel_world_size': 1})
+    return dct
+
+
+if __name__ == '__main__':
+    for checkpoint_path in sys.argv[1:]:
+        torch.save(consolidate(checkpoint_path), checkpoint_path)
+        print("Saved consolidated checkpoint `{}`".format(checkpoint_path))
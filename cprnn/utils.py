@@ -1,6 +1,7 @@
 import pickle
 
 import yaml
+import torch
 
 
 def save_object(obj, filename):
@@ -14,6 +15,16 @@ def load_object(filename):
     return out
 
 
+def repackage_hidden(h):
+    """Detaches hidden states from their history, so that truncated BPTT stops at batch boundaries"""
+    if h is None:
+        return None
+    elif isinstance(h, torch.Tensor):
+        return h.detach()
+    else:
+        return tuple(repackage_hidden(v) for v in h)
+
+
 def saveckpt(model, epoch, optimizer):
     pass
 
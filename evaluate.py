@@ -4,11 +4,13 @@ import time
 import logging
 import os.path as osp
 
+import numpy as np
 import torch
 import torch.nn as nn
 
 from cprnn.utils import load_object, AverageMeter, get_yaml_dict
-from cprnn.models import CPRNN, SecondOrderRNN, LSTMPT, MRNN, MIRNN
+from cprnn.models import CPRNN, SecondOrderRNN, LSTMPT, MRNN, MIRNN, CPLSTM, TensorParallelSecondOrderRNN, \
+    BlockSparseSecondOrderRNN
 from cprnn.features.ptb_dataloader import PTBDataloader
 from cprnn.features.tokenizer import CharacterTokenizer
 
@@ -21,7 +23,10 @@ _models = {
     "2rnn": SecondOrderRNN,
     "lstmpt": LSTMPT,
     "mrnn": MRNN,
-    "mirnn": MIRNN
+    "mirnn": MIRNN,
+    "cplstm": CPLSTM,
+    "2rnn_tp": TensorParallelSecondOrderRNN,
+    "2rnn_bs": BlockSparseSecondOrderRNN
 }
 
 
@@ -30,6 +35,8 @@ def load_weights(model, dct):
         state_dict = {k.replace('module.', ''): v for k, v in dct['model_state_dict'].items()}
     else:
         state_dict = dct['model_state_dict']
+    if dct.get('rank') is not None and dct['rank'] != getattr(model, 'rank', None):
+        model.truncate_rank(dct['rank'])  # Saved before `model.rank_schedule` reached the final rank
     model.load_state_dict(state_dict)
 
 
@@ -98,8 +105,11 @@ def main():
         elapsed_start = time.time()
 
         # Quantitative evaluation
-        valid_metrics = evaluate(model, valid_dataloader, criterion, device=device)
-        test_metrics = evaluate(model, test_dataloader, criterion, device=device)
+        stateful, fused_loss = args["train"].get("stateful", False), args["train"].get("fused_loss", False)
+        valid_metrics = evaluate(model, valid_dataloader, criterion, device=device, stateful=stateful,
+                                 fused_loss=fused_loss)
+        test_metrics = evaluate(model, test_dataloader, criterion, device=device, stateful=stateful,
+                                fused_loss=fused_loss)
 
         dct['test_metrics'] = test_metrics
         torch.save(dct, osp.join(output_path, "model_best.pth"))  # Update best model saved metrics
@@ -143,25 +153,30 @@ def main():
 
 
 def sample(model, tokenizer, device=torch.device('cpu'), size=100, prime='The', top_k=5):
-    # First off, run through the prime characters
-    chars = [ch for ch in prime]
-
+    """Continues `prime` with `size + 1` characters, each drawn from the `top_k` most likely ones through `step`"""
     model_alias = model.module if isinstance(model, nn.DataParallel) else model
-    init_states = model_alias.init_hidden(batch_size=1, device=device)
-
-    for ch in prime:
-        inp = torch.tensor(tokenizer.char_to_ix(ch)).reshape(1, 1).to(device)
-        output_id, init_states = model_alias.predict(inp, init_states, top_k=top_k, device=device)
-
-    chars.append(tokenizer.ix_to_char(output_id.item()))
+    states = model_alias.init_hidden(batch_size=1, device=device)
 
-    # Now pass in the previous character and get a new one
-    for ii in range(size):
-        inp = torch.tensor(tokenizer.char_to_ix(chars[-1])).reshape(1, 1).to(device)
-        output_id, init_states = model_alias.predict(inp, init_states, top_k=top_k, device=device)
-        chars.append(tokenizer.ix_to_char(output_id.item()))
-
-    return ''.join(chars)
+    with torch.no_grad():
+        # First off, run through the prime characters. `step` only scores the `top_k` most likely tokens, which skips
+        # most of the vocabulary with the adaptive softmax
+        for ch in prime:
+            top, states = model_alias.step(
+                torch.tensor([tokenizer.char_to_ix(ch)], device=device), states, top_k=top_k
+            )
+
+        # Now pass in the previous character and get a new one. Drawn with numpy like `predict`, so that sampling
+        # between epochs leaves the torch RNG (and with it the seeded training run) alone
+        output_ids = []
+        for ii in range(size + 1):
+            probs, top_ids = top  # [1, K]
+            prob = probs.view(-1).double().cpu().numpy()
+            k_star = np.random.choice(np.arange(prob.shape[0]), p=prob / prob.sum())
+            output_ids.append(top_ids[0, k_star].item())
+            if ii < size:
+                top, states = model_alias.step(top_ids[:, k_star], states, top_k=top_k)
+
+    return prime + ''.join(tokenizer.ix_to_char(ix) for ix in output_ids)
 
 
 def evaluate_qualitative(model, eval_dataloader, tokenizer: CharacterTokenizer, device: torch.device):
@@ -177,17 +192,23 @@ def evaluate_qualitative(model, eval_dataloader, tokenizer: CharacterTokenizer,
     return sentences_output, sentences_target, sentences_source
 
 
-def evaluate(model, eval_dataloader, criterion, device):
+def evaluate(model, eval_dataloader, criterion, device, stateful=False, fused_loss=False):
     with torch.no_grad():
         loss_average_meter = AverageMeter()
         ppl_average_meter = AverageMeter()
+        states = None
         for inputs, targets in eval_dataloader:
             inputs, targets = inputs.to(device), targets.to(device)
 
-            output, _ = model(inputs)
-            n_seqs_curr, n_steps_curr = output.shape[0], output.shape[1]
-            loss = criterion(output.reshape(n_seqs_curr * n_steps_curr, -1),
-                             targets.reshape(n_seqs_curr * n_steps_curr))
+            if fused_loss:
+                loss, states = model(inputs, states, targets=targets)
+                loss = loss.mean()  # nn.DataParallel returns one loss per replica
+            else:
+                output, states = model(inputs, states)
+                n_seqs_curr, n_steps_curr = output.shape[0], output.shape[1]
+                loss = criterion(output.reshape(n_seqs_curr * n_steps_curr, -1),
+                                 targets.reshape(n_seqs_curr * n_steps_curr))
+            states = states if stateful else None
 
             loss_average_meter.add(loss.item())
             ppl_average_meter.add(torch.exp(loss).item())
@@ -47,6 +47,14 @@ cp -r data $SLURM_TMPDIR/data
 #python train.py data.path=$SLURM_TMPDIR/data/processed/ptb model.name=2rnn model.hidden_size=512 train.batch_size=128
 #python train.py data.path=$SLURM_TMPDIR/data/processed/ptb model.name=2rnn model.hidden_size=1024 train.batch_size=128
 #
+## 2RNN (d=2048), core sharded over 8 processes of one machine (merge the checkpoint shards with
+## `python -m cprnn.models.tensor_parallel <run>/model_best.pth` before evaluating)
+#torchrun --standalone --nproc_per_node 8 train.py data.path=$SLURM_TMPDIR/data/processed/ptb model.name=2rnn_tp model.hidden_size=2048 train.batch_size=128
+#
+## Block-sparse 2RNN (d=1024), fixed random mask of 64x64 blocks (pruned models: `python compress.py prune`)
+#python train.py data.path=$SLURM_TMPDIR/data/processed/ptb model.name=2rnn_bs model.hidden_size=1024 +model.block_size=64 +model.density=0.25 train.batch_size=128
+#python train.py data.path=$SLURM_TMPDIR/data/processed/ptb model.name=2rnn_bs model.hidden_size=1024 +model.block_size=64 +model.density=0.1 train.batch_size=128
+#
 ## MIRNN (d=128)
 #python train.py data.path=$SLURM_TMPDIR/data/processed/ptb model.name=mirnn model.hidden_size=128 train.batch_size=128
 #
@@ -12,12 +12,20 @@ from omegaconf import DictConfig, OmegaConf
 from vizier.service import clients
 from vizier.service import pyvizier as vz
 
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.tensorboard import SummaryWriter
 
-from cprnn.utils import load_object, AverageMeter
-from cprnn.models import CPRNN, SecondOrderRNN, LSTMPT, MRNN, MIRNN
+from cprnn.utils import load_object, AverageMeter, repackage_hidden
+from cprnn.models import CPRNN, SecondOrderRNN, LSTMPT, MRNN, MIRNN, CPLSTM, TensorParallelSecondOrderRNN, \
+    BlockSparseSecondOrderRNN
+from cprnn.models.recurrence import enable_compile_cache
+from cprnn.models.autotune import set_plan_path
+from cprnn.models.rank_growth import parse_rank_schedule, scheduled_rank, grow_optimizer_state
+from cprnn.models.ensemble import Ensemble, TrialOptimizer, ensemble_cross_entropy, clip_grad_norm_per_trial, \
+    load_trial_optimizer_state_dicts
+from cprnn.models.tensor_parallel import init_tensor_parallel, shard_filename, tensor_parallel_state, clip_grad_norm_
 from cprnn.features.ptb_dataloader import PTBDataloader
 from cprnn.features.tokenizer import CharacterTokenizer
 
@@ -30,7 +38,25 @@ _models = {
     "2rnn": SecondOrderRNN,
     "lstmpt": LSTMPT,
     "mrnn": MRNN,
-    "mirnn": MIRNN
+    "mirnn": MIRNN,
+    "cplstm": CPLSTM,
+    "2rnn_tp": TensorParallelSecondOrderRNN,
+    "2rnn_bs": BlockSparseSecondOrderRNN
+}
+
+# Config keys that only change how fast a run goes, not what it trains. They are left out of experiment names so
+# that toggling them resumes the same experiment.
+_speed_keys = {"compile", "unroll", "checkpoint_segments", "scan", "recompute", "autotune", "transition_table",
+               "fused_loss", "ensemble"}
+
+# Config keys left out of experiment names when at their default, i.e. the behaviour of runs that predate them. Runs
+# that do not set them keep their names (and resume), only runs that change them get a new one.
+_default_values = {"stateful": False, "precision": "fp32", "decoder": "linear"}
+
+# Autocast dtypes of `train.precision`. bf16 keeps the exponent range of fp32, so gradients need no loss scaling
+_precisions = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16
 }
 
 
@@ -80,32 +106,97 @@ def get_experiment_name(configs, abbrevs=None):
     return abbrevs
 
 
+def parse_nested_ranks(nested_ranks: str, rank: int):
+    """Parses `train.nested_ranks`, e.g. `8,16,32,64` or `sample:8,16,32,64`. Returns the rank prefixes and whether
+    each sequence samples one of them (otherwise every batch is trained on all of them)"""
+    nested_ranks = str(nested_ranks).replace(' ', '')
+    sample = nested_ranks.startswith('sample:')
+    ranks = [int(r) for r in nested_ranks[len('sample:') if sample else 0:].split(',')]
+    if any(r < 1 or r > rank for r in ranks):
+        raise ValueError("Nested ranks {} must lie in [1, {}]".format(ranks, rank))
+    return sorted(set(ranks)), sample
+
+
+def nested_batch(inputs: torch.Tensor, targets: torch.Tensor, ranks: list, sample: bool = False):
+    """Batch of nested-rank training and its rank prefix per sequence. Sequences either sample a prefix of `ranks`,
+    or the batch is repeated once per prefix (prefix-major), which averages the losses of all prefixes."""
+    prefixes = torch.tensor(ranks, device=inputs.device)
+    if sample:
+        return inputs, targets, prefixes[torch.randint(len(ranks), (inputs.size(0),), device=inputs.device)]
+    n = len(ranks)
+    return inputs.repeat(n, 1), targets.repeat(n, 1), prefixes.repeat_interleave(inputs.size(0))
+
+
 @hydra.main(version_base=None, config_path="./", config_name="configs")
 def main(cfg: DictConfig):
 
     args = OmegaConf.to_container(cfg, resolve=True)
 
+    # Processes launched by torchrun (`2rnn_tp`) each hold a shard of the model and save their own checkpoints
+    rank, _ = init_tensor_parallel()
+
     if (args['data']['tokenizer'] == 'word') ^ (args['model']['input_size'] != 0):
         raise ValueError("Embedding dimension and word tokenizer must be set jointly")
 
+    if args['train']['precision'] not in _precisions:
+        raise ValueError("Unknown precision `{}`. Expected one of {}".format(
+            args['train']['precision'], list(_precisions.keys())
+        ))
+
+    if args['model']['compile']:
+        enable_compile_cache(osp.join(args['data']['output'], '.compile_cache'))
+
+    if args['model']['autotune']:
+        set_plan_path(osp.join(args['data']['output'], 'plans.json'))
+
+    rank_schedule = None
+    if args['model'].get('rank_schedule') is not None:
+        if args['model']['name'].lower() not in ('cprnn', 'mrnn'):
+            raise ValueError("Rank schedules require model `cprnn` or `mrnn`, got `{}`".format(args['model']['name']))
+        rank_schedule = parse_rank_schedule(args['model']['rank_schedule'], args['model']['rank'])
+
+    if args['train'].get('nested_ranks') is not None:
+        if args['model']['name'].lower() not in ('cprnn', 'mrnn'):
+            raise ValueError("Nested ranks require model `cprnn` or `mrnn`, got `{}`".format(args['model']['name']))
+        parse_nested_ranks(args['train']['nested_ranks'], args['model']['rank'])
+
+    if args['train']['ensemble']:
+        unsupported = [k for k, v in {
+            "train.fused_loss": args['train']['fused_loss'], "train.nested_ranks": args['train']['nested_ranks'],
+            "model.decoder=adaptive": args['model']['decoder'] == 'adaptive', "model.compile": args['model']['compile'],
+            "model.checkpoint_segments": args['model']['checkpoint_segments'],
+            "model.recompute": args['model']['recompute'], "model.rank_schedule": args['model']['rank_schedule'],
+            "model.autotune": args['model']['autotune'],
+            "torchrun": rank != 0 or int(os.environ.get("WORLD_SIZE", 1)) > 1
+        }.items() if v]
+        if len(unsupported) > 0:
+            raise ValueError("Ensemble training does not support {}".format(", ".join(unsupported)))
+
+    trials = []  # Trials left to train together with `train.ensemble`
     for t in range(args["runs"]):
-        exp_name = get_experiment_name(
-            {**args["train"], **args['model'], **{"tokenizer": args['data']['tokenizer'], "trial": t}}
-        )
+        # Unset options and options at their default are left out, so that adding one keeps the names of existing
+        # experiments
+        exp_name = get_experiment_name({
+            **{
+                k: v for k, v in {**args["train"], **args['model']}.items()
+                if k not in _speed_keys and v is not None and not (k in _default_values and v == _default_values[k])
+            },
+            **{"tokenizer": args['data']['tokenizer'], "trial": t}
+        })
         folder_name = "_".join(["{}{}".format(k, v) for k, v in exp_name.items()])
         dct_latest, dct_best = None, None
 
         output_path = osp.join(args['data']['output'], osp.split(args["data"]["path"])[-1], folder_name)
         if not osp.exists(output_path):
-            os.makedirs(output_path)
+            os.makedirs(output_path, exist_ok=True)  # Tensor-parallel processes create it concurrently
             print("Running Experiment: `{}`".format(folder_name))
 
-        elif not osp.exists(osp.join(output_path, 'model_latest.pth')):
+        elif not osp.exists(osp.join(output_path, shard_filename('model_latest.pth'))):
             print("Running Experiment: `{}`".format(folder_name))
 
         else:  # Experiment already exists
-            dct_latest = torch.load(osp.join(output_path, 'model_latest.pth'))
-            dct_best = torch.load(osp.join(output_path, 'model_best.pth'))
+            dct_latest = torch.load(osp.join(output_path, shard_filename('model_latest.pth')))
+            dct_best = torch.load(osp.join(output_path, shard_filename('model_best.pth')))
             if dct_latest['epoch'] >= args['train']['epochs']:
                 print("Experiment `{}` already exists. (Latest @ epoch {})".format(
                     folder_name, dct_latest['epoch']
@@ -115,10 +206,11 @@ def main(cfg: DictConfig):
             else:
                 print("Running Experiment: `{}`".format(folder_name))
 
-        with open(osp.join(output_path, 'configs.yaml'), 'w') as outfile:
-            yaml.dump(args, outfile)
+        if rank == 0:
+            with open(osp.join(output_path, 'configs.yaml'), 'w') as outfile:
+                yaml.dump(args, outfile)
 
-        writer = SummaryWriter(log_dir=output_path)
+        writer = SummaryWriter(log_dir=output_path if rank == 0 else osp.join(output_path, 'rank{}'.format(rank)))
 
         # Logging configuration
         logging.basicConfig(
@@ -127,7 +219,8 @@ def main(cfg: DictConfig):
             datefmt='%H:%M:%S',
             filemode='a'
         )
-        logging.getLogger().addHandler(logging.FileHandler(osp.join(output_path, "logging.txt")))
+        if rank == 0:
+            logging.getLogger().addHandler(logging.FileHandler(osp.join(output_path, "logging.txt")))
 
         # Data
         train_dataloader = PTBDataloader(
@@ -150,7 +243,18 @@ def main(cfg: DictConfig):
         logging.info("Device: {}".format(device))
 
         # Model
-        model = _models[args["model"]["name"].lower()](vocab_size=tokenizer.vocab_size, **args["model"])
+        model_kwargs = dict()
+        if args["model"]["decoder"] == "adaptive":
+            # Adaptive softmax clusters are sized from the unigram frequencies of the training split
+            model_kwargs["unigram_counts"] = torch.bincount(
+                train_dataloader.arr.reshape(-1), minlength=tokenizer.vocab_size
+            )
+        model = _models[args["model"]["name"].lower()](
+            vocab_size=tokenizer.vocab_size, **args["model"], **model_kwargs
+        )
+        if rank_schedule is not None:
+            # Starts at the first rank of the schedule, or at the rank reached by the run being resumed
+            model.truncate_rank(rank_schedule[0][0] if dct_latest is None else dct_latest['rank'])
         num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
 
         criterion = nn.CrossEntropyLoss()
@@ -170,6 +274,14 @@ def main(cfg: DictConfig):
             model.to(device)
             optimizer = torch.optim.Adam(model.parameters(), lr=args["train"]["lr"])
 
+        if args['train']['ensemble']:
+            trials.append({
+                'model': model, 'optimizer': optimizer, 'num_params': num_params, 'output_path': output_path,
+                'writer': writer, 'curr_epoch': curr_epoch + 1, 'best_valid_loss': curr_best_valid_loss,
+                'folder_name': folder_name
+            })
+            continue
+
         # Parallelize the model
         if torch.cuda.device_count() > 1:
             print("Using {} GPUs".format(torch.cuda.device_count()))
@@ -178,115 +290,115 @@ def main(cfg: DictConfig):
         # Training
         train(
             model, args, criterion, optimizer, train_dataloader, valid_dataloader, test_dataloader, device, num_params,
-            output_path, tokenizer, writer, curr_epoch=curr_epoch+1, best_valid_loss=curr_best_valid_loss
+            output_path, tokenizer, writer, curr_epoch=curr_epoch+1, best_valid_loss=curr_best_valid_loss,
+            rank_schedule=rank_schedule
         )
 
         print("Experiment: `{}` Succeeded".format(folder_name))
 
-
-def train(model, args, criterion, optimizer, train_dataloader, valid_dataloader, test_dataloader, device, num_params,
-          output_path, tokenizer, writer, curr_epoch=1, best_valid_loss=None):
-
+    if len(trials) > 0:
+        train_ensemble(
+            trials, args, criterion, train_dataloader, valid_dataloader, test_dataloader, device, tokenizer
+        )
+        for trial in trials:
+            print("Experiment: `{}` Succeeded".format(trial['folder_name']))
+
+
+def train_ensemble(trials, args, criterion, train_dataloader, valid_dataloader, test_dataloader, device, tokenizer):
+    """Trains the `trials` of `main` together as an `Ensemble`. After every epoch, each trial is copied back into its
+    own model, then evaluated, checkpointed and logged into its own folder as in `train`."""
+    curr_epoch = trials[0]['curr_epoch']
+    if any(trial['curr_epoch'] != curr_epoch for trial in trials):
+        logging.info("Trials resume from different epochs, training them one at a time")
+        for trial in trials:
+            train(
+                trial['model'], args, criterion, trial['optimizer'], train_dataloader, valid_dataloader,
+                test_dataloader, device, trial['num_params'], trial['output_path'], tokenizer, trial['writer'],
+                curr_epoch=trial['curr_epoch'], best_valid_loss=trial['best_valid_loss']
+            )
+        return
+
+    ensemble = Ensemble([trial['model'] for trial in trials])
+    optimizer = torch.optim.Adam(ensemble.parameters(), lr=args["train"]["lr"])
+    if curr_epoch > 1:
+        load_trial_optimizer_state_dicts(optimizer, [trial['optimizer'].state_dict() for trial in trials])
+
+    throughput = AverageMeter()
     for i_epoch in range(curr_epoch, args["train"]["epochs"] + 1):
         epoch_start_time = time.time()
-        train_metrics = train_epoch(
-            model, train_dataloader, optimizer, criterion, clip=args["train"]["grad_clip"], device=device
+        train_metrics = train_epoch_ensemble(
+            ensemble, train_dataloader, optimizer, clip=args["train"]["grad_clip"], device=device,
+            stateful=args["train"]["stateful"], precision=args["train"]["precision"]
         )
-        valid_metrics = evaluate(model, valid_dataloader, criterion, device=device)
-
-        logging.info(
-            'Epoch {:4d}/{:4d} | time: {:5.2f}s | train loss {:5.2f} | train ppl {:8.2f} | train bpc {:8.2f} | '
-            'valid loss {:5.2f} | valid ppl {:8.2f} | valid bpc {:8.2f}'.format(
-                i_epoch, args["train"]["epochs"], (time.time() - epoch_start_time),
-                train_metrics['loss'], train_metrics['ppl'], train_metrics['bpc'],
-                valid_metrics['loss'], valid_metrics['ppl'], valid_metrics['bpc']
-            ))
-
-        # Save the model if the validation loss is the best we've seen so far.
-        if best_valid_loss is None or valid_metrics['loss'] < best_valid_loss:
-            # Compute here for convenience
-            test_metrics = evaluate(model, test_dataloader, criterion, device=device)
-
-            torch.save({
-                'epoch': i_epoch,
-                'optimizer_state_dict': optimizer.state_dict(),
-                'model_state_dict': model.state_dict(),
-                'torchrandom_state': torch.get_rng_state(),
-                'train_metrics': valid_metrics,
-                'valid_metrics': valid_metrics,
-                'test_metrics': test_metrics,
-                'num_params': num_params,
-                'config': args
-            }, osp.join(output_path, "model_best.pth"))
-
-            best_valid_loss = valid_metrics['loss']
-
-            # Save the latest model
-            torch.save({
-                'epoch': i_epoch,
-                'optimizer_state_dict': optimizer.state_dict(),
-                'model_state_dict': model.state_dict(),
-                'torchrandom_state': torch.get_rng_state(),
-                'train_metrics': valid_metrics,
-                'valid_metrics': valid_metrics,
-                'test_metrics': test_metrics,
-                'num_params': num_params,
-                'config': args
-            }, osp.join(output_path, "model_latest.pth"))
-
-        elif i_epoch % 5 == 0 or i_epoch == args["train"]["epochs"]:
-            test_metrics = evaluate(model, test_dataloader, criterion, device=device)
-            torch.save({
-                'epoch': i_epoch,
-                'optimizer_state_dict': optimizer.state_dict(),
-                'model_state_dict': model.state_dict(),
-                'torchrandom_state': torch.get_rng_state(),
-                'train_metrics': valid_metrics,
-                'valid_metrics': valid_metrics,
-                'test_metrics': test_metrics,
-                'num_params': num_params,
-                'config': args
-            }, osp.join(output_path, "model_latest.pth"))
-
-        # Qualitative prediction
-        train_sent_output, train_sent_target, train_sent_source = evaluate_qualitative(
-            model, train_dataloader, tokenizer, device,
-        )
-        valid_sent_output, valid_sent_target, valid_sent_source = evaluate_qualitative(
-            model, valid_dataloader, tokenizer, device,
+        # Tokens/s of each trial, the ensemble processes `len(trials)` times as many
+        tokens_per_s = len(train_dataloader) * args["train"]["batch_size"] * args["train"]["seq_len"] / (
+            time.time() - epoch_start_time
         )
+        throughput.add(tokens_per_s)
 
-        valid_sent_output = valid_sent_output.transpose(1, 0)
-        valid_sent_target = valid_sent_target.transpose(1, 0)
-        valid_sent_source = valid_sent_source.transpose(1, 0)
-        train_sent_output = train_sent_output.transpose(1, 0)
-        train_sent_target = train_sent_target.transpose(1, 0)
-        train_sent_source = train_sent_source.transpose(1, 0)
+        for i, trial in enumerate(trials):
+            ensemble.copy_trial(i, trial['model'])
+            _, trial['best_valid_loss'], _ = end_epoch(
+                trial['model'], args, criterion, TrialOptimizer(optimizer, i), train_dataloader, valid_dataloader,
+                test_dataloader, device, trial['num_params'], trial['output_path'], tokenizer, trial['writer'],
+                i_epoch, train_metrics[i], tokens_per_s, epoch_start_time, best_valid_loss=trial['best_valid_loss']
+            )
 
-        valid_qaul_str = "Source:  \n{}  \nTarget:  \n{}  \nPrediction:  \n{}".format(
-            "".join(valid_sent_source[:, 0]), "".join(valid_sent_target[:, 0]), "".join(valid_sent_output[:, 0])
-        )
+    if args["train"]["epochs"] >= curr_epoch:
+        logging.info("Ensemble of {} trials | mean train throughput {:8.0f} tokens/s per trial".format(
+            len(trials), throughput.value
+        ))
+
+    for trial in trials:
+        trial['writer'].flush()
+        trial['writer'].close()
 
-        train_qaul_str = "Source:  \n{}  \nTarget:  \n{}  \nPrediction:  \n{}".format(
-            "".join(train_sent_source[:, 0]), "".join(train_sent_target[:, 0]), "".join(train_sent_output[:, 0])
-        )
 
-        sample_str = sample(model, size=100, prime='The', top_k=5, device=device, tokenizer=tokenizer)
+def train(model, args, criterion, optimizer, train_dataloader, valid_dataloader, test_dataloader, device, num_params,
+          output_path, tokenizer, writer, curr_epoch=1, best_valid_loss=None, rank_schedule=None):
 
-        # Sample
-        logging.info("Train:\n{}".format(train_qaul_str))
-        logging.info("Validation:\n{}".format(valid_qaul_str))
-        logging.info("Sample:\n{}".format(sample_str))
+    precision = args["train"]["precision"]
+    throughput = AverageMeter()
+    model_alias = model.module if isinstance(model, nn.DataParallel) else model
+    plateau = False  # Whether the last epoch did not improve the validation loss
 
-        # Logging
-        for m in train_metrics.keys():
-            writer.add_scalar("train/{}".format(m), train_metrics[m], i_epoch)
-            writer.add_scalar("valid/{}".format(m), valid_metrics[m], i_epoch)
+    # The adaptive softmax only saves compute through its own loss, which skips the clusters of other tokens.
+    # Evaluation keeps the exact log-probabilities over the whole vocabulary unless `fused_loss` is set.
+    fused_loss = args["train"]["fused_loss"] or args["model"]["decoder"] == "adaptive"
+
+    # Nested-rank training: the first r CP components are trained as a rank-r model for every prefix r
+    nested_ranks = None
+    if args["train"].get("nested_ranks") is not None:
+        nested_ranks = parse_nested_ranks(args["train"]["nested_ranks"], args["model"]["rank"])
+
+    for i_epoch in range(curr_epoch, args["train"]["epochs"] + 1):
+        if rank_schedule is not None:
+            rank = scheduled_rank(rank_schedule, model_alias.rank, i_epoch, plateau)
+            if rank > model_alias.rank:
+                logging.info("Epoch {:4d} | growing rank {} => {}".format(i_epoch, model_alias.rank, rank))
+                model_alias.grow_rank(rank)
+                grow_optimizer_state(optimizer, model_alias.parameters())
+                num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+        epoch_start_time = time.time()
+        train_metrics = train_epoch(
+            model, train_dataloader, optimizer, criterion, clip=args["train"]["grad_clip"], device=device,
+            stateful=args["train"]["stateful"], precision=precision, fused_loss=fused_loss, nested_ranks=nested_ranks
+        )
+        tokens_per_s = len(train_dataloader) * args["train"]["batch_size"] * args["train"]["seq_len"] / (
+            time.time() - epoch_start_time
+        )
+        throughput.add(tokens_per_s)
+        valid_metrics, best_valid_loss, plateau = end_epoch(
+            model, args, criterion, optimizer, train_dataloader, valid_dataloader, test_dataloader, device,
+            num_params, output_path, tokenizer, writer, i_epoch, train_metrics, tokens_per_s, epoch_start_time,
+            best_valid_loss=best_valid_loss, nested_ranks=nested_ranks
+        )
 
-        writer.add_scalar("LR", args["train"]["lr"], i_epoch)
-        writer.add_text('Valid', valid_qaul_str, i_epoch)
-        writer.add_text('Train', train_qaul_str, i_epoch)
-        writer.add_text('Sample', sample_str, i_epoch)
+    if args["train"]["epochs"] >= curr_epoch:
+        logging.info("Precision {} | mean train throughput {:8.0f} tokens/s | final valid bpc {:8.3f}".format(
+            precision, throughput.value, valid_metrics['bpc']
+        ))
 
     writer.flush()
     writer.close()
@@ -294,26 +406,186 @@ def train(model, args, criterion, optimizer, train_dataloader, valid_dataloader,
     return valid_metrics
 
 
-def sample(model, tokenizer, device=torch.device('cpu'), size=100, prime='The', top_k=5):
-    # First off, run through the prime characters
-    chars = [ch for ch in prime]
-
+def end_epoch(model, args, criterion, optimizer, train_dataloader, valid_dataloader, test_dataloader, device,
+              num_params, output_path, tokenizer, writer, i_epoch, train_metrics, tokens_per_s, epoch_start_time,
+              best_valid_loss=None, nested_ranks=None):
+    """Evaluates, checkpoints and logs the model after training epoch `i_epoch`. Returns the validation metrics, the
+    best validation loss so far and whether the epoch did not improve it"""
     model_alias = model.module if isinstance(model, nn.DataParallel) else model
-    init_states = model_alias.init_hidden(batch_size=1, device=device)
 
-    for ch in prime:
-        inp = torch.tensor(tokenizer.char_to_ix(ch)).reshape(1, 1).to(device)
-        output_id, init_states = model_alias.predict(inp, init_states, top_k=top_k, device=device)
+    # Scored like in evaluate.py: without dropout and with the inference-only paths (e.g. the transition table)
+    model.eval()
+
+    valid_metrics = evaluate(
+        model, valid_dataloader, criterion, device=device, stateful=args["train"]["stateful"],
+        fused_loss=args["train"]["fused_loss"]
+    )
+
+    logging.info(
+        'Epoch {:4d}/{:4d} | time: {:5.2f}s | train {:8.0f} tokens/s | train loss {:5.2f} | train ppl {:8.2f} | '
+        'train bpc {:8.2f} | valid loss {:5.2f} | valid ppl {:8.2f} | valid bpc {:8.2f}'.format(
+            i_epoch, args["train"]["epochs"], (time.time() - epoch_start_time), tokens_per_s,
+            train_metrics['loss'], train_metrics['ppl'], train_metrics['bpc'],
+            valid_metrics['loss'], valid_metrics['ppl'], valid_metrics['bpc']
+        ))
+
+    nested_valid_metrics, nested_test_metrics = None, None
+    if nested_ranks is not None:
+        nested_valid_metrics = evaluate_nested(
+            model, valid_dataloader, nested_ranks[0], device=device, stateful=args["train"]["stateful"]
+        )
+        logging.info("Epoch {:4d}/{:4d} | valid bpc per rank prefix | {}".format(
+            i_epoch, args["train"]["epochs"],
+            " | ".join("r{} {:6.3f}".format(r, m['bpc']) for r, m in nested_valid_metrics.items())
+        ))
+
+    # Save the model if the validation loss is the best we've seen so far.
+    plateau = best_valid_loss is not None and valid_metrics['loss'] >= best_valid_loss
+    if not plateau:
+        # Compute here for convenience
+        test_metrics = evaluate(
+            model, test_dataloader, criterion, device=device, stateful=args["train"]["stateful"],
+            fused_loss=args["train"]["fused_loss"]
+        )
+        if nested_ranks is not None:
+            nested_test_metrics = evaluate_nested(
+                model, test_dataloader, nested_ranks[0], device=device, stateful=args["train"]["stateful"]
+            )
+
+        torch.save({
+            'epoch': i_epoch,
+            'optimizer_state_dict': optimizer.state_dict(),
+            'model_state_dict': model.state_dict(),
+            'torchrandom_state': torch.get_rng_state(),
+            'train_metrics': valid_metrics,
+            'valid_metrics': valid_metrics,
+            'test_metrics': test_metrics,
+            'nested_valid_metrics': nested_valid_metrics,
+            'nested_test_metrics': nested_test_metrics,
+            'num_params': num_params,
+            'rank': getattr(model_alias, 'rank', None),
+            'config': args,
+            **tensor_parallel_state(model)
+        }, osp.join(output_path, shard_filename("model_best.pth")))
+
+        best_valid_loss = valid_metrics['loss']
+
+        # Save the latest model
+        torch.save({
+            'epoch': i_epoch,
+            'optimizer_state_dict': optimizer.state_dict(),
+            'model_state_dict': model.state_dict(),
+            'torchrandom_state': torch.get_rng_state(),
+            'train_metrics': valid_metrics,
+            'valid_metrics': valid_metrics,
+            'test_metrics': test_metrics,
+            'nested_valid_metrics': nested_valid_metrics,
+            'nested_test_metrics': nested_test_metrics,
+            'num_params': num_params,
+            'rank': getattr(model_alias, 'rank', None),
+            'config': args,
+            **tensor_parallel_state(model)
+        }, osp.join(output_path, shard_filename("model_latest.pth")))
+
+    elif i_epoch % 5 == 0 or i_epoch == args["train"]["epochs"]:
+        test_metrics = evaluate(
+            model, test_dataloader, criterion, device=device, stateful=args["train"]["stateful"],
+            fused_loss=args["train"]["fused_loss"]
+        )
+        if nested_ranks is not None:
+            nested_test_metrics = evaluate_nested(
+                model, test_dataloader, nested_ranks[0], device=device, stateful=args["train"]["stateful"]
+            )
+        torch.save({
+            'epoch': i_epoch,
+            'optimizer_state_dict': optimizer.state_dict(),
+            'model_state_dict': model.state_dict(),
+            'torchrandom_state': torch.get_rng_state(),
+            'train_metrics': valid_metrics,
+            'valid_metrics': valid_metrics,
+            'test_metrics': test_metrics,
+            'nested_valid_metrics': nested_valid_metrics,
+            'nested_test_metrics': nested_test_metrics,
+            'num_params': num_params,
+            'rank': getattr(model_alias, 'rank', None),
+            'config': args,
+            **tensor_parallel_state(model)
+        }, osp.join(output_path, shard_filename("model_latest.pth")))
+
+    # Qualitative prediction
+    train_sent_output, train_sent_target, train_sent_source = evaluate_qualitative(
+        model, train_dataloader, tokenizer, device,
+    )
+    valid_sent_output, valid_sent_target, valid_sent_source = evaluate_qualitative(
+        model, valid_dataloader, tokenizer, device,
+    )
+
+    valid_sent_output = valid_sent_output.transpose(1, 0)
+    valid_sent_target = valid_sent_target.transpose(1, 0)
+    valid_sent_source = valid_sent_source.transpose(1, 0)
+    train_sent_output = train_sent_output.transpose(1, 0)
+    train_sent_target = train_sent_target.transpose(1, 0)
+    train_sent_source = train_sent_source.transpose(1, 0)
+
+    valid_qaul_str = "Source:  \n{}  \nTarget:  \n{}  \nPrediction:  \n{}".format(
+        "".join(valid_sent_source[:, 0]), "".join(valid_sent_target[:, 0]), "".join(valid_sent_output[:, 0])
+    )
+
+    train_qaul_str = "Source:  \n{}  \nTarget:  \n{}  \nPrediction:  \n{}".format(
+        "".join(train_sent_source[:, 0]), "".join(train_sent_target[:, 0]), "".join(train_sent_output[:, 0])
+    )
+
+    sample_str = sample(model, size=100, prime='The', top_k=5, device=device, tokenizer=tokenizer)
+
+    # Sample
+    logging.info("Train:\n{}".format(train_qaul_str))
+    logging.info("Validation:\n{}".format(valid_qaul_str))
+    logging.info("Sample:\n{}".format(sample_str))
+
+    # Logging
+    for m in train_metrics.keys():
+        writer.add_scalar("train/{}".format(m), train_metrics[m], i_epoch)
+        writer.add_scalar("valid/{}".format(m), valid_metrics[m], i_epoch)
+    for r, metrics in (nested_valid_metrics or dict()).items():
+        writer.add_scalar("valid/bpc_r{}".format(r), metrics['bpc'], i_epoch)
+
+    writer.add_scalar("train/tokens_per_s", tokens_per_s, i_epoch)
+    writer.add_scalar("LR", args["train"]["lr"], i_epoch)
+    writer.add_text('Valid', valid_qaul_str, i_epoch)
+    writer.add_text('Train', train_qaul_str, i_epoch)
+    writer.add_text('Sample', sample_str, i_epoch)
 
-    chars.append(tokenizer.ix_to_char(output_id.item()))
+    model.train()
+    return valid_metrics, best_valid_loss, plateau
 
-    # Now pass in the previous character and get a new one
-    for ii in range(size):
-        inp = torch.tensor(tokenizer.char_to_ix(chars[-1])).reshape(1, 1).to(device)
-        output_id, init_states = model_alias.predict(inp, init_states, top_k=top_k, device=device)
-        chars.append(tokenizer.ix_to_char(output_id.item()))
 
-    return ''.join(chars)
+def sample(model, tokenizer, device=torch.device('cpu'), size=100, prime='The', top_k=5):
+    """Continues `prime` with `size + 1` characters, each drawn from the `top_k` most likely ones through `step`"""
+    model_alias = model.module if isinstance(model, nn.DataParallel) else model
+    states = model_alias.init_hidden(batch_size=1, device=device)
+
+    with torch.no_grad():
+        # First off, run through the prime characters. `step` only scores the `top_k` most likely tokens, which skips
+        # most of the vocabulary with the adaptive softmax
+        for ch in prime:
+            top, states = model_alias.step(
+                torch.tensor([tokenizer.char_to_ix(ch)], device=device), states, top_k=top_k
+            )
+
+        # Now pass in the previous character and get a new one. Drawn with numpy like `predict`, so that sampling
+        # between epochs leaves the torch RNG (and with it the seeded training run) alone. Tensor parallel models
+        # bring an RNG seeded alike in every process, since all processes have to feed `step` the same characters
+        rng = getattr(model_alias, 'sample_rng', np.random)
+        output_ids = []
+        for ii in range(size + 1):
+            probs, top_ids = top  # [1, K]
+            prob = probs.view(-1).double().cpu().numpy()
+            k_star = rng.choice(np.arange(prob.shape[0]), p=prob / prob.sum())
+            output_ids.append(top_ids[0, k_star].item())
+            if ii < size:
+                top, states = model_alias.step(top_ids[:, k_star], states, top_k=top_k)
+
+    return prime + ''.join(tokenizer.ix_to_char(ix) for ix in output_ids)
 
 
 def evaluate_qualitative(model, eval_dataloader, tokenizer: CharacterTokenizer, device: torch.device):
@@ -328,17 +600,23 @@ def evaluate_qualitative(model, eval_dataloader, tokenizer: CharacterTokenizer,
     return sentences_output, sentences_target, sentences_source
 
 
-def evaluate(model, eval_dataloader, criterion, device):
+def evaluate(model, eval_dataloader, criterion, device, stateful=False, fused_loss=False):
     with torch.no_grad():
         loss_average_meter = AverageMeter()
         ppl_average_meter = AverageMeter()
+        states = None
         for inputs, targets in eval_dataloader:
             inputs, targets = inputs.to(device), targets.to(device)
 
-            output, _ = model(inputs)
-            n_seqs_curr, n_steps_curr = output.shape[0], output.shape[1]
-            loss = criterion(output.reshape(n_seqs_curr * n_steps_curr, -1),
-                             targets.reshape(n_seqs_curr * n_steps_curr))
+            if fused_loss:
+                loss, states = model(inputs, states, targets=targets)
+                loss = loss.mean()  # nn.DataParallel returns one loss per replica
+            else:
+                output, states = model(inputs, states)
+                n_seqs_curr, n_steps_curr = output.shape[0], output.shape[1]
+                loss = criterion(output.reshape(n_seqs_curr * n_steps_curr, -1),
+                                 targets.reshape(n_seqs_curr * n_steps_curr))
+            states = states if stateful else None
 
             loss_average_meter.add(loss.item())
             ppl_average_meter.add(torch.exp(loss).item())
@@ -348,27 +626,97 @@ def evaluate(model, eval_dataloader, criterion, device):
             "bpc": loss_average_meter.value / math.log(2)}
 
 
-def train_epoch(model, train_dataloader, optimizer, criterion, clip=5, device=torch.device('cpu')):
+def evaluate_nested(model, eval_dataloader, ranks, device, stateful=False):
+    """Metrics of every rank prefix in `ranks` in one pass over the data, the batch being repeated once per prefix
+    (see `nested_batch`). Returns `{rank: metrics}`"""
+    with torch.no_grad():
+        loss_average_meters = {r: AverageMeter() for r in ranks}
+        states = None
+        for inputs, targets in eval_dataloader:
+            inputs, targets, rank_prefix = nested_batch(inputs.to(device), targets.to(device), ranks)
+            output, states = model(inputs, states, rank_prefix=rank_prefix)
+            loss = nn.functional.cross_entropy(
+                output.reshape(-1, output.size(-1)).float(), targets.reshape(-1), reduction='none'
+            )
+            for r, loss_r in zip(ranks, loss.view(len(ranks), -1).mean(dim=1).tolist()):
+                loss_average_meters[r].add(loss_r)
+            states = states if stateful else None
+
+    return {r: {"loss": m.value, "ppl": math.exp(m.value), "bpc": m.value / math.log(2)}
+            for r, m in loss_average_meters.items()}
+
+
+def train_epoch_ensemble(ensemble, train_dataloader, optimizer, clip=5, device=torch.device('cpu'), stateful=False,
+                         precision='fp32'):
+    """`train_epoch` of all trials of `ensemble` at once. Returns the metrics of every trial"""
+    loss_average_meters = [AverageMeter() for _ in range(ensemble.n_trials)]
+    ppl_average_meters = [AverageMeter() for _ in range(ensemble.n_trials)]
+    states = None
+
+    for i_batch, (inputs, targets) in enumerate(train_dataloader):
+        inputs, targets = inputs.to(device), targets.to(device)
+
+        optimizer.zero_grad()
+
+        with torch.autocast(device_type=device.type, dtype=_precisions[precision], enabled=precision != 'fp32'):
+            output, states = ensemble(inputs, states)  # [N, B, S, D_out]
+            loss = ensemble_cross_entropy(output, targets)  # [N]
+            states = repackage_hidden(states) if stateful else None
+
+        # Trials do not share parameters, so the gradient of the sum is the gradient of each trial's loss
+        loss.sum().backward()
+
+        if clip != 'inf':
+            clip_grad_norm_per_trial(ensemble.parameters(), clip)
+
+        optimizer.step()
+
+        for i, loss_i in enumerate(loss.tolist()):
+            loss_average_meters[i].add(loss_i)
+            ppl_average_meters[i].add(math.exp(loss_i))
+
+    return [{"loss": loss_meter.value, "ppl": ppl_meter.value, "bpc": loss_meter.value / math.log(2)}
+            for loss_meter, ppl_meter in zip(loss_average_meters, ppl_average_meters)]
+
+
+def train_epoch(model, train_dataloader, optimizer, criterion, clip=5, device=torch.device('cpu'), stateful=False,
+                precision='fp32', fused_loss=False, nested_ranks=None):
     model.train()
     loss_average_meter = AverageMeter()
     ppl_average_meter = AverageMeter()
+    states = None
 
     # for x, y in get_batches(data, n_seqs, n_steps):
     for i_batch, (inputs, targets) in enumerate(train_dataloader):  # [L, BS]
 
         inputs, targets = inputs.to(device), targets.to(device)
+        nested_kwargs = dict()
+        if nested_ranks is not None:
+            inputs, targets, nested_kwargs['rank_prefix'] = nested_batch(inputs, targets, *nested_ranks)
 
         model.zero_grad()
-        output, _ = model.forward(inputs)
 
-        n_seqs_curr, n_steps_curr = output.shape[0], output.shape[1]
-        loss = criterion(output.reshape(n_seqs_curr * n_steps_curr, -1),
-                         targets.reshape(n_seqs_curr * n_steps_curr))
+        # Parameters (master weights) stay in fp32, autocast only lowers the precision of the matmuls
+        with torch.autocast(device_type=device.type, dtype=_precisions[precision], enabled=precision != 'fp32'):
+            if fused_loss:
+                # Logits are computed chunk by chunk and recomputed in backward, they never exist for the whole batch
+                loss, states = model(inputs, states, targets=targets, **nested_kwargs)
+                loss = loss.mean()  # nn.DataParallel returns one loss per replica
+            else:
+                output, states = model.forward(inputs, states, **nested_kwargs)
+
+                # Softmax and loss are computed from fp32 logits
+                n_seqs_curr, n_steps_curr = output.shape[0], output.shape[1]
+                loss = criterion(output.float().reshape(n_seqs_curr * n_steps_curr, -1),
+                                 targets.reshape(n_seqs_curr * n_steps_curr))
+
+            # Rows of consecutive batches continue the same streams: carry the context, but not the gradient history
+            states = repackage_hidden(states) if stateful else None
         loss.backward()
 
         # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
         if clip != 'inf':
-            nn.utils.clip_grad_norm_(model.parameters(), clip)
+            clip_grad_norm_(model.parameters(), clip)  # Norm over all shards for tensor-parallel models
 
         optimizer.step()
 